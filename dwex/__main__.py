@@ -1,22 +1,28 @@
 from bisect import bisect_left
-import sys, os
-from PyQt6.QtCore import Qt, QModelIndex, QSettings, QUrl, QEvent
+import sys, os, time
+from PyQt6.QtCore import Qt, QModelIndex, QSettings, QUrl, QEvent, QTimer
 from PyQt6.QtGui import QFontMetrics, QDesktopServices, QWindow
 from PyQt6.QtWidgets import *
 
 from .die import DIETableModel, on_details_row_dclick
-from .formats import read_dwarf, get_debug_sections, load_companion_executable, FormatError, section_bytes, write_to_file
-from .dwarfutil import get_code_location, get_di_frames, has_code_location, ip_in_range, quote_filename, subprogram_name
+from .formats import read_dwarf, recall_slice, get_debug_sections, load_companion_executable, FormatError, section_bytes, write_to_file
+from .dwarfutil import decorate_dwarfinfo, die_has_text, get_code_location, get_di_frames, has_code_location, ip_in_range, quote_filename, subprogram_name, top_die_file_name
 from .tree import DWARFTreeModel, cu_sort_key
-from .scriptdlg import ScriptDlg, make_execution_environment
+from .scriptdlg import ScriptDlg
 from .ui import setup_explorer, setup_ui
 from .locals import LocalsDlg, LoadedModuleDlgBase
 from .aranges import ArangesDlg
-from .frames import FramesDlg
+from .frames import FramesDlg, parse_error_message
 from .unwind import UnwindDlg
-from .funcmap import FuncMapDlg, GatherFuncsThread
+from .funcmap import FuncMapDlg, GatherFuncsThread, ParallelGatherFuncsThread
 from .fx import WaitCursor, ArrowCursor
 from .treedlg import TreeDlg
+from .indexcache import load_index_cache, save_index_cache
+from .strindex import StringIndex, StringIndexThread
+from .prefetch import PrefetchThread, PrefetchedChildren, nodes_to_prefetch
+from .mpsearch import SearchPool, can_search_in_parallel
+from .diecache import DIECache
+from .addrindex import get_address_index
 
 # Sync with version in setup.py
 version = (4, 80)
@@ -54,6 +60,14 @@ class TheWindow(QMainWindow):
 
         self.findcondition = None
         self.findcucondition = None
+        self.findcandidates = None
+        self.hlcandidates = None
+        self.strindex_thread = None
+        self.prefetch_thread = None
+        self.searchpool = None
+        self.toploader = QTimer(self) # Fills the top nodes of the tree between the UI events
+        self.toploader.setInterval(0)
+        self.toploader.timeout.connect(self.on_load_top_nodes)
 
         self.show()
 
@@ -79,6 +93,11 @@ class TheWindow(QMainWindow):
         self.sortcus = sett.value('General/SortCUs', True, type=bool)
         self.sortdies = sett.value('General/SortDIEs', False, type=bool)
         self.dwarfregnames = sett.value('General/DWARFRegNames', False, type=bool)
+        self.mapfiles = sett.value('General/MapFiles', False, type=bool)
+        self.cacheindex = sett.value('General/CacheIndex', True, type=bool)
+        self.stringindex = sett.value('General/StringIndex', True, type=bool)
+        self.parallelfind = sett.value('General/ParallelFind', True, type=bool)
+        self.diecachemb = sett.value('General/DIECacheMB', 1024, type=int) # Parsed DIEs to keep in memory, roughly, no UI
         self.mru = []
         for i in range(0, 10):
             f = sett.value("General/MRU%d" % i, False)
@@ -116,15 +135,7 @@ class TheWindow(QMainWindow):
     # True if the DWARF tree was loaded
     def open_file(self, filename, slice = None):
         with WaitCursor():
-            def recall_slice(slices, title, text):
-                if len(slice) == 1:
-                    return slices.index(slice[0])
-                else: # arch is a tuple, assuming no more than two levels
-                    (arch, fn) = slice
-                    (i, a) = next(ia for ia in enumerate(slices) if ia[1][0] == arch)
-                    j = a[1].index(fn)
-                    return (i, j)
-            di = read_dwarf(filename, self.resolve_arch if slice is None else recall_slice)
+            di = read_dwarf(filename, self.resolve_arch if slice is None else recall_slice(slice), self.mapfiles)
             if not di: # Covers both False and None
                 return di
             
@@ -135,29 +146,34 @@ class TheWindow(QMainWindow):
         # Some degree of graceful handling of wrong format
         # File name in case of Mach-O bundles refers to the bundle path, not to the binary path within
         try:
+            self.stop_string_index()
+            self.stop_prefetch()
+            self.stop_parallel_search()
+            self.toploader.stop()
+            self.save_index_cache() # For the previous file, if any
             #TODO, slice
             slice_code = di._slice_code if hasattr(di, '_slice_code') else None
             # Some cached top level stuff
             # Notably, iter_CUs doesn't cache (TODO, check that in the next version)
-            di._ranges = None # Loaded on first use
-            di._aranges = None
-            di._frames = None # Loaded on first use, False means missing
-            def decorate_cu(cu, i):
-                cu._i = i
-                cu._lineprogram = None
-                cu._exprparser = None
-                return cu
-            di._unsorted_CUs = [decorate_cu(cu, i) for (i, cu) in enumerate(di.iter_CUs())] # We'll need them first thing, might as well load here
-
-            # For quick CU search by offset within the info section, regardless of sorting
-            di._CU_offsets = [cu.cu_offset for cu in di._unsorted_CUs]
-            di._CUs = list(di._unsorted_CUs)
-
-            if self.sortcus:
+            di._diecache = DIECache(self.diecachemb)
+            di._prefetched = PrefetchedChildren() # Filled in the background
+            decorate_dwarfinfo(di) # We'll need the CUs first thing, might as well load here
+            di._indexcache = load_index_cache(di, filename) if self.cacheindex else None
+
+            cache = di._indexcache
+            if cache and not cache.check_CUs(di._CU_offsets): # Stale
+                cache = di._indexcache = None
+            if cache:
+                di._cu_names = cache.cu_names
+                di._aranges = cache.load_aranges()
+
+            # Sorting by name needs all the top DIEs - unless the names are cached, the CUs are sorted
+            # once the top DIEs are loaded, see on_load_top_nodes()
+            sortcus = self.sortcus and di._cu_names is not None
+            if sortcus:
                 di._CUs.sort(key = cu_sort_key)
                 for (i, cu) in enumerate(di._CUs):
                     cu._i = i
-            di._locparser = None # Created on first use - but see #1683
 
             if self.dwarfinfo is None:
                 setup_explorer(self)
@@ -165,7 +181,7 @@ class TheWindow(QMainWindow):
             self.filename = filename
             has_CUs = bool(len(di._unsorted_CUs))
             if has_CUs:
-                self.tree_model = DWARFTreeModel(di, self.prefix, self.sortcus, self.sortdies)
+                self.tree_model = DWARFTreeModel(di, self.prefix, sortcus, self.sortdies)
                 self.the_tree.setModel(self.tree_model)
                 self.the_tree.selectionModel().currentChanged.connect(self.on_tree_selection)
             else: # Loading a binary with no CUs - possible
@@ -208,6 +224,12 @@ class TheWindow(QMainWindow):
             self.frames_menuitem.setEnabled(True)
             self.unwind_menuitem.setEnabled(di._format in (1, 5))
             self.on_highlight_nothing()
+            self.findcandidates = None
+            self.hlcandidates = None
+            if has_CUs:
+                self.toploader.start() # The string index starts after that
+                self.prefetch_thread = PrefetchThread(self, di)
+                self.prefetch_thread.start()
             # Navigation stack - empty
             self.navhistory = []
             self.navpos = -1
@@ -307,6 +329,45 @@ class TheWindow(QMainWindow):
             except FormatError as exc:
                 self.show_warning(str(exc))
 
+    # Takes effect on the next file open
+    def on_mapfiles(self, checked):
+        self.mapfiles = checked
+        self.sett.setValue('General/MapFiles', self.mapfiles)
+
+    def on_cacheindex(self, checked):
+        self.cacheindex = checked
+        self.sett.setValue('General/CacheIndex', self.cacheindex)
+
+    # Never fails - the cache is an optimization
+    def save_index_cache(self):
+        if self.cacheindex and self.dwarfinfo:
+            try:
+                save_index_cache(self.dwarfinfo)
+            except Exception as exc:
+                print("Error saving the index cache: %s" % format(exc))
+
+    def on_stringindex(self, checked):
+        self.stringindex = checked
+        self.sett.setValue('General/StringIndex', self.stringindex)
+        if self.dwarfinfo and self.tree_model:
+            if checked and not self.dwarfinfo._strindex and not self.toploader.isActive():
+                self.start_string_index(self.dwarfinfo)
+            elif not checked:
+                self.stop_string_index()
+
+    def on_parallelfind(self, checked):
+        self.parallelfind = checked
+        self.sett.setValue('General/ParallelFind', self.parallelfind)
+        if not checked:
+            self.stop_parallel_search()
+
+    def closeEvent(self, evt):
+        self.stop_string_index()
+        self.stop_prefetch()
+        self.stop_parallel_search()
+        self.save_index_cache()
+        QMainWindow.closeEvent(self, evt)
+
     def populate_mru_menu(self):
         class MRUHandler(object):
             def __init__(self, fn, sc, win):
@@ -415,7 +476,7 @@ class TheWindow(QMainWindow):
         with WaitCursor():
             if start_index.isValid():
                 # Export from the selected node downwards
-                die = start_index.internalPointer()
+                die = self.tree_model.die_for_index(start_index)
                 traverse_and_generate_c_skeleton(die, 0, text_lines, self.sortdies)
             else:
                 # Export entire tree by iterating over Compilation Units directly
@@ -443,7 +504,7 @@ class TheWindow(QMainWindow):
     # Index is a tree index - the DIE is the data object within
     def display_die(self, index):
         if self.details_table and self.die_table: # Short out for #1753
-            die = index.internalPointer()
+            die = self.tree_model.die_for_index(index)
             die_table = self.die_table
             if not self.die_model:
                 self.die_model = DIETableModel(die, self.prefix, self.lowlevel, self.hex, self.dwarfregnames)
@@ -478,6 +539,8 @@ class TheWindow(QMainWindow):
                 self.forward_menuitem.setEnabled(False)
                 self.forward_tbitem.setEnabled(False)
         self.display_die(index) # Will clear the selection in the attribute table
+        if self.prefetch_thread and index.isValid():
+            self.prefetch_thread.prefetch(nodes_to_prefetch(index.internalPointer(), self.tree_model.top_dies))
 
     # Selection changed in the DIE table - either user or program
     def on_attribute_selection(self, index, prev = None):
@@ -552,27 +615,111 @@ class TheWindow(QMainWindow):
     # Find/Find next stuff
     ##########################################################################
 
+    # The string index builder also wants all the top DIEs, so it waits for this
+    def on_load_top_nodes(self):
+        if self.tree_model and self.tree_model.load_top_nodes(time.monotonic() + 0.02):
+            return
+        self.toploader.stop()
+        if self.tree_model:
+            if self.sortcus and not self.tree_model.sortcus:
+                self.tree_model.set_sortcus(True)
+                self.the_tree.scrollTo(self.the_tree.currentIndex())
+            if self.stringindex:
+                self.start_string_index(self.dwarfinfo)
+
     def findbytext(self, die, s):
-        for k in die.attributes.keys():
-            attr = die.attributes[k]
-            v = attr.value
-            f = attr.form
-            all = "\n".join((str(v), str(k), f, hex(v) if isinstance(v, int) else '')).lower()
-            if all.find(s) >= 0:
-                return True
-        return False
+        return die_has_text(die, s)
+
+    # Returns a StringMatches or None if the index is not there yet, or can't help with this string
+    def search_string_index(self, s):
+        index = self.dwarfinfo._strindex
+        return index.search(s) if index else None
+
+    def start_string_index(self, di):
+        self.stop_string_index()
+        cache = di._indexcache
+        if cache and cache.has_strindex():
+            parts = cache.load_strindex()
+            if parts:
+                di._strindex = StringIndex(*parts)
+                return
+        th = self.strindex_thread = StringIndexThread(self, di)
+        def done():
+            if th.index and self.dwarfinfo is di:
+                di._strindex = th.index
+            elif th.exc:
+                print(th.exc)
+        th.finished.connect(done)
+        th.start()
+
+    def stop_string_index(self):
+        if self.strindex_thread:
+            self.strindex_thread.cancel()
+            self.strindex_thread.wait()
+            self.strindex_thread = None
+
+    def stop_prefetch(self):
+        if self.prefetch_thread:
+            self.prefetch_thread.stop()
+            self.prefetch_thread = None
+
+    # Kicks off a search in worker processes, starting with the current CU
+    # Returns a cu_candidates function for DWARFTreeModel.find(), or None if it's not worth it
+    def start_parallel_search(self, query):
+        di = self.dwarfinfo
+        if not self.parallelfind or not can_search_in_parallel(di):
+            return None
+        index = self.the_tree.currentIndex()
+        i = index.internalPointer().cu._i if index.isValid() else 0
+        try:
+            search = self.get_searchpool().start_search(query, di._CUs[i:] + di._CUs[:i])
+        except Exception as exc: # Can't start the workers, or they've died - search the slow way
+            print("Error starting the parallel search: %s" % format(exc))
+            self.stop_parallel_search()
+            return None
+        # Blocks on the workers without dispatching any events, the same way the search in this process would.
+        # The timers (highlight scan, tree loading) would otherwise step on find() halfway through.
+        return search.candidates
+
+    # The worker processes are shared between Find and the function map gathering
+    def get_searchpool(self):
+        if self.searchpool is None:
+            self.searchpool = SearchPool(self.filename, self.dwarfinfo)
+        return self.searchpool
+
+    # The highlight condition, evaluated in the worker processes - for DWARFTreeModel.add_highlight()
+    # None if the highlight should be evaluated here, same criteria as for Find
+    def start_parallel_highlight(self, query):
+        di = self.dwarfinfo
+        if not self.parallelfind or not can_search_in_parallel(di):
+            return None
+        try:
+            return self.get_searchpool().start_matching(query, di._CUs)
+        except Exception as exc:
+            print("Error starting the parallel highlight: %s" % format(exc))
+            self.stop_parallel_search()
+            return None
+
+    def stop_parallel_search(self):
+        if self.searchpool:
+            self.searchpool.shutdown()
+            self.searchpool = None
 
     # Exception means false
+    # cond is a Condition
     def eval_user_condition(self, cond, die):
         try:
-            env = make_execution_environment(die)
+            v = cond.quick(die)
+            if v is not None:
+                return v
+            env = cond.environment(die)
         except Exception as exc: # Our error
             from .crash import report_crash
             from inspect import currentframe
             report_crash(exc, exc.__traceback__, version, currentframe())
             return False
         try:
-            return eval(cond, env)
+            return eval(cond.code, env)
         except Exception as exc: # Error in condition or it assumes a different DIE structure 
             print("Error in user condition: %s" % format(exc))
             return False
@@ -582,7 +729,9 @@ class TheWindow(QMainWindow):
         if r[1] and r[0]:
             s = r[0].lower()
             self.findcondition = lambda die: self.findbytext(die, s)
-            self.findcucondision = None
+            self.findcucondition = None
+            matches = self.search_string_index(s)
+            self.findcandidates = matches.candidates if matches else self.start_parallel_search(('text', s))
             self.findnext_menuitem.setEnabled(True)
             self.on_findnext()
 
@@ -597,6 +746,7 @@ class TheWindow(QMainWindow):
                 ip = int(ip, 16)
                 self.findcondition = lambda die: ip_in_range(die, ip)
                 self.findcucondition = lambda cu: ip_in_range(cu.get_top_DIE(), ip)
+                self.findcandidates = lambda cu: get_address_index(cu).offsets_at(ip)
                 self.findnext_menuitem.setEnabled(True)
                 self.on_findnext()            
             except ValueError:
@@ -616,7 +766,7 @@ class TheWindow(QMainWindow):
                 pass
 
     def sample_die(self):
-        return self.the_tree.currentIndex().internalPointer() or self.dwarfinfo._CUs[0].get_top_DIE()
+        return self.tree_model.die_for_index(self.the_tree.currentIndex()) or self.dwarfinfo._CUs[0].get_top_DIE()
 
     def on_findbycondition(self):
         dlg = ScriptDlg(self, self.sample_die())
@@ -624,11 +774,12 @@ class TheWindow(QMainWindow):
             cond = dlg.cond
             self.findcondition = lambda die: self.eval_user_condition(cond, die)
             self.findcucondition = None
+            self.findcandidates = self.start_parallel_search(('condition', dlg.py))
             self.findnext_menuitem.setEnabled(True)
             self.on_findnext()
 
     def on_findnext(self):
-        index = self.tree_model.find(self.the_tree.currentIndex(), self.findcondition, self.findcucondition)
+        index = self.tree_model.find(self.the_tree.currentIndex(), self.findcondition, self.findcucondition, self.findcandidates)
         if index:
             self.the_tree.setCurrentIndex(index)
 
@@ -719,29 +870,15 @@ class TheWindow(QMainWindow):
         self.sortcus = checked
         self.sett.setValue('General/SortCUs', self.sortcus)
         if self.tree_model:
-            sel = self.the_tree.currentIndex()
-            sel = self.tree_model.set_sortcus(checked, sel) # This will reload the tree
-            if sel:
-                self.the_tree.setCurrentIndex(sel)
+            self.tree_model.set_sortcus(checked) # The selection and the navigation history stay
+            self.the_tree.scrollTo(self.the_tree.currentIndex())
 
     def on_sortdies(self, checked):
         self.sortdies = checked
         self.sett.setValue('General/SortDIEs', self.sortdies)
         if self.tree_model:
-            #Throw away everything we had cached so far
-            sel = self.tree_model.set_sortdies(checked)
-            #This invalidates the navigation
-            self.back_menuitem.setEnabled(False)
-            self.back_tbitem.setEnabled(False)
-            self.forward_menuitem.setEnabled(False)
-            self.forward_tbitem.setEnabled(False)
-            self.followref_menuitem.setEnabled(False)
-            self.followref_tbitem.setEnabled(False)
-            # Navigation stack - empty
-            self.navhistory = []
-            self.navpos = -1
-            if sel:
-                self.the_tree.setCurrentIndex(sel)
+            self.tree_model.set_sortdies(checked) # Same
+            self.the_tree.scrollTo(self.the_tree.currentIndex())
 
     # Tree highlighting business
 
@@ -761,7 +898,7 @@ class TheWindow(QMainWindow):
         if self.tree_model.has_highlight(1):
             self.highlight_off(1)
         else:
-            self.tree_model.add_highlight(1, has_code_location)        
+            self.tree_model.add_highlight(1, has_code_location, self.start_parallel_highlight(('code', None)))
             self.manage_hlnavigation(True)
 
     def on_highlight_substring(self):
@@ -771,7 +908,14 @@ class TheWindow(QMainWindow):
             r = QInputDialog.getText(self, 'Highlight', 'Highlight DIEs with substring:')
             if r[1] and r[0]:
                 s = r[0].lower()
-                self.tree_model.add_highlight(2, lambda die:self.findbytext(die, s))
+                matches = self.search_string_index(s)
+                batches = self.start_parallel_highlight(('text', s))
+                if matches:
+                    self.tree_model.add_highlight(2, lambda die: matches.contains(die) if matches.covers(die.cu) else self.findbytext(die, s), batches)
+                    self.hlcandidates = matches.candidates
+                else:
+                    self.tree_model.add_highlight(2, lambda die:self.findbytext(die, s), batches)
+                    self.hlcandidates = None
                 self.manage_hlnavigation(True)
             else:
                 self.highlightsubstring_menuitem.setChecked(False)
@@ -783,7 +927,7 @@ class TheWindow(QMainWindow):
             dlg = ScriptDlg(self, self.sample_die())
             if dlg.exec() == QDialog.DialogCode.Accepted:
                 cond = dlg.cond
-                self.tree_model.add_highlight(3, lambda die: self.eval_user_condition(cond, die))
+                self.tree_model.add_highlight(3, lambda die: self.eval_user_condition(cond, die), self.start_parallel_highlight(('condition', cond.source)))
                 self.manage_hlnavigation(True)
             else:
                 self.highlightcondition_menuitem.setChecked(False)
@@ -797,18 +941,28 @@ class TheWindow(QMainWindow):
         if self.tree_model:
             self.tree_model.clear_highlight()
 
+    # The precomputed highlights, where they're done. Otherwise, the string index,
+    # it only helps if the substring highlight is the only one
+    def hl_candidates(self):
+        model = self.tree_model
+        strcandidates = self.hlcandidates if model.highlight_keys() == {2} else None
+        def candidates(cu):
+            offsets = model.highlight_candidates(cu)
+            return strcandidates(cu) if offsets is None and strcandidates else offsets
+        return candidates
+
     def on_nexthl(self):
-        index = self.tree_model.find(self.the_tree.currentIndex(), self.tree_model.is_highlighted, False)
+        index = self.tree_model.find(self.the_tree.currentIndex(), self.tree_model.is_highlighted, False, self.hl_candidates())
         if index:
             self.the_tree.setCurrentIndex(index)
 
     def on_prevhl(self):
-        index = self.tree_model.find_back(self.the_tree.currentIndex(), self.tree_model.is_highlighted, False)
+        index = self.tree_model.find_back(self.the_tree.currentIndex(), self.tree_model.is_highlighted, False, self.hl_candidates())
         if index:
             self.the_tree.setCurrentIndex(index)
 
     def on_cuproperties(self):
-        die = self.the_tree.currentIndex().internalPointer()
+        die = self.tree_model.die_for_index(self.the_tree.currentIndex())
         if die:
             cu = die.cu
             ver = cu['version']
@@ -856,15 +1010,30 @@ class TheWindow(QMainWindow):
              self.the_tree.setCurrentIndex(self.tree_model.index_for_die(dlg.selected_die))
 
     def on_funcmap(self):
-        th = GatherFuncsThread(self, self.dwarfinfo)
+        di = self.dwarfinfo
+        if di._funcs is None and di._indexcache and di._indexcache.has_funcs():
+            di._funcs = di._indexcache.load_funcs()
+        if di._funcs is not None: # Gathered already
+            self.show_funcmap(di._funcs)
+            return
+
+        th = None
+        if self.parallelfind and can_search_in_parallel(di):
+            try:
+                th = ParallelGatherFuncsThread(self, di, self.get_searchpool().start_gathering_funcs(di._unsorted_CUs))
+            except Exception as exc: # Can't start the workers, or they've died - gather in this process
+                print("Error starting the parallel function gathering: %s" % format(exc))
+                self.stop_parallel_search()
+        if th is None:
+            th = GatherFuncsThread(self, di)
         def done():
+            di._diecache.resume()
             if not pd.wasCanceled():
                 pd.close()
 
-            if th.funcs:
-                dlg = FuncMapDlg(self, self.hex, th.funcs)
-                if dlg.exec() == QDialog.DialogCode.Accepted and dlg.selected_die:
-                    self.the_tree.setCurrentIndex(self.tree_model.index_for_die(dlg.selected_die))
+            if th.funcs is not None:
+                di._funcs = th.funcs
+                self.show_funcmap(th.funcs)
             elif th.exc:
                 print(th.exc)
 
@@ -874,8 +1043,14 @@ class TheWindow(QMainWindow):
         pd.show()
         th.progress.connect(pd.setValue)
         th.finished.connect(done)
+        di._diecache.suspend() # The thread is filling the DIE caches, no evicting under it
         th.start() # Will continue in done
 
+    def show_funcmap(self, funcs):
+        dlg = FuncMapDlg(self, self.hex, funcs)
+        if dlg.exec() == QDialog.DialogCode.Accepted and dlg.selected_die:
+            self.the_tree.setCurrentIndex(self.tree_model.index_for_die(dlg.selected_die))
+
     def on_aranges(self):
         from elftools.common.exceptions import ELFParseError
         try:
@@ -904,7 +1079,7 @@ class TheWindow(QMainWindow):
             else:
                 self.show_warning("This binary does not have neither an eh_frames section nor a debug_frames section.")
         except KeyError: # 1761
-            self.show_warning("Error parsing the frames section in this binary. Please report to the tech support: menu/Help/Report an issue.")
+            self.show_warning(parse_error_message)
 
             
     def on_unwind(self):
@@ -991,6 +1166,10 @@ def main():
     from .patch import monkeypatch
     monkeypatch()
 
+    # For the parallel search workers in frozen builds
+    from multiprocessing import freeze_support
+    freeze_support()
+
     global the_app
     the_app = TheApp()
     the_app.start()
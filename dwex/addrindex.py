@@ -0,0 +1,152 @@
+from array import array
+from bisect import bisect_right
+
+from .dwarfutil import get_code_location, has_code_location, CodeLocationSimple
+from .dieindex import find_DIE
+
+# Address lookup over the code ranges of DIEs - functions, inlines, lexical blocks,
+# and the likes of them.
+#
+# ip_in_range() reparses the range list every time, and finding the DIEs at an address
+# used to mean calling it on every DIE. Instead, the ranges of a CU are resolved once,
+# into absolute (low, high) pairs, and the address space is cut into segments,
+# each one mapped to all the DIEs that cover it, innermost first. An address lookup is a bisect.
+# Siblings may overlap - ICF folded functions, duplicated subprograms - so that's
+# every covering DIE, not just a chain of ancestors.
+#
+# There is also a CU level one, over the top DIEs, for when aranges are missing or incomplete.
+# This doesn't depend on Qt.
+
+NO_ENTRY = 0xFFFFFFFF
+
+class AddressIndex(object):
+    # Entries are the DIEs (or CUs) with code ranges, in order.
+    # The ranges of entry #i are lows/highs[range_starts[i]:range_starts[i+1]]
+    # parents are the entries of the closest indexed ancestor, NO_ENTRY if none
+    # seg_starts are the starts of address segments, the entries that cover segment #i,
+    # innermost first, are seg_entries[seg_firsts[i]:seg_firsts[i+1]]
+    def __init__(self, offsets, parents, range_starts, lows, highs, seg_starts, seg_firsts, seg_entries):
+        self.offsets = offsets
+        self.parents = parents
+        self.range_starts = range_starts
+        self.lows = lows
+        self.highs = highs
+        self.seg_starts = seg_starts
+        self.seg_firsts = seg_firsts
+        self.seg_entries = seg_entries
+
+    def contains(self, i, ip):
+        lows = self.lows
+        highs = self.highs
+        return any(lows[r] <= ip < highs[r] for r in range(self.range_starts[i], self.range_starts[i+1]))
+
+    # The innermost entry that covers the address, or -1. The first one, if there are several.
+    def innermost(self, ip):
+        i = bisect_right(self.seg_starts, ip) - 1
+        if i < 0 or self.seg_firsts[i] == self.seg_firsts[i+1]:
+            return -1
+        return self.seg_entries[self.seg_firsts[i]]
+
+    # Entries that cover the address, innermost first; among the same depth, in order
+    def chain(self, ip):
+        i = bisect_right(self.seg_starts, ip) - 1
+        if i < 0:
+            return []
+        return list(self.seg_entries[self.seg_firsts[i]:self.seg_firsts[i+1]])
+
+    # Offsets of the DIEs that cover the address, in order
+    # For DWARFTreeModel.find()
+    def offsets_at(self, ip):
+        return array('Q', sorted(self.offsets[i] for i in self.chain(ip)))
+
+# Entries are (offset, parent, depth, ranges)
+def _make_index(entries):
+    offsets = array('Q')
+    parents = array('L')
+    range_starts = array('L')
+    lows = array('Q')
+    highs = array('Q')
+    events = [] # (address, is_start, entry)
+    for (i, (offset, parent, depth, ranges)) in enumerate(entries):
+        offsets.append(offset)
+        parents.append(parent)
+        range_starts.append(len(lows))
+        for (low, high) in ranges:
+            lows.append(low)
+            highs.append(high)
+            events.append((low, 1, i))
+            events.append((high, 0, i))
+    range_starts.append(len(lows))
+
+    # Sweep over the addresses, a segment starts wherever the set of the covering entries changes
+    events.sort()
+    active = dict() # Entry to the number of its ranges that cover the current address
+    seg_starts = array('Q')
+    seg_firsts = array('L')
+    seg_entries = array('L')
+    covering = None
+    n = len(events)
+    e = 0
+    while e < n:
+        address = events[e][0]
+        while e < n and events[e][0] == address:
+            (_, is_start, i) = events[e]
+            if is_start:
+                active[i] = active.get(i, 0) + 1
+            else:
+                active[i] -= 1
+                if not active[i]:
+                    del active[i]
+            e += 1
+        now_covering = sorted(active, key = lambda i: (-entries[i][2], i))
+        if now_covering != covering:
+            seg_starts.append(address)
+            seg_firsts.append(len(seg_entries))
+            seg_entries.extend(now_covering)
+            covering = now_covering
+    seg_firsts.append(len(seg_entries))
+    return AddressIndex(offsets, parents, range_starts, lows, highs, seg_starts, seg_firsts, seg_entries)
+
+# Absolute (low, high) pairs, empty ones skipped
+def _resolve_ranges(die):
+    try:
+        loc = get_code_location(die)
+        ranges = [(loc.low, loc.hi)] if isinstance(loc, CodeLocationSimple) else loc.ranges
+    except Exception: # No base, no ranges section, or malformed - leave it out, like ip_in_range would
+        return ()
+    return [r for r in ranges if r[0] < r[1]]
+
+# Returns the address index of the CU, building it on the first use
+def get_address_index(cu):
+    index = getattr(cu, '_addrindex', None)
+    if index is None:
+        entries = []
+        def walk(die, parent, depth):
+            if has_code_location(die):
+                ranges = _resolve_ranges(die)
+                if ranges:
+                    entries.append((die.offset, parent, depth, ranges))
+                    parent = len(entries) - 1
+            for child in die.iter_children():
+                walk(child, parent, depth + 1)
+        walk(cu.get_top_DIE(), NO_ENTRY, 0)
+        index = cu._addrindex = _make_index(entries)
+    return index
+
+# Over the top DIEs, the offsets are of the CUs
+def get_cu_address_index(di):
+    index = getattr(di, '_cuaddrindex', None)
+    if index is None:
+        entries = []
+        for cu in di._unsorted_CUs:
+            top_die = cu.get_top_DIE()
+            ranges = _resolve_ranges(top_die) if has_code_location(top_die) else None
+            if ranges:
+                entries.append((cu.cu_offset, NO_ENTRY, 0, ranges))
+        index = di._cuaddrindex = _make_index(entries)
+    return index
+
+# DIEs that cover the address in the CU, outermost first
+def find_DIEs_at_address(cu, address):
+    index = get_address_index(cu)
+    return [find_DIE(cu, index.offsets[i]) for i in sorted(index.chain(address))] # Entries are in the DIE order
@@ -0,0 +1,155 @@
+from array import array
+from bisect import bisect_left
+
+from elftools.dwarf.callframe import CallFrameInfo
+from elftools.dwarf.structs import DWARFStructs
+
+# Call frame info, parsed on demand.
+#
+# pyelftools' EH_CFI_entries()/CFI_entries() parse every CIE and FDE, with the instructions,
+# before returning anything. On a large binary, that's seconds and a lot of memory before
+# the Frames dialog shows up, or before the first CFA lookup.
+# Instead, the sections are scanned once for the entry lengths, which gives the offsets
+# and the kinds of the entries. An entry is parsed by pyelftools when it's asked for -
+# a visible row in the Frames dialog, an FDE that an address lookup has landed on.
+# For the address index (see FDEIndex), there's fde_ranges(), which reads the start
+# and the length of every FDE from the header bytes, without parsing the rest.
+# This doesn't depend on Qt.
+
+_CIE = 0
+_FDE = 1
+_ZERO = 2 # eh_frame terminator
+
+# Byte sizes of the basic pointer encodings in eh_frame, signed or not; 0 is absptr, the address size
+_eh_pointer_sizes = {0x00: (0, False), 0x02: (2, False), 0x03: (4, False), 0x04: (8, False),
+    0x0a: (2, True), 0x0b: (4, True), 0x0c: (8, True)}
+_DW_EH_PE_pcrel = 0x10
+
+# The entries of one CFI section, in the section order
+class LazyCFI(object):
+    def __init__(self, di, sec, for_eh_frame):
+        self.cfi = CallFrameInfo(stream=sec.stream, size=sec.size, address=sec.address,
+            base_structs=di.structs, for_eh_frame=for_eh_frame)
+        self.sec = sec
+        self.for_eh_frame = for_eh_frame
+        self.byteorder = 'little' if di.structs.little_endian else 'big'
+        self.address_size = di.structs.address_size
+        self.offsets = array('Q')
+        self.kinds = bytearray()
+        self.parsed = dict() # Position to entry - the views hold on to the entries by raw pointers, they have to stay around
+        self.scan()
+
+    def scan(self):
+        bo = self.byteorder
+        eh = self.for_eh_frame
+        offsets = self.offsets
+        kinds = self.kinds
+        buf = self.sec.stream.getbuffer()
+        try:
+            size = self.sec.size
+            pos = 0
+            while pos < size:
+                length = int.from_bytes(buf[pos:pos+4], bo)
+                if eh and length == 0:
+                    offsets.append(pos)
+                    kinds.append(_ZERO)
+                    pos += 4
+                    continue
+                if length == 0xFFFFFFFF:
+                    length = int.from_bytes(buf[pos+4:pos+12], bo)
+                    id = int.from_bytes(buf[pos+12:pos+20], bo)
+                    is_CIE = id == 0 if eh else id == 0xFFFFFFFFFFFFFFFF
+                    header_size = 12
+                else:
+                    id = int.from_bytes(buf[pos+4:pos+8], bo)
+                    is_CIE = id == 0 if eh else id == 0xFFFFFFFF
+                    header_size = 4
+                offsets.append(pos)
+                kinds.append(_CIE if is_CIE else _FDE)
+                pos += header_size + length
+        finally:
+            del buf
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        entry = self.parsed.get(i)
+        if entry is None:
+            entry = self.parsed[i] = self.cfi._parse_entry_at(self.offsets[i])
+        return entry
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    # The FDE at the offset in the section, or None if there's no FDE there
+    def fde_at_offset(self, offset):
+        i = bisect_left(self.offsets, offset)
+        if i < len(self.offsets) and self.offsets[i] == offset and self.kinds[i] == _FDE:
+            return self[i]
+        return None
+
+    # Yields (position, initial location, address range) for every FDE,
+    # same as in the headers that pyelftools would parse
+    def fde_ranges(self):
+        bo = self.byteorder
+        eh = self.for_eh_frame
+        asz = self.address_size
+        buf = self.sec.stream.getbuffer()
+        try:
+            for (i, offset) in enumerate(self.offsets):
+                if self.kinds[i] != _FDE:
+                    continue
+                if int.from_bytes(buf[offset:offset+4], bo) == 0xFFFFFFFF:
+                    (dwarf_format, p) = (64, offset + 12)
+                    osz = 8
+                else:
+                    (dwarf_format, p) = (32, offset + 4)
+                    osz = 4
+                if not eh:
+                    yield (i, int.from_bytes(buf[p+osz:p+osz+asz], bo), int.from_bytes(buf[p+osz+asz:p+osz+2*asz], bo))
+                    continue
+                # Same as CallFrameInfo._parse_cie_for_fde()
+                cie_offset = offset + dwarf_format // 8 - int.from_bytes(buf[p:p+osz], bo)
+                encoding = self.cfi._parse_entry_at(cie_offset).augmentation_dict['FDE_encoding']
+                (size, signed) = _eh_pointer_sizes.get(encoding & 0x0f, (None, None))
+                if size is None or encoding & 0xf0 not in (0, _DW_EH_PE_pcrel):
+                    header = self.cfi._parse_fde_header(DWARFStructs(little_endian=bo == 'little',
+                        dwarf_format=dwarf_format, address_size=asz), offset) # Uncommon, let pyelftools deal with it
+                    yield (i, header.initial_location, header.address_range)
+                    continue
+                size = size or asz
+                p += osz
+                initial_location = int.from_bytes(buf[p:p+size], bo, signed=signed)
+                address_range = int.from_bytes(buf[p+size:p+2*size], bo, signed=signed)
+                if encoding & 0xf0 == _DW_EH_PE_pcrel:
+                    initial_location += self.cfi.address + p
+                yield (i, initial_location, address_range)
+        finally:
+            del buf
+
+# eh_frame, then debug_frame, as one sequence - what get_di_frames() returns
+class FrameEntries(object):
+    # Either can be None
+    def __init__(self, eh, cfi):
+        self.eh = eh
+        self.cfi = cfi
+        self.eh_count = len(eh) if eh else 0
+        self.has_cfi = cfi is not None
+
+    def __len__(self):
+        return self.eh_count + (len(self.cfi) if self.cfi else 0)
+
+    def __getitem__(self, i):
+        return self.eh[i] if i < self.eh_count else self.cfi[i - self.eh_count]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    # Yields (position, initial location, address range) for every FDE
+    def fde_ranges(self):
+        if self.eh:
+            yield from self.eh.fde_ranges()
+        if self.cfi:
+            for (i, start, length) in self.cfi.fde_ranges():
+                yield (self.eh_count + i, start, length)
@@ -0,0 +1,181 @@
+import ast, re
+from elftools.dwarf.locationlists import LocationParser
+
+# User conditions - Find by condition, Highlight by condition.
+#
+# A condition is a Python expression, evaluated for every DIE in an environment where the DIE,
+# its tag and its attributes are variables - see make_execution_environment(). Building that
+# environment for every DIE, with every attribute, was most of the cost of a search.
+# So the expression is analyzed once:
+# - only the names that it refers to are bound;
+# - the parts of it that only depend on the tag, on the attribute presence and on the has children bit,
+#   which are the same for all DIEs with the same abbreviation, are computed once per abbreviation.
+#   If such a part makes the whole condition false, the DIE is skipped without an eval(),
+#   if the whole condition is like that, there's no eval() at all.
+# This doesn't depend on Qt.
+
+_fixed_names = ('die', 'tag', 'attr', 'has_attribute', 'has_loclist')
+_user_name = re.compile(r'user_[0-9A-F]+$')
+
+def _env_tag(tag):
+    return 'user_%X' % (tag,) if isinstance(tag, int) else tag[7:]
+
+def _has_attribute(die):
+    def has_attribute(func):
+        for k in die.attributes:
+            if func(k, die.attributes[k].value, die.attributes[k].form):
+                return True
+    return has_attribute
+
+def _has_loclist(die):
+    def has_loclist():
+        ver = die.cu.header.version
+        def attr_is_loclist(attr):
+            return (LocationParser._attribute_is_loclistptr_class(attr) and
+                LocationParser._attribute_has_loc_list(attr, ver))
+        g = (a for a in die.attributes if attr_is_loclist(die.attributes[a]))
+        return bool(next(g, False))
+    return has_loclist
+
+_fixed_bindings = {
+    'die': lambda die: die,
+    'tag': lambda die: _env_tag(die.tag),
+    'attr': lambda die: die.attributes,
+    'has_attribute': _has_attribute,
+    'has_loclist': _has_loclist}
+
+# The whole environment, as the guide describes it
+def make_execution_environment(die):
+    d = {k: bind(die) for (k, bind) in _fixed_bindings.items()}
+    for k, a in die.attributes.items():
+        d['user_%X' % (k,) if isinstance(k, int) else k[6:]] = a.value
+    return d
+
+# All the global names that the code, and the lambdas/comprehensions within, might look up
+def _code_names(code):
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if hasattr(c, 'co_names'):
+            names |= _code_names(c)
+    return names
+
+#------------------------------------
+# The per abbreviation part. Static parts of the expression become functions of (tag, attribute names, has children).
+#------------------------------------
+
+def _is_name(node, name):
+    return isinstance(node, ast.Name) and node.id == name
+
+def _is_die_field(node, field):
+    return isinstance(node, ast.Attribute) and _is_name(node.value, 'die') and node.attr == field
+
+def _constants(node):
+    if isinstance(node, ast.Constant):
+        return (node.value,)
+    elif isinstance(node, (ast.Tuple, ast.List, ast.Set)) and all(isinstance(e, ast.Constant) for e in node.elts):
+        return tuple(e.value for e in node.elts)
+    return None
+
+# tag == 'variable', die.tag == 'DW_TAG_variable', tag in ('variable', 'member'), the same with != and not in
+def _static_tag_compare(left, op, right):
+    if isinstance(op, (ast.Eq, ast.NotEq)) and (_is_name(right, 'tag') or _is_die_field(right, 'tag')):
+        (left, right) = (right, left)
+    if _is_name(left, 'tag'):
+        get_tag = lambda a: _env_tag(a[0])
+    elif _is_die_field(left, 'tag'):
+        get_tag = lambda a: a[0]
+    else:
+        return None
+    values = _constants(right)
+    if values is None:
+        return None
+    if isinstance(op, ast.Eq) and isinstance(right, ast.Constant):
+        return lambda a: get_tag(a) == values[0]
+    elif isinstance(op, ast.NotEq) and isinstance(right, ast.Constant):
+        return lambda a: get_tag(a) != values[0]
+    elif isinstance(op, ast.In) and not isinstance(right, ast.Constant):
+        return lambda a: get_tag(a) in values
+    elif isinstance(op, ast.NotIn) and not isinstance(right, ast.Constant):
+        return lambda a: get_tag(a) not in values
+    return None
+
+# 'DW_AT_name' in attr, 'DW_AT_name' not in die.attributes
+def _static_presence(left, op, right):
+    if (isinstance(left, ast.Constant) and isinstance(left.value, (str, int)) and isinstance(op, (ast.In, ast.NotIn))
+        and (_is_name(right, 'attr') or _is_die_field(right, 'attributes'))):
+        key = left.value
+        if isinstance(op, ast.In):
+            return lambda a: key in a[1]
+        else:
+            return lambda a: key not in a[1]
+    return None
+
+def _static(node):
+    if isinstance(node, ast.BoolOp):
+        parts = [_static(v) for v in node.values]
+        if any(p is None for p in parts):
+            return None
+        if isinstance(node.op, ast.And):
+            return lambda a: all(p(a) for p in parts)
+        else:
+            return lambda a: any(p(a) for p in parts)
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        p = _static(node.operand)
+        return (lambda a: not p(a)) if p else None
+    elif isinstance(node, ast.Compare) and len(node.ops) == 1:
+        return (_static_tag_compare(node.left, node.ops[0], node.comparators[0]) or
+            _static_presence(node.left, node.ops[0], node.comparators[0]))
+    elif _is_die_field(node, 'has_children'):
+        return lambda a: bool(a[2])
+    return None
+
+class Condition(object):
+    # Raises on syntax errors, like compile()
+    def __init__(self, source):
+        self.source = source
+        self.code = compile(source, 'inline', 'eval')
+        names = _code_names(self.code)
+        self.fixed = tuple((name, _fixed_bindings[name]) for name in _fixed_names if name in names)
+        # (variable name, attribute key) - user_XX is either an unknown attribute or DW_AT_user_XX
+        self.attrs = tuple((name, 'DW_AT_' + name) for name in names if name not in _fixed_bindings)
+        self.attrs += tuple((name, int(name[5:], 16)) for name in names if _user_name.match(name))
+
+        # The static parts. The whole thing, or the operands of the top level "and" that are.
+        self.static = None # Function of (tag, attribute names, has children)
+        self.fully_static = False
+        tree = ast.parse(source, mode='eval').body
+        if not any(isinstance(n, ast.NamedExpr) for n in ast.walk(tree)): # A := could rebind tag or attr
+            self.static = _static(tree)
+            if self.static:
+                self.fully_static = True
+            elif isinstance(tree, ast.BoolOp) and isinstance(tree.op, ast.And):
+                parts = [p for p in (_static(v) for v in tree.values) if p]
+                if parts:
+                    self.static = lambda a: all(p(a) for p in parts)
+        self.by_abbrev = dict() # (CU offset, abbrev code) to the static value
+
+    # True or False if the abbreviation alone decides, None if the expression has to be evaluated
+    def quick(self, die):
+        if not self.static:
+            return None
+        code = die.abbrev_code
+        if code is None: # DWARF 1, no abbreviations
+            v = self.static((die.tag, die.attributes, die.has_children))
+        else:
+            key = (die.cu.cu_offset, code)
+            v = self.by_abbrev.get(key)
+            if v is None:
+                v = self.by_abbrev[key] = self.static((die.tag, die.attributes, die.has_children))
+        if self.fully_static:
+            return v
+        return None if v else False
+
+    # Same as make_execution_environment(), only with what the expression looks at
+    def environment(self, die):
+        d = {name: bind(die) for (name, bind) in self.fixed}
+        attributes = die.attributes
+        for (name, key) in self.attrs:
+            a = attributes.get(key)
+            if a is not None:
+                d[name] = a.value
+        return d
@@ -32,6 +32,35 @@ class GenericTableModel(QAbstractTableModel):
             if self.get_tooltip:
                 return self.get_tooltip(index.row(), index.column(), index.internalPointer())
 
+class PagedTableModel(GenericTableModel):
+    """ For large tables - rows are produced by get_row(i) on demand, a page at a time.
+        The pages are kept, since the index internal object is the row
+    """
+    PAGE_SIZE = 256
+
+    def __init__(self, headers, count, get_row):
+        QAbstractTableModel.__init__(self)
+        self.headers = headers
+        self.count = count
+        self.get_row = get_row
+        self.pages = dict()
+        self.warning = None
+        self.get_tooltip = None
+
+    def rowCount(self, parent):
+        return self.count
+
+    def row(self, row):
+        page_no = row // self.PAGE_SIZE
+        page = self.pages.get(page_no)
+        if page is None:
+            start = page_no * self.PAGE_SIZE
+            page = self.pages[page_no] = tuple(self.get_row(i) for i in range(start, min(start + self.PAGE_SIZE, self.count)))
+        return page[row % self.PAGE_SIZE]
+
+    def index(self, row, col, parent):
+        return self.createIndex(row, col, self.row(row))
+
 class FixedWidthTableModel(GenericTableModel):
     def __init__(self, headers, values):
         super().__init__(headers, values)
@@ -9,7 +9,8 @@ from elftools.common.exceptions import ELFParseError
 from .exprutil import ExprFormatter, is_parsed_expression
 from .dwarfone import DWARFExprParserV1
 from .dwarfutil import *
-from .details import GenericTableModel, FixedWidthTableModel
+from .details import GenericTableModel, FixedWidthTableModel, PagedTableModel
+from .linetable import get_line_table, IS_STMT, BASIC_BLOCK, END_SEQUENCE, PROLOGUE_END, EPILOGUE_BEGIN
 from .exprdlg import ExpressionTableModel, ExpressionDlg, op_has_nested_expression
 from .fx import blue_brush, ltgrey_brush
 
@@ -369,34 +370,31 @@ class DIETableModel(QAbstractTableModel):
             elif LocationParser.attribute_has_location(attr, self.die.cu['version']):
                 return self.show_location(attr)
             elif key == 'DW_AT_stmt_list':
-                if self.die.cu._lineprogram is None:
-                    self.die.cu._lineprogram = self.die.dwarfinfo.line_program_for_CU(self.die.cu)
-                lpe = self.die.cu._lineprogram.get_entries()
-                files = self.die.cu._lineprogram.header.file_entry
-                ver5 = self.die.cu._lineprogram.header.version >= 5
+                lt = get_line_table(self.die.cu)
+                if lt is None:
+                    return None
                 def_file = safe_DIE_name(self.die.cu.get_top_DIE(), 'N/A')
-                def format_state(state):
-                    filename = 'N/A'
-                    if ver5:
-                        if state.file >= 0 and state.file < len(files):
-                            filename = files[state.file].name.decode('utf-8', errors='ignore')
-                    else:
-                        if state.file == 0:
-                            filename = def_file
-                        elif state.file >= 1 and state.file <= len(files):
-                            filename = files[state.file-1].name.decode('utf-8', errors='ignore')
-                    return (hex(state.address),
+                file_names = dict() # Decoded, by file number
+                def format_state(i):
+                    file = lt.files[i]
+                    filename = file_names.get(file)
+                    if filename is None:
+                        filename = lt.file_name(file, def_file)
+                        if isinstance(filename, bytes):
+                            filename = filename.decode('utf-8', errors='ignore')
+                        filename = file_names[file] = filename or 'N/A'
+                    flags = lt.flags[i]
+                    return (hex(lt.addresses[i]),
                         filename,
-                        state.line,
-                        'Y' if state.is_stmt  else '',
-                        'Y' if state.basic_block else '',
-                        'Y' if state.end_sequence else '',
-                        'Y' if state.prologue_end else '',
-                        'Y' if state.epilogue_begin else '')
-                states = [format_state(e.state) for e in lpe if e.state]
+                        lt.lines[i],
+                        'Y' if flags & IS_STMT else '',
+                        'Y' if flags & BASIC_BLOCK else '',
+                        'Y' if flags & END_SEQUENCE else '',
+                        'Y' if flags & PROLOGUE_END else '',
+                        'Y' if flags & EPILOGUE_BEGIN else '')
                 # TODO: low level flavor with extra details
                 # TODO: commands vs states
-                return GenericTableModel(('Address', 'File', 'Line', 'Stmt', 'Basic block', 'End seq', 'End prologue', 'Begin epilogue'), states)
+                return PagedTableModel(('Address', 'File', 'Line', 'Stmt', 'Basic block', 'End seq', 'End prologue', 'Begin epilogue'), len(lt), format_state)
             elif key in ('DW_AT_upper_bound', 'DW_AT_lower_bound') and is_block(form):
                 return ExpressionTableModel(self.parse_expr(attr.value), self.expr_formatter)
             elif is_long_blob(attr):
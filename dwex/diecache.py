@@ -0,0 +1,101 @@
+import threading
+from collections import OrderedDict
+
+# Keeps the parsed DIEs in memory under a budget.
+#
+# pyelftools caches every DIE that it parses in the CU (_dielist/_diemap), and never lets go.
+# Find through a large binary, or a long browsing session, parses most of it, and the process
+# grows to gigabytes. The tree doesn't hold on to DIEs (see DIENode), and everything else
+# that needs a DIE later remembers the offset, so the cached DIEs of a CU can be dropped,
+# and they will be parsed again on the next access.
+#
+# The CUs are tracked in the order they were last touched, the least recent ones are
+# evicted first, down to the top DIE. Callers touch a CU before they parse its DIEs.
+# The DIE count is an estimate of the size - the number of DIEs that were cached
+# the last time the CU was touched.
+# Only call from the UI thread. While some other thread is parsing DIEs, eviction should be suspended.
+#
+# The caches themselves are shared between the UI thread and the ones that parse DIEs in the background
+# (the function map). A lookup in a cache is a bisect in _diemap, an insert is two list inserts,
+# and a thread switch in between would pair the wrong DIE with an offset. So everything that touches
+# _dielist/_diemap goes under cache_lock - the pyelftools methods are wrapped in patch.py.
+# This doesn't depend on Qt.
+
+cache_lock = threading.RLock()
+
+DIE_COST = 1500 # Bytes per cached DIE, roughly, with the attributes
+
+class DIECache(object):
+    def __init__(self, budget_mb):
+        self.max_dies = max(budget_mb, 1) * 1024 * 1024 // DIE_COST
+        self.cus = OrderedDict() # CU offset to (CU, DIE count), least recently touched first
+        self.total = 0
+        self.suspended = 0
+
+    # Marks the CU as the most recently used, evicts the others if over budget
+    def touch(self, cu):
+        cus = self.cus
+        cu_offset = cu.cu_offset
+        # The last one touched is likely to have grown since
+        if cus:
+            (last_offset, (last_cu, count)) = next(reversed(cus.items()))
+            if last_offset != cu_offset:
+                self._update(last_offset, last_cu)
+        self._update(cu_offset, cu)
+        cus.move_to_end(cu_offset)
+        if self.total > self.max_dies and not self.suspended:
+            self._evict()
+
+    def _update(self, cu_offset, cu):
+        count = len(cu._dielist)
+        old = self.cus.get(cu_offset)
+        self.total += count - (old[1] if old else 0)
+        self.cus[cu_offset] = (cu, count)
+
+    # The one that was just touched goes last, if it's over the budget all by itself.
+    # That's safe, since the callers touch a CU before they parse anything in it, not in the middle.
+    def _evict(self):
+        cus = self.cus
+        while self.total > self.max_dies and cus:
+            (cu_offset, (cu, count)) = cus.popitem(False)
+            evict_CU(cu)
+            self.total -= count
+
+    # For the passes over every CU that shouldn't disturb the tree's working set (the highlight scan) -
+    # called once the pass is done with the CU, which it didn't touch. The CU stays where it was in the order.
+    # Unless the tree has its DIEs cached past the top one, whatever the pass has parsed is dropped.
+    def release(self, cu):
+        cus = self.cus
+        cu_offset = cu.cu_offset
+        entry = cus.get(cu_offset)
+        # The last one touched might be in use with the count not updated yet, see touch()
+        if entry and (entry[1] > 1 or next(reversed(cus)) == cu_offset):
+            self._update(cu_offset, cu)
+            if self.total > self.max_dies and not self.suspended:
+                self._evict()
+        else:
+            evict_CU(cu)
+            if entry:
+                self._update(cu_offset, cu)
+
+    def suspend(self):
+        self.suspended += 1
+
+    def resume(self):
+        self.suspended -= 1
+
+# Drops the cached DIEs of the CU, except for the top one - pyelftools relies on that one being there
+def evict_CU(cu):
+    with cache_lock:
+        del cu._dielist[1:]
+        del cu._diemap[1:]
+
+def touch_CU(cu):
+    cache = getattr(cu.dwarfinfo, '_diecache', None)
+    if cache:
+        cache.touch(cu)
+
+def release_CU(cu):
+    cache = getattr(cu.dwarfinfo, '_diecache', None)
+    if cache:
+        cache.release(cu)
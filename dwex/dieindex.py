@@ -0,0 +1,309 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+from elftools.dwarf.enums import ENUM_DW_FORM
+
+from .diecache import cache_lock
+
+# Random access to DIEs within a CU.
+#
+# pyelftools can only get to a DIE by parsing everything before it,
+# so following a reference into a large CU used to mean parsing the whole CU.
+# Instead, we scan the CU once, without building any DIE objects, only skipping over
+# attribute values using the sizes from the abbreviation table, and remember the offsets.
+# After that, getting to any DIE means parsing that DIE and its ancestors, and nothing else.
+
+NO_PARENT = 0xFFFFFFFFFFFFFFFF # In the parents array, for the top DIE
+
+# Value skipping plan items, other than fixed sizes - negative so that they don't clash
+_LEB = -1
+_STRING = -2
+_BLOCK1 = -3
+_BLOCK2 = -4
+_BLOCK4 = -5
+_BLOCKLEB = -6
+_INDIRECT = -7
+
+# Forms that are one LEB128 number
+_leb_forms = set(('DW_FORM_sdata', 'DW_FORM_udata', 'DW_FORM_ref_udata', 'DW_FORM_strx', 'DW_FORM_addrx',
+    'DW_FORM_loclistx', 'DW_FORM_rnglistx', 'DW_FORM_GNU_addr_index', 'DW_FORM_GNU_str_index'))
+
+# Forms that are an offset into another section
+_offset_forms = set(('DW_FORM_strp', 'DW_FORM_line_strp', 'DW_FORM_strp_sup', 'DW_FORM_sec_offset',
+    'DW_FORM_GNU_ref_alt', 'DW_FORM_GNU_strp_alt'))
+
+_fixed_forms = {
+    'DW_FORM_data1': 1, 'DW_FORM_data2': 2, 'DW_FORM_data4': 4, 'DW_FORM_data8': 8, 'DW_FORM_data16': 16,
+    'DW_FORM_ref1': 1, 'DW_FORM_ref2': 2, 'DW_FORM_ref4': 4, 'DW_FORM_ref8': 8,
+    'DW_FORM_ref_sig8': 8, 'DW_FORM_ref_sup4': 4, 'DW_FORM_ref_sup8': 8,
+    'DW_FORM_flag': 1, 'DW_FORM_flag_present': 0, 'DW_FORM_implicit_const': 0,
+    'DW_FORM_strx1': 1, 'DW_FORM_strx2': 2, 'DW_FORM_strx3': 3, 'DW_FORM_strx4': 4,
+    'DW_FORM_addrx1': 1, 'DW_FORM_addrx2': 2, 'DW_FORM_addrx3': 3, 'DW_FORM_addrx4': 4}
+
+_block_forms = {'DW_FORM_block1': _BLOCK1, 'DW_FORM_block2': _BLOCK2, 'DW_FORM_block4': _BLOCK4,
+    'DW_FORM_block': _BLOCKLEB, 'DW_FORM_exprloc': _BLOCKLEB}
+
+_form_names = {v: k for (k, v) in ENUM_DW_FORM.items() if isinstance(v, int)}
+
+class UnsupportedFormError(Exception):
+    pass
+
+# Returns the byte size of a form, or one of the variable size codes above
+def form_size(form, address_size, offset_size, version):
+    if form in _fixed_forms:
+        return _fixed_forms[form]
+    elif form == 'DW_FORM_addr':
+        return address_size
+    elif form in _offset_forms:
+        return offset_size
+    elif form == 'DW_FORM_ref_addr':
+        return address_size if version == 2 else offset_size
+    elif form in _leb_forms:
+        return _LEB
+    elif form == 'DW_FORM_string':
+        return _STRING
+    elif form in _block_forms:
+        return _block_forms[form]
+    elif form == 'DW_FORM_indirect':
+        return _INDIRECT
+    raise UnsupportedFormError(form)
+
+# A plan is a tuple of fixed sizes and variable size codes, with the adjacent fixed sizes merged
+# A DIE with no variable size attributes has a plan of a single int
+def _make_plan(abbrev, address_size, offset_size, version):
+    plan = []
+    fixed = 0
+    for spec in abbrev['attr_spec']:
+        size = form_size(spec.form, address_size, offset_size, version)
+        if size >= 0:
+            fixed += size
+        else:
+            if fixed:
+                plan.append(fixed)
+                fixed = 0
+            plan.append(size)
+    if not plan:
+        return fixed
+    if fixed:
+        plan.append(fixed)
+    return tuple(plan)
+
+class DIEIndex(object):
+    # offsets: the section offsets of the non-null DIEs, in order
+    # parents: the offsets of their parent DIEs, NO_PARENT for the top one
+    # ends: the offsets right after their subtrees, i. e. where the next sibling or the terminator would be
+    def __init__(self, cu, offsets, parents, ends):
+        self.cu = cu
+        self.offsets = offsets
+        self.parents = parents
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Position of the DIE with the exact offset, or -1
+    def find(self, offset):
+        i = bisect_left(self.offsets, offset)
+        return i if i < len(self.offsets) and self.offsets[i] == offset else -1
+
+    # Position of the last DIE that starts at or before the offset, or -1
+    def find_containing(self, offset):
+        return bisect_right(self.offsets, offset) - 1
+
+    # Offset right after the subtree of the DIE at the offset, or None if not a DIE
+    def subtree_end(self, offset):
+        i = self.find(offset)
+        return self.ends[i] if i >= 0 else None
+
+    # Parses the DIE at the position, and its ancestor chain if not yet,
+    # so that get_parent() works without searching
+    def get_DIE(self, i):
+        cu = self.cu
+        die = d = cu._get_cached_DIE(self.offsets[i])
+        # Link up the ancestors, until one that's already linked
+        while d._parent is None and self.parents[i] != NO_PARENT:
+            parent_offset = self.parents[i]
+            parent = cu._get_cached_DIE(parent_offset)
+            d.set_parent(parent)
+            d = parent
+            i = self.find(parent_offset)
+        return die
+
+# Goes through the DIEs in the CU without parsing them
+def _scan_cu(cu):
+    di = cu.dwarfinfo
+    address_size = cu['address_size']
+    offset_size = 8 if cu.structs.dwarf_format == 64 else 4
+    version = cu['version']
+    byteorder = 'little' if cu.structs.little_endian else 'big'
+    abbrevs = cu.get_abbrev_table()
+    plans = dict() # By abbrev code: (has_children, plan)
+
+    offsets = array('Q')
+    parents = array('Q')
+    ends = array('Q')
+    stack = [] # Positions of the DIEs whose children we're in
+    parent_offset = NO_PARENT
+
+    stm = di.debug_info_sec.stream
+    buf = stm.getbuffer() # Works for both BytesIO and MappedStream
+    try:
+        pos = cu.cu_die_offset
+        end = cu.cu_offset + cu.size
+        while pos < end:
+            die_offset = pos
+
+            # Abbrev code, ULEB128 - one byte is by far the most common case
+            b = buf[pos]
+            pos += 1
+            code = b & 0x7f
+            shift = 7
+            while b & 0x80:
+                b = buf[pos]
+                pos += 1
+                code |= (b & 0x7f) << shift
+                shift += 7
+
+            if code == 0: # Null DIE, ends the current child list
+                if stack:
+                    ends[stack.pop()] = pos
+                    parent_offset = offsets[stack[-1]] if stack else NO_PARENT
+                continue
+
+            if code in plans:
+                (has_children, plan) = plans[code]
+            else:
+                abbrev = abbrevs.get_abbrev(code)
+                has_children = abbrev.has_children()
+                plan = _make_plan(abbrev, address_size, offset_size, version)
+                plans[code] = (has_children, plan)
+
+            offsets.append(die_offset)
+            parents.append(parent_offset)
+
+            if isinstance(plan, int):
+                pos += plan
+            else:
+                for item in plan:
+                    if item >= 0:
+                        pos += item
+                    else:
+                        pos = skip_value(buf, pos, item, byteorder, address_size, offset_size, version)
+
+            if has_children:
+                stack.append(len(ends))
+                ends.append(end) # Until we see the terminator
+                parent_offset = die_offset
+            else:
+                ends.append(pos)
+    finally:
+        del buf
+    return DIEIndex(cu, offsets, parents, ends)
+
+def read_uleb(buf, pos):
+    v = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        v |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return v, pos
+
+# Returns the position after the value
+def skip_value(buf, pos, kind, byteorder, address_size, offset_size, version):
+    if kind == _LEB:
+        while buf[pos] & 0x80:
+            pos += 1
+        return pos + 1
+    elif kind == _STRING:
+        while buf[pos]:
+            pos += 1
+        return pos + 1
+    elif kind == _BLOCK1:
+        return pos + 1 + buf[pos]
+    elif kind == _BLOCK2:
+        return pos + 2 + int.from_bytes(buf[pos:pos+2], byteorder)
+    elif kind == _BLOCK4:
+        return pos + 4 + int.from_bytes(buf[pos:pos+4], byteorder)
+    elif kind == _BLOCKLEB:
+        (length, pos) = read_uleb(buf, pos)
+        return pos + length
+    else: # _INDIRECT, the form follows
+        (form, pos) = read_uleb(buf, pos)
+        if form not in _form_names:
+            raise UnsupportedFormError(form)
+        size = form_size(_form_names[form], address_size, offset_size, version)
+        if size >= 0:
+            return pos + size
+        return skip_value(buf, pos, size, byteorder, address_size, offset_size, version)
+
+# Returns the DIE index of the CU, building it on the first use
+# None if not available - DWARF v1, or something that the scanner can't handle
+def get_die_index(cu):
+    index = getattr(cu, '_dieindex', None)
+    if index is None:
+        index = False
+        cache = getattr(cu.dwarfinfo, '_indexcache', None)
+        if cache:
+            index = cache.load_die_index(cu) or False
+        if not index:
+            index = scan_die_index(cu) or False
+        cu._dieindex = index
+    return index or None
+
+# Builds the DIE index of the CU from scratch, None if not possible
+# Doesn't use the DIE cache or the section stream - OK to call off the UI thread,
+# as long as the CU's abbreviation table has been loaded
+def scan_die_index(cu):
+    if cu['version'] >= 2:
+        try:
+            return _scan_cu(cu)
+        except (UnsupportedFormError, KeyError, IndexError, AttributeError):
+            pass # Fall back to parsing
+    return None
+
+# Returns the DIE at the offset, or None if there isn't one
+# If not exact, returns the last DIE that starts at or before the offset
+def find_DIE(cu, offset, exact = True):
+    index = get_die_index(cu)
+    if index:
+        i = index.find(offset) if exact else index.find_containing(offset)
+        return index.get_DIE(i) if i >= 0 else None
+
+    # No index, parse the whole CU.
+    for _ in cu.iter_DIEs():
+        pass
+    # Abusing the structure of the per-CU DIE cache of pyelftools, it's the same in DWARFv1
+    with cache_lock:
+        i = bisect_right(cu._diemap, offset) - 1
+        if i < 0 or exact and cu._diemap[i] != offset:
+            return None
+        die = cu._dielist[i]
+    return None if exact and die.is_null() else die
+
+# Same, by offset in the whole info section
+# Not generally applicable for pyelftools clients - relies on CU caching by dwex
+def find_DIE_in_info(di, offset, exact = True):
+    i = bisect_right(di._CU_offsets, offset) - 1
+    return find_DIE(di._unsorted_CUs[i], offset, exact) if i >= 0 else None
+
+# Yields the non-null DIEs of the CU from last to first
+# If before is provided, starts at the last DIE before that offset
+def iter_DIEs_back(cu, before = None):
+    index = get_die_index(cu)
+    if index:
+        i = len(index) if before is None else bisect_left(index.offsets, before)
+        while i > 0:
+            i -= 1
+            yield index.get_DIE(i)
+    else:
+        for _ in cu.iter_DIEs(): # Fill the DIE cache
+            pass
+        with cache_lock:
+            i = len(cu._diemap) if before is None else bisect_left(cu._diemap, before)
+            dies = cu._dielist[:i]
+        for die in reversed(dies):
+            if not die.is_null():
+                yield die
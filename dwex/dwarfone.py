@@ -12,6 +12,9 @@ from elftools.construct import CString
 from elftools.dwarf.lineprogram import LineProgramEntry, LineState
 from elftools.dwarf.dwarf_expr import DWARFExprOp
 
+from .formats import SharedStream
+from .diecache import cache_lock
+
 LineTableHeader = namedtuple('LineTableHeader', 'version file_entry')
 CUv1Header = namedtuple('CUv1Header', 'version unit_length debug_abbrev_offset address_size')
 
@@ -126,13 +129,14 @@ class CompileUnitV1(object):
 
     # Caches
     def DIE_at_offset(self, offset):
-        i = bisect_left(self._diemap, offset)
-        if i < len(self._diemap) and offset == self._diemap[i]:
-            die = self._dielist[i]
-        else:
-            die = self.dwarfinfo.DIE_at_offset(offset, self)
-            self._dielist.insert(i, die)
-            self._diemap.insert(i, offset)
+        with cache_lock:
+            i = bisect_left(self._diemap, offset)
+            if i < len(self._diemap) and offset == self._diemap[i]:
+                die = self._dielist[i]
+            else:
+                die = self.dwarfinfo.DIE_at_offset(offset, self)
+                self._dielist.insert(i, die)
+                self._diemap.insert(i, offset)
         return die
 
     # pyelftools' iter_DIEs sets parent on discovered DIEs, we should too
@@ -308,11 +312,11 @@ class DWARFInfoV1(object):
         section_data = section.data()
         # TODO: relocation? Compression?
         self.section_size = len(section_data)
-        self.stm = BytesIO(section_data)
+        self.stm = SharedStream(section_data)
 
         lsection = elffile.get_section_by_name(".line")
         if lsection:
-            self.linestream = BytesIO(lsection.data())
+            self.linestream = SharedStream(lsection.data())
         # Sections .debug_pubnames, .debug_aranges also in the spec -
         # those are indices into info, we ignore them
 
@@ -1,10 +1,13 @@
 from bisect import bisect_left
+from collections import OrderedDict
 from elftools.dwarf.ranges import BaseAddressEntry as RangeBaseAddressEntry, RangeEntry
 from elftools.dwarf.locationlists import LocationExpr
 from elftools.dwarf.dwarf_expr import DWARFExprParser
 from elftools.dwarf.callframe import FDE
 
 from dwex.dwarfone import DWARFExprParserV1
+from dwex.cfi import LazyCFI, FrameEntries
+from dwex.machounwind import MachoUnwindInfo
 
 class NoBaseError(Exception):
     pass
@@ -78,35 +81,141 @@ def get_die_ranges(die):
         return None
     return di._ranges.get_range_list_at_offset(die.attributes['DW_AT_ranges'].value, cu=die.cu)
 
+MAX_DECODED_FDES = 256 # Decoded call frame tables kept by FDEIndex
+
+# The FDEs of eh_frame and debug_frame, sorted by the start address, for lookups by address or by range.
+# Lookups used to filter every FDE in the binary. FDEs may overlap - the same function can be covered
+# by both sections - so the ends are tracked as a running maximum, and the results come back
+# in the order of get_di_frames().
+# Built from the FDE headers only, the FDEs proper are parsed when found. Also a sequence of the FDEs
+# in the address order, for the Frames dialog.
+# The decoded call frame tables are cached here, up to MAX_DECODED_FDES, least recently used out.
+# pyelftools' own get_decoded() keeps them in the FDE for as long as the FDE is around.
+class FDEIndex(object):
+    # frames is a FrameEntries
+    def __init__(self, frames):
+        self.frames = frames
+        self.eh_count = frames.eh_count
+        self.has_cfi = frames.has_cfi
+        fdes = sorted((start, pos, start + length) for (pos, start, length) in frames.fde_ranges())
+        self.starts = [start for (start, pos, end) in fdes]
+        self.positions = [pos for (start, pos, end) in fdes] # In get_di_frames()
+        self.ends = [end for (start, pos, end) in fdes]
+        self.max_ends = [] # Max of ends up to and including the FDE
+        max_end = 0
+        for end in self.ends:
+            max_end = max(max_end, end)
+            self.max_ends.append(max_end)
+        self.tables = OrderedDict() # FDE to decoded table
+
+    # Positions in the sorted list of the FDEs that intersect [low, high)
+    def _overlapping(self, low, high):
+        i = bisect_left(self.starts, high) - 1
+        while i >= 0 and self.max_ends[i] > low:
+            if self.ends[i] > low:
+                yield i
+            i -= 1
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        return self.frames[self.positions[i]]
+
+    # FDEs that intersect any of the [low, high) ranges, in the order of get_di_frames()
+    def overlapping(self, ranges):
+        found = set(self.positions[i] for (low, high) in ranges for i in self._overlapping(low, high))
+        return [self.frames[pos] for pos in sorted(found)]
+
+    # The FDE that covers the address, or None. From debug_frame if there's one, from eh_frame otherwise.
+    def fde_at(self, address):
+        found = [self.positions[i] for i in self._overlapping(address, address + 1)]
+        found = [pos for pos in found if (pos >= self.eh_count) == self.has_cfi]
+        return self.frames[min(found)] if found else None
+
+    # Same as fde.get_decoded(), without keeping the table in the FDE forever
+    def decoded(self, fde):
+        tables = self.tables
+        table = tables.get(fde)
+        if table is None:
+            table = tables[fde] = fde._decoded_table if fde._decoded_table is not None else fde._decode_CFI_table()
+            if len(tables) > MAX_DECODED_FDES:
+                tables.popitem(False)
+        else:
+            tables.move_to_end(fde)
+        return table
+
+# The caches and the CU list that dwex keeps on the DWARFInfo, and on its CUs.
+# Shared by the UI (TheWindow.load_dwarfinfo, which adds its own) and the symbolizer.
+# Everything that is loaded on first use starts as None.
+def decorate_dwarfinfo(di):
+    di._ranges = None
+    di._aranges = None
+    di._frames = None # False means missing
+    di._funcs = None # Function map, see funclist
+    di._strindex = None
+    di._cu_names = None # In the order of _unsorted_CUs
+    di._cuaddrindex = None
+    di._locparser = None # But see #1683
+    di._indexcache = None
+    def decorate_cu(cu, i):
+        cu._i = i
+        cu._lineprogram = None
+        cu._linetable = None # Compiled from the line program on first use, False if none
+        cu._exprparser = None
+        cu._dieindex = None # Built on first random access, False if not possible
+        cu._addrindex = None # Built on first lookup by address
+        return cu
+    di._unsorted_CUs = [decorate_cu(cu, i) for (i, cu) in enumerate(di.iter_CUs())]
+    # For quick CU search by offset within the info section, regardless of sorting
+    di._CU_offsets = [cu.cu_offset for cu in di._unsorted_CUs]
+    di._CUs = list(di._unsorted_CUs)
+    return di
+
 # Doesn't return None, returns False if not found
+# Returns a FrameEntries - the entries of eh_frame, then debug_frame, parsed on access
 def get_di_frames(di):
     if di._frames is None:
-        has_cfi = di.has_CFI()
-        if di.has_EH_CFI():
-            if has_cfi:
-                di._frames = di.EH_CFI_entries() + di.CFI_entries()
-            else:
-                di._frames = di.EH_CFI_entries()
-        elif has_cfi:
-            di._frames = di.CFI_entries()
-        else:
+        eh = LazyCFI(di, di.eh_frame_sec, True) if di.has_EH_CFI() else None
+        cfi = LazyCFI(di, di.debug_frame_sec, False) if di.has_CFI() else None
+        if eh is None and cfi is None:
             di._frames = False
+        else:
+            di._frames = FrameEntries(eh, cfi)
+            di._fdeindex = None # Built on first use
     return di._frames
 
+# The FDEIndex, or None if there are no frames
+def get_fde_index(di):
+    if not get_di_frames(di):
+        return None
+    if di._fdeindex is None:
+        di._fdeindex = FDEIndex(di._frames)
+    return di._fdeindex
+
+# The MachoUnwindInfo for a Mach-O binary with an __unwind_info section, made on first use
+# Shared by the unwind info dialog and the unwinder. Raises NotImplementedError on 32-bit ARM.
+def get_unwind_info(di):
+    if getattr(di, '_unwind_info', None) is None:
+        text = getattr(di, '_text_sec', None)
+        text_section = (text, di._text_section_start - di._start_address) if text is not None else None
+        di._unwind_info = MachoUnwindInfo(di._unwind_sec, di._arch_code[0], text_section = text_section)
+    return di._unwind_info
+
 def get_frame_rules_for_die(die):
     """
        Returns a list of dictionaries with 'pc', 'cfa' and other registers, as found in DecodedCallFrameTable.table
        for the FDE entries that overlap with the range or ranges of the provided DIE.
     """
-    frames = get_di_frames(die.dwarfinfo)
-    if not frames:
+    index = get_fde_index(die.dwarfinfo)
+    if not index:
         return None
     try:
         code_loc = get_code_location(die)
     except NoBaseError:
         return None
-    entries = [f for f in frames if isinstance(f, FDE) and code_loc.intersects_fde(f)]
-    return [de for e in entries for de in e.get_decoded().table]    
+    ranges = code_loc.ranges if isinstance(code_loc, CodeLocationRanges) else ((code_loc.low, code_loc.hi),)
+    return [de for e in index.overlapping(ranges) for de in index.decoded(e).table]
 
 def is_inline(func):
     return 'DW_AT_inline' in func.attributes and func.attributes['DW_AT_inline'].value != 0
@@ -149,6 +258,17 @@ def top_die_file_name(die, Default = 'N/A'):
     return Default
 
  # See #1742
+# s is lowercase. Matches the attribute names and forms too, not just the values.
+def die_has_text(die, s):
+    for k in die.attributes.keys():
+        attr = die.attributes[k]
+        v = attr.value
+        f = attr.form
+        all = "\n".join((str(v), str(k), f, hex(v) if isinstance(v, int) else '')).lower()
+        if all.find(s) >= 0:
+            return True
+    return False
+
 def DIE_has_name(die):
     """DIE object has a name attribute and the name is bytes or compatible
     """
@@ -201,7 +321,10 @@ def find_cu_by_address(di, address):
             cu = di._unsorted_CUs[bisect_left(di._CU_offsets, cuoffset)]
             if cu.cu_offset == cuoffset:
                 return cu
-    return next((cu for cu in di._unsorted_CUs if ip_in_range(cu.get_top_DIE(), address)), None)
+    from .addrindex import get_cu_address_index
+    index = get_cu_address_index(di)
+    i = index.innermost(address)
+    return di._unsorted_CUs[bisect_left(di._CU_offsets, index.offsets[i])] if i >= 0 else None
 
 # May return None or raise NoBaseError
 def get_cu_base(die):
@@ -227,38 +350,21 @@ def get_cu_base(die):
         raise NoBaseError()
 
 # Returns a list of DIEs objects for top level functions that contain the address
-# Inlines analyzed later
-# TODO: namespaces
+# Inlines analyzed later. Nested functions are left out. More than one if the functions overlap.
 def find_funcs_at_address(cu, address):
-    funcs = []
-    top_die = cu.get_top_DIE()
-    di = cu.dwarfinfo
-    first_die = next(top_die.iter_children())
-    if first_die is None:
-        return []
-        
-    has_siblings = "DW_AT_sibling" in first_die.attributes 
-    if has_siblings:
-        die_list = (die for die in cu.iter_DIE_children(top_die))
-    else:
-        die_list = (die for die in cu.iter_DIEs())
-
-    for die in die_list:
-        if die.tag in ('DW_TAG_subprogram', 'DW_TAG_global_subroutine') and has_code_location(die):
-            if 'DW_AT_range' in die.attributes:
-                cu_base = top_die.attributes['DW_AT_low_pc'].value
-                rl = di._ranges.get_range_list_at_offset(die.attributes['DW_AT_ranges'].value, cu = die.cu)
-                for r in rl:
-                    if r.begin_offset <= address - cu_base < r.end_offset:
-                        funcs.append(die)
-            else:
-                l = die.attributes['DW_AT_low_pc'].value
-                h = die.attributes['DW_AT_high_pc'].value
-                if not die.attributes['DW_AT_high_pc'].form == 'DW_FORM_addr':
-                    h += l
-                if address >= l and address < h:
-                    funcs.append(die)
-    return funcs
+    from .addrindex import get_address_index, NO_ENTRY
+    from .dieindex import find_DIE
+    index = get_address_index(cu)
+    funcs = dict() # Index entry to DIE
+    for i in sorted(index.chain(address)): # In the DIE order, a nested function comes after its parent
+        die = find_DIE(cu, index.offsets[i])
+        if die.tag in ('DW_TAG_subprogram', 'DW_TAG_global_subroutine'):
+            p = index.parents[i]
+            while p != NO_ENTRY and p not in funcs:
+                p = index.parents[p]
+            if p == NO_ENTRY:
+                funcs[i] = die
+    return list(funcs.values())
 
 # Find helper:
 # Returns true if the specified IP is in [low_pc, high_pc)
@@ -291,6 +397,30 @@ def ip_in_range(die, ip):
             return True
     return False
 
+# The function at the address and the inlines in it, innermost first, as (die, file, line).
+# For the innermost one, that's the source line of the address, for the rest, where the next one was inlined.
+# file is the number in the CU's line table, see LineTable.file_name(). None if not known.
+# Same as LocalsDlg.on_check, minus the locals. Empty if no function there.
+def get_inline_frames(cu, address):
+    from .addrindex import find_DIEs_at_address
+    from .linetable import get_line_table
+    dies = find_DIEs_at_address(cu, address) # Outermost first
+    i = next((i for (i, die) in enumerate(dies) if die.tag in ('DW_TAG_subprogram', 'DW_TAG_global_subroutine')), None)
+    if i is None:
+        return []
+    chain = [dies[i]] + [die for die in dies[i+1:] if die.tag == 'DW_TAG_inlined_subroutine']
+    lt = get_line_table(cu)
+    row = lt.find(address) if lt is not None else -1
+    (file, line) = (lt.files[row], lt.lines[row]) if row >= 0 else (None, None)
+    frames = []
+    for die in reversed(chain):
+        frames.append((die, file, line))
+        if die.tag == 'DW_TAG_inlined_subroutine':
+            attr = die.attributes
+            file = attr['DW_AT_call_file'].value if 'DW_AT_call_file' in attr else None
+            line = attr['DW_AT_call_line'].value if 'DW_AT_call_line' in attr else None
+    return frames
+
 # returns (origin, spec)
 def follow_function_spec(func_die):
     origin = func_die.get_DIE_from_attribute('DW_AT_abstract_origin') if 'DW_AT_abstract_origin' in func_die.attributes else func_die
@@ -300,31 +430,14 @@ def follow_function_spec(func_die):
 # Line program navigation - A2L core
 # DWEX aware caching
 def get_source_line(die, address):
-    cu = die.cu
-    if cu._lineprogram is None:
-        cu._lineprogram = die.dwarfinfo.line_program_for_CU(cu)
-    lp = cu._lineprogram
-    v5 = cu.header.version >= 5
-    file_and_line = None
-    prevstate = None
-    for entry in lp.get_entries():
-        state = entry.state
-        # We're interested in those entries where a new state is assigned
-        if state is None:
-            continue
-
-        # Looking for a range of addresses in two consecutive states that
-        # contain the required address.
-        if prevstate and prevstate.address <= address < state.address and not file_and_line:
-            file = (die.cu.get_top_DIE().attributes['DW_AT_name'].value if not v5 and prevstate.file == 0 else lp['file_entry'][prevstate.file + (0 if v5 else -1)].name).decode('UTF-8')
-            line = prevstate.line
-            file_and_line = (file, line)
-
-        if state.end_sequence:
-            prevstate = None
-        else:
-            prevstate = state
-    return file_and_line
+    from .linetable import get_line_table
+    lt = get_line_table(die.cu)
+    row = lt.find(address) if lt is not None else -1
+    if row < 0:
+        return None
+    file = lt.files[row]
+    name = lt.file_name(file, None if file else die.cu.get_top_DIE().attributes['DW_AT_name'].value)
+    return (name.decode('UTF-8'), lt.lines[row]) if name is not None else None
 
 # Resolves source file number in an attribute to a file name
 # None if no such attribute or no such file
@@ -509,7 +622,11 @@ def get_class_spec_if_member(func_spec, the_func):
 # For now, local datatype is not returned
 # location is a list of parsed DWARF operations or an empty list
 # if the var has no matching location record for the given address
-def scan_scope(scope, address):
+# covering is the offsets of the DIEs in the CU that cover the address
+def scan_scope(scope, address, covering = None):
+    if covering is None:
+        from .addrindex import get_address_index
+        covering = set(get_address_index(scope.cu).offsets_at(address))
     locals = []
     next_scope = None
     if 'DW_AT_frame_base' in scope.attributes:
@@ -520,10 +637,10 @@ def scan_scope(scope, address):
         if die.tag == 'DW_TAG_variable' or die.tag == 'DW_TAG_formal_parameter':
             (k, v) = resolve_local(die, address)
             locals.append((k, v, die))
-        elif die.tag == 'DW_TAG_lexical_block' and ip_in_range(die, address):
-            (block_locals, next_scope) = scan_scope(die, address)
+        elif die.tag == 'DW_TAG_lexical_block' and die.offset in covering:
+            (block_locals, next_scope) = scan_scope(die, address, covering)
             locals += block_locals
-        elif die.tag ==  'DW_TAG_inlined_subroutine' and ip_in_range(die, address):
+        elif die.tag ==  'DW_TAG_inlined_subroutine' and die.offset in covering:
             next_scope = die
     return (locals, next_scope)
 
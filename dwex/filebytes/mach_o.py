@@ -558,8 +558,9 @@ class TwoLevelHintData(Container):
 
 class MachO(Binary):
 
-    def __init__(self, fileName, fileContent=None):
+    def __init__(self, fileName, fileContent=None, parse_header_only=False):
         super(MachO, self).__init__(fileName, fileContent)
+        self.__parse_header_only = parse_header_only
 
         self.__fatArches = self._tryParseFat(self._bytes)
         if self.__fatArches:
@@ -667,7 +668,7 @@ class MachO(Binary):
                 command = self.__parseSegmentCommand(data, offset, raw)
             elif command.cmd == LC.UUID:
                 command = self.__parseUuidCommand(data, offset, raw)
-            elif command.cmd == LC.TWOLEVEL_HINTS:
+            elif command.cmd == LC.TWOLEVEL_HINTS and not self.__parse_header_only:
                 command = self.__parseTwoLevelHintCommand(data, offset, raw)
             elif command.cmd in (LC.ID_DYLIB, LC.LOAD_DYLIB, LC.LOAD_WEAK_DYLIB):
                 command = self.__parseDylibCommand(data, offset, raw)
@@ -725,7 +726,7 @@ class MachO(Binary):
             else:
                 offset += sizeof(self._classes.Section)
 
-            if sec.offset > 0:
+            if sec.offset > 0 and not self.__parse_header_only:
                 raw = (c_ubyte * sec.size).from_buffer(data, sec.offset)
                 bytes = bytearray(raw)
             else:
@@ -738,7 +739,7 @@ class MachO(Binary):
     @classmethod
     def isSupportedContent(cls, fileContent):
         """Returns if the files are valid for this filetype"""
-        magic = bytearray(fileContent)[:4]
+        magic = bytearray(fileContent[:4])
         magics = (
             p('>I', 0xfeedface),
             p('>I', 0xfeedfacf),
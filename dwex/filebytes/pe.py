@@ -723,4 +723,4 @@ class PE(Binary):
     @classmethod
     def isSupportedContent(cls, fileContent):
         """Returns if the files are valid for this filetype"""
-        return bytearray(fileContent)[:2] == b'MZ'
+        return bytearray(fileContent[:2]) == b'MZ'
@@ -1,9 +1,9 @@
 from collections import namedtuple
-import io, os
+import io, os, mmap, threading
 from os import path, listdir
 from elftools.dwarf.dwarfinfo import DWARFInfo, DebugSectionDescriptor, DwarfConfig
-
-from .fx import wait_with_events
+from elftools.elf.elffile import ELFFile
+from elftools.elf.relocation import RelocationHandler
 
 # This doesn't depend on Qt
 # The dependency on filebytes only lives here
@@ -13,19 +13,145 @@ class FormatError(Exception):
     def __init__(self, s):
         Exception.__init__(self, s)
 
+# Read-only stream over a buffer - normally a slice of a memory mapped file.
+# Looks enough like a BytesIO for pyelftools, and getbuffer() doesn't copy.
+class MappedStream(object):
+    def __init__(self, buf):
+        self._buf = memoryview(buf)
+        self._size = len(self._buf)
+        self._pos = 0
+
+    def read(self, size=-1):
+        pos = self._pos
+        end = self._size if size is None or size < 0 else min(pos + size, self._size)
+        if end <= pos:
+            return b''
+        self._pos = end
+        return self._buf[pos:end].tobytes()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % (offset,))
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    def getbuffer(self):
+        return self._buf
+
+    # A stream over a subrange, with its own position
+    def view(self, offset, size):
+        return MappedStream(self._buf[offset:offset+size])
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def close(self):
+        pass
+
+# Stream over the same bytes for every thread, but with a separate position in each.
+# pyelftools parses by seek() and read() on the section streams, so a background thread
+# that parses DIEs (function map, find, prefetch) would move the UI thread's position
+# from under it. threading.local runs __init__ again, with the same arguments,
+# in every thread that touches the object, so each thread gets its own BytesIO/MappedStream
+# over the shared data, and the methods are bound straight to that - no extra layer per read.
+# BytesIO doesn't copy the bytes that it's constructed on until written to, and it never is.
+class SharedStream(threading.local):
+    # data is bytes or a memoryview
+    def __init__(self, data):
+        stream = io.BytesIO(data) if isinstance(data, bytes) else MappedStream(data)
+        self.read = stream.read
+        self.readinto = stream.readinto
+        self.seek = stream.seek
+        self.tell = stream.tell
+        self._data = data
+
+    # Read-only, unlike the one of BytesIO; shared between threads
+    def getbuffer(self):
+        return memoryview(self._data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def close(self):
+        pass
+
+# Same section, over a SharedStream
+def share_section(section):
+    if section is None or isinstance(section.stream, SharedStream):
+        return section
+    stream = section.stream
+    if isinstance(stream, io.BytesIO):
+        data = stream.getvalue() # Doesn't copy if the BytesIO was constructed on bytes
+    elif isinstance(stream, MappedStream):
+        data = stream.getbuffer()
+    else:
+        stream.seek(0)
+        data = stream.read()
+    return section._replace(stream=SharedStream(data))
+
+# Puts all the DWARF sections over per thread streams
+# Call before parsing anything - the DIEs and the CUs hold on to the section streams
+def share_streams(di):
+    for (name, section) in vars(di).items():
+        if isinstance(section, DebugSectionDescriptor):
+            setattr(di, name, share_section(section))
+
+def map_file(file):
+    """ Maps the whole file read-only. The mapping outlives the file object.
+        Returns a memoryview, slices of which don't copy.
+    """
+    return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
 def decorate_di(di, f, a, sa):
     di._format = f
     di._arch_code = a
     di._start_address = sa
     di._frames = None
     di._use_siblings = not(f in (0, 4) and a in ("EM_PPC", 'EM_PPC64'))
+    share_streams(di)
+    if getattr(di, 'supplementary_dwarfinfo', None):
+        share_streams(di.supplementary_dwarfinfo)
 
-def read_pe(filename):
+def read_pe(filename, mapped = False):
     from .filebytes.pe import PE, IMAGE_FILE_MACHINE, BinaryError
     import struct, zlib
 
     try:
-        pefile = PE(filename)
+        if mapped:
+            # filebytes wants a writable buffer for ctypes' from_buffer. Copy on write pages
+            # are never written to, so they don't take up memory.
+            from ctypes import c_ubyte
+            with open(filename, 'rb') as file:
+                mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+            pefile = PE(filename, (c_ubyte * len(mm)).from_buffer(mm), True)
+            image = memoryview(mm)
+        else:
+            pefile = PE(filename)
+            image = None
 
         # Section's real size might be padded - see https://github.com/sashs/filebytes/issues/28
         sections = [(section.name if section.name[1] != 'z' else '.' + section.name[2:],
@@ -37,8 +163,14 @@ def read_pe(filename):
             if section.name.startswith('.debug') or section.name.startswith('.zdebug')]
         
         def read_section(name, is_compressed, section, virtual_size, raw_size):
-            data = section.bytes
             size = raw_size if virtual_size == 0 else min((raw_size, virtual_size))
+            if image is not None:
+                data = image[section.header.PointerToRawData:section.header.PointerToRawData + raw_size]
+                if not is_compressed:
+                    return DebugSectionDescriptor(MappedStream(data[:size]), name, None, size, 0)
+                data = data.tobytes()
+            else:
+                data = section.bytes
             if is_compressed:
                 if size < 12:
                     raise FormatError("Compressesed section %s is unexpectedly short." % (name,))
@@ -147,7 +279,9 @@ def parse_fat_header(file):
 # the desired index/multiindex, or None if the user has cancelled
 # file read position should be past the fat signature
 # filename is a real file name, not bundle 
-def read_fat_macho(file, resolve_arch):
+# mapped is the memoryview of the whole file, or None
+# find_dsym is for get_macho_dwarf()
+def read_fat_macho(file, resolve_arch, mapped = None, find_dsym = True):
     arches = parse_fat_header(file)
     # Fat executable binary or fat static lib?
     slice_names = list()
@@ -186,18 +320,25 @@ def read_fat_macho(file, resolve_arch):
         size = slice.size
         format = 1 # Plain Mach-O or slice inside fat
 
-    file.seek(offset)
-    data = file.read(size) # TODO: avoid copying? Hand-parse MachO maybe
-    macho = open_macho('', data)
-    di = get_macho_dwarf(macho, slice_code)
+    if mapped is not None:
+        image = mapped[offset:offset+size]
+        macho = open_mapped_macho(image)
+    else:
+        file.seek(offset)
+        data = file.read(size)
+        macho = open_macho('', data)
+        image = None
+    di = get_macho_dwarf(macho, slice_code, image, find_dsym)
     if di:
         di._format = format
     return di
 
 # Only used for nonfat, standalone macho files.    
-def read_macho(filename):
+def read_macho(filename, mapped = None, find_dsym = True):
+    if mapped is not None:
+        return get_macho_dwarf(open_mapped_macho(mapped), None, mapped, find_dsym)
     macho = open_macho(filename) # Not fat - checked upstack
-    return get_macho_dwarf(macho, None)
+    return get_macho_dwarf(macho, None, None, find_dsym)
 
 # Given a filename and an arch code (type, subtype), returns dwarfinfo, if any
 # The arch code must be given. If the target is fat, it will choose the right slice.
@@ -220,6 +361,7 @@ def read_macho_with_arch(filename, slice_code, arch_code):
 def locate_dsym(uuid):
     try:
         from Foundation import NSMetadataQuery, NSPredicate
+        from .fx import wait_with_events # Keeps the rest of this module Qt free
 
         su = uuid.decode('ASCII').upper()
         su = f"{su[0:8]}-{su[8:12]}-{su[12:16]}-{su[16:20]}-{su[20:]}"
@@ -243,24 +385,40 @@ def macho_arch_code(macho):
     h = macho.machHeader.header
     return (h.cputype, h.cpusubtype)
 
-def get_macho_dwarf(macho, slice_code):
-    """Slice_code is (arch_name,) or (arch_name, file_name) or None"""
+def get_macho_dwarf(macho, slice_code, image = None, find_dsym = True):
+    """Slice_code is (arch_name,) or (arch_name, file_name) or None
+       image is the mapped Mach-O image, or None if the section contents were loaded by filebytes
+       find_dsym is False to skip the Spotlight query for the dSYM - it needs the event loop
+    """
     from .filebytes.mach_o import TypeFlags, LC, MH
     # We proceed with macho being a arch-specific file, or a slice within a fat binary
     sections = {
-        section.name: section.bytes
+        section.name: section.bytes if image is None else image[section.header.offset:section.header.offset + section.header.size]
         for cmd in macho.loadCommands
         if cmd.header.cmd in (LC.SEGMENT, LC.SEGMENT_64)
         for section in cmd.sections
         if (section.name.startswith('__debug') or section.name in ('__eh_frame', '__unwind_info')) and section.header.offset > 0
     }
 
+    eh_address = next((section.header.addr
+        for cmd in macho.loadCommands
+        if cmd.header.cmd in (LC.SEGMENT, LC.SEGMENT_64)
+        for section in cmd.sections
+        if section.name == '__eh_frame'), 0)
+
+    # The code, for the compact unwind entries that refer into it - see get_unwind_info()
+    text = next((section
+        for cmd in macho.loadCommands
+        if cmd.header.cmd in (LC.SEGMENT, LC.SEGMENT_64)
+        for section in cmd.sections
+        if section.name == '__text' and section.header.offset > 0), None)
+
     uuid_cmd = next((cmd for cmd in macho.loadCommands if cmd.header.cmd == LC.UUID), None)
     uuid = uuid_cmd.uuid if uuid_cmd else None
     # a bytes with a hex representation of the binary GUID 
 
     if not '__debug_info' in sections:
-        if macho.machHeader.header.filetype == MH.EXECUTE and uuid:
+        if macho.machHeader.header.filetype == MH.EXECUTE and uuid and find_dsym:
             # TODO: locate dSYM by UUID
             dsym_path = locate_dsym(uuid)
             if dsym_path:
@@ -270,6 +428,7 @@ def get_macho_dwarf(macho, slice_code):
                 di = read_macho_with_arch(dsym_path, macho_arch_code(macho))
                 if di:
                     add_macho_sections_from_executable(di, macho)
+                    di._dsym_path = dsym_path # The DWARF is not in the file that was opened
                     return di
             else:
                 return None
@@ -297,8 +456,10 @@ def get_macho_dwarf(macho, slice_code):
                     pass
         return None
     
+    # eh_frame gets its load address, so that the pointers in it that are relative to their own location come out right
     data = {
-        name: DebugSectionDescriptor(io.BytesIO(contents), name, None, len(contents), 0)
+        name: DebugSectionDescriptor(io.BytesIO(contents) if image is None else MappedStream(contents), name, None, len(contents),
+            eh_address if name == '__eh_frame' else 0)
         for (name, contents)
         in sections.items()
     }
@@ -336,21 +497,34 @@ def get_macho_dwarf(macho, slice_code):
     text_cmd = next((cmd for cmd in macho.loadCommands if cmd.header.cmd in (LC.SEGMENT, LC.SEGMENT_64) and cmd.name == "__TEXT"), False)
     decorate_di(di, 1, macho_arch_code(macho), text_cmd.header.vmaddr if text_cmd else 0)
     di._unwind_sec = sections.get('__unwind_info') # VERY unlikely to be None
+    if text and di._unwind_sec:
+        di._text_sec = text.bytes if image is None else image[text.header.offset:text.header.offset + text.header.size]
+        di._text_section_start = text.header.addr
     di._slice_code = slice_code
     di._uuid = uuid
     di._has_exec = False
     return di
 
-def open_macho(filename, contents=None):
+def open_macho(filename, contents=None, header_only=False):
     """ Wrapper around the filebytes' MachO constructor
         that translates filebytes' exceptions to our own
     """
     from .filebytes.mach_o import MachO, BinaryError
     try:
-        return MachO(filename, contents)
+        return MachO(filename, contents, header_only)
     except BinaryError as err:
         raise FormatError("Error parsing the binary.\n" + str(err))
 
+def open_mapped_macho(image):
+    """ Parses the header and the load commands of a mapped thin Mach-O image.
+        Section contents are not loaded - get_macho_dwarf takes them from the image.
+    """
+    magic = image[:4].tobytes()
+    big_endian = magic in (b'\xFE\xED\xFA\xCE', b'\xFE\xED\xFA\xCF')
+    is64 = magic in (b'\xFE\xED\xFA\xCF', b'\xCF\xFA\xED\xFE')
+    sizeofcmds = int.from_bytes(image[20:24], 'big' if big_endian else 'little')
+    return open_macho('', image[:(32 if is64 else 28) + sizeofcmds].tobytes(), True)
+
 # TODO: don't load the whole binary, load just the right slice
 def load_companion_executable(filename, di):
     from .filebytes.mach_o import LC, MH
@@ -400,10 +574,11 @@ def add_macho_sections_from_executable(di, macho):
 
     eh = sections.get('__eh_frame', None)
     if eh:
-        di.eh_frame_sec = DebugSectionDescriptor(io.BytesIO(eh.bytes), eh.name, None, len(eh.bytes), 0)
+        di.eh_frame_sec = share_section(DebugSectionDescriptor(io.BytesIO(eh.bytes), eh.name, None, len(eh.bytes), eh.header.addr))
         
     di._text_section_start = sections.get('__text').header.addr
     di._has_exec = True
+    di._unwind_info = None # Made again with the new sections, see get_unwind_info()
 
 def binary_from_bundle(filename):
     # Is it a dSYM bundle?
@@ -430,7 +605,7 @@ def binary_from_bundle(filename):
 
 _WASM_section_header = False
 
-def read_wasm(file):
+def read_wasm(file, mapped = None):
     global _WASM_section_header
     from elftools.common.construct_utils import ULEB128, StreamOffset
     from elftools.construct import ULInt8, ULInt32, Struct, If, PascalString, Value
@@ -459,8 +634,12 @@ def read_wasm(file):
     while file.tell() < file_size:
         sh = _WASM_section_header.parse_stream(file)
         if sh.id == 0 and sh.name.startswith(".debug"):
-            content = file.read(sh.length)
-            data[sh.name] = DebugSectionDescriptor(io.BytesIO(content), sh.name, None, sh.length, 0)
+            if mapped is not None:
+                content = MappedStream(mapped[file.tell():file.tell() + sh.length])
+                file.seek(sh.length, os.SEEK_CUR)
+            else:
+                content = io.BytesIO(file.read(sh.length))
+            data[sh.name] = DebugSectionDescriptor(content, sh.name, None, sh.length, 0)
         elif sh.id == 0 and sh.name == 'external_debug_info':
             dwarf_url = file.read(sh.length).decode('UTF-8')
         else: # Skip this section
@@ -500,12 +679,30 @@ def read_wasm(file):
     decorate_di(di, 3, None, 0)
     return di
 
+# ELFFile that hands out views of the file mapping for the DWARF sections instead of copies.
+# Compressed and relocated sections are still materialized the usual way.
+class MappedELFFile(ELFFile):
+    def _read_dwarf_section(self, section, relocate_dwarf_sections):
+        if (section.compressed or section['sh_type'] == 'SHT_NOBITS' or self.has_phantom_bytes() or
+            (relocate_dwarf_sections and RelocationHandler(self).find_relocations_for_section(section) is not None)):
+            return ELFFile._read_dwarf_section(self, section, relocate_dwarf_sections)
+        return DebugSectionDescriptor(
+                stream=self.stream.view(section['sh_offset'], section['sh_size']),
+                name=section.name,
+                global_offset=section['sh_offset'],
+                size=section.data_size,
+                address=section['sh_addr'])
+
 # Filename is only needed for supplemental DWARF resolution
-def read_elf(file, filename):
-    from elftools.elf.elffile import ELFFile
-    file.seek(0)
+# mapped is the memoryview of the ELF image, or None to read from file
+def read_elf(file, filename, mapped = None):
     # TODO: interactive supplemental DWARF resolver here...
-    elffile = ELFFile(file, lambda s: open(path.join(path.dirname(filename), s.decode('UTF-8')), 'rb'))
+    stream_loader = lambda s: open(path.join(path.dirname(filename), s.decode('UTF-8')), 'rb')
+    if mapped is not None:
+        elffile = MappedELFFile(MappedStream(mapped), stream_loader)
+    else:
+        file.seek(0)
+        elffile = ELFFile(file, stream_loader)
 
     # Retrieve the preferred loading address
     load_segment = next((seg for seg in elffile.iter_segments() if seg.header.p_type == 'PT_LOAD'), None)
@@ -519,8 +716,16 @@ def read_elf(file, filename):
 
     if di:
         decorate_di(di, 0, elffile.header.e_machine, start_address)
+        di._build_id = elf_build_id(elffile)
     return di
 
+# GNU build ID as a hex string, or None
+def elf_build_id(elffile):
+    sec = elffile.get_section_by_name('.note.gnu.build-id')
+    if sec and sec['sh_type'] == 'SHT_NOTE':
+        return next((note['n_desc'] for note in sec.iter_notes() if note['n_type'] == 'NT_GNU_BUILD_ID'), None)
+    return None
+
 ###########################################################################
 ############################ Libraries
 ###########################################################################
@@ -609,7 +814,7 @@ def scan_staticlib(file, size):
 
 # resolve_slice takes a list of files in the archive, and returns
 # the desired index, or None if the user has cancelled
-def read_staticlib(file, resolve_slice):
+def read_staticlib(file, resolve_slice, mapped = None):
     from io import BytesIO
 
     file.seek(0, os.SEEK_END)
@@ -625,19 +830,25 @@ def read_staticlib(file, resolve_slice):
         return False # Cancellation
     
     header = headers[slice]
-    file.seek(header.data_offset)
-    b = file.read(header.size)
+    if mapped is not None:
+        b = mapped[header.data_offset:header.data_offset + header.size]
+    else:
+        file.seek(header.data_offset)
+        b = file.read(header.size)
+    signature = bytes(b[:4])
     slice_code = (names[slice],)
     # We support ELF and MachO static libraries so far
-    if b[:4] == b'\x7FELF':
-        di = read_elf(BytesIO(b), None)
+    if signature == b'\x7FELF':
+        di = read_elf(BytesIO(b), None) if mapped is None else read_elf(None, None, b)
         if di:
             di._slice_code = slice_code
-    elif b[:4] in (b'\xFE\xED\xFA\xCE', b'\xFE\xED\xFA\xCF', b'\xCE\xFA\xED\xFE', b'\xCF\xFA\xED\xFE'):
-        from .filebytes.mach_o import MachO
-        macho = open_macho(None, b)
-        di = get_macho_dwarf(macho, slice_code)
-    elif b[:4] == b'\xCA\xFE\xBA\xBE':
+    elif signature in (b'\xFE\xED\xFA\xCE', b'\xFE\xED\xFA\xCF', b'\xCE\xFA\xED\xFE', b'\xCF\xFA\xED\xFE'):
+        if mapped is not None:
+            di = get_macho_dwarf(open_mapped_macho(b), slice_code, b)
+        else:
+            macho = open_macho(None, b)
+            di = get_macho_dwarf(macho, slice_code)
+    elif signature == b'\xCA\xFE\xBA\xBE':
         raise FormatError("The selected slice of the static library is a Mach-O fat binary. Those are not supported. Let the author know.")
     else:
         raise FormatError("The selected slice of the static library is not a supported object file. Let the author know.")
@@ -650,7 +861,19 @@ def read_staticlib(file, resolve_slice):
 ######################## The main entry point - file in, DWARF out
 #########################################################################
 
-def read_dwarf(filename, resolve_arch):
+# A resolve_arch for read_dwarf() that picks the slice by a previously recorded slice code
+def recall_slice(slice_code):
+    def resolve(slices, title, text):
+        if len(slice_code) == 1:
+            return slices.index(slice_code[0])
+        else: # arch is a tuple, assuming no more than two levels
+            (arch, fn) = slice_code
+            (i, a) = next(ia for ia in enumerate(slices) if ia[1][0] == arch)
+            j = a[1].index(fn)
+            return (i, j)
+    return resolve
+
+def read_dwarf(filename, resolve_arch, mapped = False, find_dsym = True):
     """ UI agnostic - resolve_arch might be interactive
         Returns slightly augmented DWARFInfo
         Or None if not a DWARF containing file (or unrecognized)
@@ -658,36 +881,41 @@ def read_dwarf(filename, resolve_arch):
         Or throws an exception
         resolve_arch is for Mach-O fat binaries - see read_macho()
         and repurposed for .a static libraries
+        If mapped is True, the file is memory mapped and the uncompressed
+        debug sections are views into the mapping rather than copies
+        If find_dsym is False, a Mach-O executable without DWARF is not matched
+        with a dSYM elsewhere - for the worker processes, see mpsearch
         Primary point of call is open_file() in main
     """
     if path.isfile(filename): # On MacOS, opening dSYM bundles as is would be right, and they are technically folders
         with open(filename, 'rb') as file:
             xsignature = file.read(8)
             signature = xsignature[:4]
+            mm = map_file(file) if mapped and len(xsignature) == 8 and xsignature[:2] != b'MZ' else None
 
             if xsignature[:2] == b'MZ': # DOS header - this might be a PE. Don't verify the PE header, just feed it to the parser
-                return read_pe(filename)
+                return read_pe(filename, mapped)
             elif signature == b'\x7FELF': #It's an ELF
-                return read_elf(file, filename)
+                return read_elf(file, filename, mm)
             elif signature in (b'\xFE\xED\xFA\xCE', b'\xFE\xED\xFA\xCF', b'\xCE\xFA\xED\xFE', b'\xCF\xFA\xED\xFE'):
                 # Mach-O 32/64-bit Mach-O in big/little-endian format, but not a fat binary
                 # TODO: little endian is not supported!
-                return read_macho(filename)
+                return read_macho(filename, mm, find_dsym)
             elif signature == b'\xCA\xFE\xBA\xBE': 
                 # Mach-O fat binary - could be executable, or a multiarch static lib.
                 if int.from_bytes(xsignature[4:8], 'big') >= 0x20:
                     # Java .class files also have CAFEBABE, check the fat binary arch count
                     return None
                 file.seek(4, os.SEEK_SET)
-                return read_fat_macho(file, resolve_arch)
+                return read_fat_macho(file, resolve_arch, mm, find_dsym)
             elif signature == b'\0asm':
-                return read_wasm(file)
+                return read_wasm(file, mm)
             elif xsignature == b'!<arch>\n':
-                return read_staticlib(file, resolve_arch)
+                return read_staticlib(file, resolve_arch, mm)
     elif path.isdir(filename):
         binary_filename = binary_from_bundle(filename)
         if binary_filename:
-            return read_dwarf(binary_filename, resolve_arch)
+            return read_dwarf(binary_filename, resolve_arch, mapped, find_dsym)
         
 def get_debug_sections(di):
     section_names = {name: "debug_%s_sec" % name
@@ -707,9 +935,9 @@ def get_debug_sections(di):
         if hasattr(di, field_name)}
 
 # Section can be a SectionDescription or a raw dump
+# Doesn't copy - the stream is a SharedStream
 def section_bytes(section):
     return section if isinstance(section, (bytes, bytearray, memoryview)) else section.stream.getbuffer()
-    # TODO: reliance on stream being a BytesIO
 
 def write_to_file(filename, data):
     with open(filename, 'wb') as f:
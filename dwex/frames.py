@@ -8,6 +8,9 @@ from .exprdlg import ExpressionDlg
 from .fx import bold_font
 from .locals import LoadedModuleDlgBase
 from .exprutil import _REG_NAME_MAP, ExprFormatter, format_offset
+from .dwarfutil import get_fde_index
+
+parse_error_message = "Error parsing the frames section in this binary. Please report to the tech support: menu/Help/Report an issue."
 
 rheaders = ('Start address', 'End address', 'Length')
 eheaders = ('Type', 'CIE offset', 'Start address', 'End address', 'Length')
@@ -15,16 +18,15 @@ eheaders = ('Type', 'CIE offset', 'Start address', 'End address', 'Length')
 # TODO: more fields in entries mode? Version, augmentation, etc? Or a properties window?
 # TODO: dump raw instructions in details?
 class EntriesModel(QAbstractTableModel):
-    def __init__(self, cfi, fdes_only, hex):
+    # entries is a FrameEntries, or an FDEIndex for the FDEs by address - parsed as the rows are shown
+    # on_error is called when an entry fails to parse, the row stays blank
+    def __init__(self, entries, fdes_only, hex, on_error):
         QAbstractTableModel.__init__(self)
         self.fdes_only = fdes_only
         self.headers = rheaders if fdes_only else eheaders
         self.hex = hex
-        if fdes_only:
-            self.entries = [e for e in cfi if isinstance(e, FDE)]
-            self.entries.sort(key=lambda e: e.header.initial_location)
-        else:
-            self.entries = cfi
+        self.entries = entries
+        self.on_error = on_error
 
     def headerData(self, section, ori, role):
         if ori == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
@@ -37,11 +39,18 @@ class EntriesModel(QAbstractTableModel):
         return len(self.headers)
     
     def index(self, row, col, parent):
-        return self.createIndex(row, col, self.entries[row])
+        try:
+            entry = self.entries[row]
+        except KeyError: # 1761
+            entry = None
+            self.on_error()
+        return self.createIndex(row, col, entry)
     
     def data(self, index, role):
         col = index.column()
         entry = index.internalPointer()
+        if entry is None:
+            return None
         header = entry.header if not isinstance(entry, ZERO) else None
         is_fde = isinstance(entry, FDE)
         if role == Qt.ItemDataRole.DisplayRole:
@@ -66,9 +75,10 @@ class EntriesModel(QAbstractTableModel):
                 return bold_font()
 
 class DecodedEntryModel(QAbstractTableModel):
-    def __init__(self, entry, regnamelist, p, f):
+    # table is the DecodedCallFrameTable of the entry
+    def __init__(self, table, regnamelist, p, f):
         QAbstractTableModel.__init__(self)
-        self.table = entry.get_decoded() # Anything else from the entry?
+        self.table = table # Anything else from the entry?
         self.regnamelist = regnamelist
         self.parser = p
         self.formatter = f
@@ -232,6 +242,7 @@ class FramesDlg(FramesUIDlg):
         dwarf_version = 2 # If no debug sections, can't tell if it's V1. Frames were not in V1.
         self.expr_parser = DWARFExprParser(di.structs)
         self.expr_formatter = ExprFormatter(regnames, False, arch, dwarf_version, True)
+        self.error_shown = False
 
         FramesUIDlg.__init__(self, win)
 
@@ -240,7 +251,23 @@ class FramesDlg(FramesUIDlg):
 
     def on_entry_sel(self, index, prev = None):
         # TODO: raw mode
-        self.details.setModel(DecodedEntryModel(index.internalPointer(), self.regnamelist, self.expr_parser, self.expr_formatter))
+        entry = index.internalPointer()
+        if entry is None or isinstance(entry, ZERO):
+            self.details.setModel(None)
+            return
+        try:
+            table = get_fde_index(self.dwarfinfo).decoded(entry)
+        except KeyError: # 1761
+            self.details.setModel(None)
+            self.on_parse_error()
+            return
+        self.details.setModel(DecodedEntryModel(table, self.regnamelist, self.expr_parser, self.expr_formatter))
+
+    # Once per dialog, the same entry comes up in every column
+    def on_parse_error(self):
+        if not self.error_shown:
+            self.error_shown = True
+            QMessageBox(QMessageBox.Icon.Warning, "DWARF Explorer", parse_error_message, QMessageBox.StandardButton.Ok, self).show()
 
     def on_rule_dclick(self, index):
         if index and index.isValid():
@@ -258,9 +285,15 @@ class FramesDlg(FramesUIDlg):
 
     def set_view(self, fdes_only):
         # TODO: change the model in place
-        self.entries.setModel(EntriesModel(self.cfi, fdes_only, self.hex))
-        self.entries.selectionModel().currentChanged.connect(self.on_entry_sel)
         self.details.setModel(None)
+        try:
+            entries = get_fde_index(self.dwarfinfo) if fdes_only else self.cfi
+        except KeyError: # 1761, the index parses the CIEs
+            self.entries.setModel(None)
+            self.on_parse_error()
+            return
+        self.entries.setModel(EntriesModel(entries, fdes_only, self.hex, self.on_parse_error))
+        self.entries.selectionModel().currentChanged.connect(self.on_entry_sel)
 
 def make_rbutton_pair(titles, on_toggle):
     bu_line = QHBoxLayout()
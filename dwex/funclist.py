@@ -0,0 +1,67 @@
+from array import array
+from heapq import merge
+
+from .dwarfutil import get_code_location, has_code_location, subprogram_name
+
+# The function map - functions with code, sorted by the start address.
+#
+# Used to be a list of (hex address, name, DIE, address) tuples, kept sorted by inserting
+# every function in place, which is quadratic on a large binary. Now the functions are
+# collected into flat arrays in the section order, and sorted once at the end.
+# Only DIE offsets are kept; the DIEs are looked up when someone navigates to one.
+# For large binaries, the CUs are split between worker processes, and the sorted
+# runs that they return are merged, see mpsearch.gather_funcs_in_CUs().
+# This doesn't depend on Qt.
+
+FUNC_TAGS = ('DW_TAG_subprogram', 'DW_TAG_global_subroutine')
+
+class FuncList(object):
+    def __init__(self, addresses, die_offsets, names):
+        self.addresses = addresses
+        self.die_offsets = die_offsets
+        self.names = names
+
+    def __len__(self):
+        return len(self.addresses)
+
+    # In the format of the old tuples, for the table and the export
+    def row(self, i):
+        address = self.addresses[i]
+        return (hex(address), self.names[i], self.die_offsets[i], address)
+
+class FuncCollector(object):
+    def __init__(self):
+        self.addresses = array('Q')
+        self.die_offsets = array('Q')
+        self.names = []
+
+    def add(self, die):
+        if die.tag in FUNC_TAGS and has_code_location(die):
+            self.addresses.append(get_code_location(die).start_address())
+            self.die_offsets.append(die.offset)
+            self.names.append(subprogram_name(die))
+
+    def add_CU(self, cu):
+        for die in cu.iter_DIEs():
+            self.add(die)
+
+    # Sorted by address, the ones at the same address stay in the section order
+    def finish(self):
+        addresses = self.addresses
+        order = sorted(range(len(addresses)), key=addresses.__getitem__)
+        return FuncList(array('Q', (addresses[i] for i in order)),
+            array('Q', (self.die_offsets[i] for i in order)),
+            [self.names[i] for i in order])
+
+# Runs are (addresses, die_offsets, names), each one sorted, in the section order of their CUs
+# The result is the same as one FuncCollector over all of them would produce
+def merge_funcs(runs):
+    addresses = array('Q')
+    die_offsets = array('Q')
+    names = []
+    # merge() is stable, so the earlier run wins the ties
+    for (address, die_offset, name) in merge(*(zip(*run) for run in runs), key=lambda f:f[0]):
+        addresses.append(address)
+        die_offsets.append(die_offset)
+        names.append(name)
+    return FuncList(addresses, die_offsets, names)
@@ -1,19 +1,22 @@
+from concurrent.futures import TimeoutError, CancelledError
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
-from bisect import bisect_left
 from PyQt6.QtWidgets import *
 
-from .details import GenericTableModel
-from .dwarfutil import get_code_location, has_code_location, subprogram_name
+from .details import PagedTableModel
+from .funclist import FuncCollector, merge_funcs
 from .locals import LoadedModuleDlgBase, WaitCursor
+from .dieindex import find_DIE_in_info
 
 # TODO: unite UI with aranges - dialog with a table and potentially a search bar
 # TODO: sorting
 
+PROGRESS_STEPS = 500 # Progress updates over the whole info section, tops
+
 class GatherFuncsThread(QThread):
     def __init__(self, parent, di):
         QThread.__init__(self, parent)
         self.cancelled = False
-        self.funcs = None
+        self.funcs = None # FuncList when done
         self.exc = None
         self.dwarfinfo = di
 
@@ -24,28 +27,64 @@ class GatherFuncsThread(QThread):
 
     def run(self):
         try:
-            funcs = []
-            for cu in self.dwarfinfo._unsorted_CUs:
+            cus = self.dwarfinfo._unsorted_CUs
+            step = max((cus[-1].cu_offset + cus[-1].size) // PROGRESS_STEPS, 1)
+            next_progress = 0
+            collector = FuncCollector()
+            for cu in cus:
                 for die in cu.iter_DIEs():
-                    self.yieldCurrentThread()
                     if self.cancelled:
                         return
-
-                    if die.tag in ('DW_TAG_subprogram', 'DW_TAG_global_subroutine') and has_code_location(die):
+                    collector.add(die)
+                    if die.offset >= next_progress: # Don't flood the UI thread with signals
                         self.progress.emit(die.offset)
-                        IP = get_code_location(die).start_address()
-                        i = bisect_left(funcs, IP, key=lambda f:f[3])
-                        funcs.insert(i, (hex(IP), subprogram_name(die), die, IP))
-            self.funcs = funcs
+                        next_progress = die.offset + step
+                        self.yieldCurrentThread()
+            self.funcs = collector.finish()
         except Exception as exc:
             self.exc = exc
 
+# Same, with the CUs spread over the worker processes of the search, see mpsearch
+# batches come from SearchPool.start_gathering_funcs(). Cancelling drops the batches that haven't started.
+class ParallelGatherFuncsThread(GatherFuncsThread):
+    def __init__(self, parent, di, batches):
+        GatherFuncsThread.__init__(self, parent, di)
+        self.batches = batches
+
+    def cancel(self):
+        GatherFuncsThread.cancel(self)
+        for (batch, future) in self.batches:
+            future.cancel()
+
+    def run(self):
+        try:
+            cus = {cu.cu_offset: cu for cu in self.dwarfinfo._unsorted_CUs}
+            runs = []
+            for (batch, future) in self.batches:
+                while True:
+                    if self.cancelled:
+                        return
+                    try:
+                        runs.append(future.result(0.1))
+                        break
+                    except TimeoutError:
+                        pass
+                    except CancelledError:
+                        return
+                last_cu = cus[batch[-1]]
+                self.progress.emit(last_cu.cu_offset + last_cu.size)
+            self.funcs = merge_funcs(runs)
+        except Exception as exc: # The workers failed, do it here
+            print("Error in the parallel function gathering: %s" % format(exc))
+            GatherFuncsThread.run(self)
+
 
 class FuncMapDlg(LoadedModuleDlgBase):
     def __init__(self, win, hex, funcs):
         LoadedModuleDlgBase.__init__(self, win)
         self.selected_die = None
-        model = GenericTableModel(("Start address", 'Function'), funcs)
+        self.funcs = funcs
+        model = PagedTableModel(("Start address", 'Function'), len(funcs), funcs.row)
 
         self.resize(500, 500)
         ly = QVBoxLayout()
@@ -78,12 +117,11 @@ class FuncMapDlg(LoadedModuleDlgBase):
         self.nav_bu.setEnabled(index.isValid())
 
     def navigate_to_index(self, index):
-        row = index.row()
-        self.selected_die = self.the_table.model().values[row][2]
+        self.selected_die = find_DIE_in_info(self.parent().dwarfinfo, self.funcs.die_offsets[index.row()])
         self.done(QDialog.DialogCode.Accepted)
 
     def export_funcs(self):
-        funcs = self.the_table.model().values
+        funcs = self.funcs
         if not funcs:
             QMessageBox.information(self, "Export Functions", "There are no functions to export.")
             return
@@ -93,8 +131,8 @@ class FuncMapDlg(LoadedModuleDlgBase):
         if path:
             try:
                 with open(path, 'w') as f:
-                    for func in funcs:
-                        f.write(f"Address: {func[0]}, Name: {func[1]}\n")
+                    for (address, name) in zip(funcs.addresses, funcs.names):
+                        f.write(f"Address: {hex(address)}, Name: {name}\n")
                 QMessageBox.information(self, "Export Successful", f"Successfully exported functions to {path}")
             except IOError as e:
                 QMessageBox.critical(self, "Export Error", f"Failed to write to file: {e}")
@@ -22,10 +22,12 @@ def fixed_font():
     return _fixed_font
 
 # TODO: cancellation, progress indication
-def wait_with_events(cond, timeout=100):
+# With user_input=False, the window repaints, but doesn't react to the user
+def wait_with_events(cond, timeout=100, user_input=True):
     loop = QEventLoop(QApplication.instance())
+    flags = QEventLoop.ProcessEventsFlag.AllEvents if user_input else QEventLoop.ProcessEventsFlag.ExcludeUserInputEvents
     while cond():
-        loop.processEvents(QEventLoop.ProcessEventsFlag.AllEvents, timeout)
+        loop.processEvents(flags, timeout)
 
 # Doesn't quite work for the delay on tree expansion :( TODO: timer checks before lighting up this
 class WaitCursor():
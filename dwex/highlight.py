@@ -0,0 +1,221 @@
+import re, time
+from array import array
+
+from .diecache import release_CU
+
+# Precomputed highlights.
+#
+# The highlight conditions used to be evaluated on every paint of every visible row,
+# and then again for every DIE on the way to the next/previous highlighted one. For the
+# condition highlight, that's an eval() in a fresh environment every time.
+#
+# Instead, once a highlight is added, its condition is evaluated once for every DIE.
+# If Find would go to the worker processes (see mpsearch), so does the highlight - ParallelHighlightScan,
+# the UI only picks up the results. Otherwise, it's CU by CU in the tree order, between the UI events
+# (see DWARFTreeModel.on_highlight_scan), and the CUs that the scan parses don't go into the DIE cache.
+# The results go into a bitset by DIE offset in the info section, a bit per byte of the section at most.
+# In the CUs that are done, checking a DIE is a bit test, and finding the next highlighted one
+# is a scan of the bitset. In the rest, the condition is evaluated the old way.
+# This doesn't depend on Qt.
+
+_nonzero = re.compile(b'[^\x00]')
+
+class HighlightBits(object):
+    def __init__(self):
+        self.bits = bytearray() # Grows up to the last highlighted DIE
+        self.done = dict() # Offsets of the CUs that were evaluated completely to the offset after their last DIE
+        self.found = dict() # CU offset to the result of offsets(), for the CUs that were asked about
+
+    def covers(self, cu):
+        return cu.cu_offset in self.done
+
+    def add(self, offset):
+        i = offset >> 3
+        if i >= len(self.bits):
+            self.bits.extend(bytes(i + 1 - len(self.bits)))
+        self.bits[i] |= 1 << (offset & 7)
+
+    def contains(self, offset):
+        i = offset >> 3
+        return i < len(self.bits) and bool(self.bits[i] & (1 << (offset & 7)))
+
+    # Offsets of the highlighted DIEs in the CU, in order - assumes the CU is covered
+    def offsets(self, cu):
+        bits = self.bits
+        start = cu.cu_offset
+        offsets = self.found.get(start)
+        if offsets is not None:
+            return offsets
+        end = self.done[start]
+        offsets = self.found[start] = array('Q')
+        for m in _nonzero.finditer(bits, start >> 3, (end + 7) >> 3):
+            pos = m.start()
+            b = bits[pos]
+            for bit in range(8):
+                if b & (1 << bit):
+                    offset = (pos << 3) + bit
+                    if start <= offset < end:
+                        offsets.append(offset)
+        return offsets
+
+class HighlightScan(object):
+    parallel = False
+
+    # cus are in the order to go through
+    def __init__(self, key, condition, bits, cus):
+        self.key = key
+        self.condition = condition
+        self.bits = bits
+        self.cus = cus
+        self.i = 0
+        self.dies = None # DIE iterator of the current CU
+        self.end = None # Past the last DIE seen in the current CU
+
+    # Returns True if there's more to do
+    def run(self, deadline):
+        bits = self.bits
+        cond = self.condition
+        while self.i < len(self.cus):
+            cu = self.cus[self.i]
+            if self.dies is None:
+                self.dies = cu.iter_DIEs()
+                self.end = cu.cu_offset
+            try:
+                for die in self.dies:
+                    if not die.is_null():
+                        if cond(die):
+                            bits.add(die.offset)
+                        self.end = max(self.end, die.offset + 1)
+                    if time.monotonic() >= deadline:
+                        return True
+                bits.done[cu.cu_offset] = self.end
+            except KeyError: # Corrupt CU, see #1516 - leave it to the slow way, it reports
+                pass
+            release_CU(cu)
+            self.dies = None
+            self.i += 1
+        return False
+
+    def cancel(self):
+        pass
+
+# Same, in the worker processes. batches come from SearchPool.start_matching().
+# The batches are picked up as they are done, in any order. The ones that fail are left to the slow way.
+class ParallelHighlightScan(object):
+    parallel = True
+
+    def __init__(self, key, bits, cus, batches):
+        self.key = key
+        self.bits = bits
+        self.ends = {cu.cu_offset: cu.cu_offset + cu.size for cu in cus}
+        self.batches = batches
+
+    # Returns True if there's more to do, doesn't wait
+    def run(self, deadline):
+        bits = self.bits
+        pending = []
+        for (batch, future) in self.batches:
+            if not future.done():
+                pending.append((batch, future))
+                continue
+            try:
+                results = future.result()
+            except Exception as exc:
+                print("Error in the parallel highlight scan: %s" % format(exc))
+                continue
+            for cu_offset in batch:
+                for offset in results[cu_offset]:
+                    bits.add(offset)
+                bits.done[cu_offset] = self.ends[cu_offset]
+        self.batches = pending
+        return bool(pending)
+
+    def cancel(self):
+        for (batch, future) in self.batches:
+            future.cancel()
+
+class Highlights(object):
+    def __init__(self):
+        self.conditions = dict() # Key to condition function
+        self.bits = dict() # Key to HighlightBits
+        self.scans = [] # HighlightScans in progress
+        self.merged = dict() # CU offset to candidates(), with more than one highlight
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def __contains__(self, key):
+        return key in self.conditions
+
+    def keys(self):
+        return self.conditions.keys()
+
+    # batches, if any, are the parallel scan of the condition, see ParallelHighlightScan
+    def add(self, key, condition, cus, batches = None):
+        self.remove(key)
+        bits = HighlightBits()
+        self.conditions[key] = condition
+        self.bits[key] = bits
+        self.merged = dict()
+        if batches is not None:
+            self.scans.append(ParallelHighlightScan(key, bits, cus, batches))
+        else:
+            self.scans.append(HighlightScan(key, condition, bits, cus))
+
+    def remove(self, key):
+        if key in self.conditions:
+            del self.conditions[key]
+            del self.bits[key]
+            self.merged = dict()
+            for scan in self.scans:
+                if scan.key == key:
+                    scan.cancel()
+            self.scans = [scan for scan in self.scans if scan.key != key]
+
+    def cancel(self):
+        for scan in self.scans:
+            scan.cancel()
+        self.scans = []
+
+    # Returns True if there's more to do
+    def scan(self, deadline):
+        for scan in list(self.scans):
+            if not scan.run(deadline):
+                self.scans.remove(scan)
+            elif not scan.parallel: # Out of time
+                return True
+        return bool(self.scans)
+
+    # True if the scans that are left are all in the worker processes
+    def waiting(self):
+        return all(scan.parallel for scan in self.scans)
+
+    def is_highlighted(self, die):
+        return self.is_offset_highlighted(die.cu, die.offset, lambda: die)
+
+    # Same by offset - get_die is called for the DIE, only if some condition is not evaluated in the CU yet
+    def is_offset_highlighted(self, cu, offset, get_die):
+        die = None
+        for (key, cond) in self.conditions.items():
+            bits = self.bits[key]
+            if bits.covers(cu):
+                if bits.contains(offset):
+                    return True
+            else:
+                if die is None:
+                    die = get_die()
+                if cond(die):
+                    return True
+        return False
+
+    # Offsets of the highlighted DIEs in the CU, in order, or None if not known yet
+    # For DWARFTreeModel.find()
+    def candidates(self, cu):
+        if not self.bits or not all(bits.covers(cu) for bits in self.bits.values()):
+            return None
+        if len(self.bits) == 1:
+            return next(iter(self.bits.values())).offsets(cu)
+        offsets = self.merged.get(cu.cu_offset)
+        if offsets is None:
+            offsets = self.merged[cu.cu_offset] = array('Q', sorted(set(offset for bits in self.bits.values() for offset in bits.offsets(cu))))
+        return offsets
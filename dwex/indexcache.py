@@ -0,0 +1,345 @@
+import os, sys, json, hashlib, zlib
+from array import array
+from bisect import bisect_right
+from struct import Struct
+
+from .dieindex import DIEIndex
+from .dwarfone import DWARFInfoV1
+from .funclist import FuncList
+
+# On-disk cache for the stuff that is expensive to recompute every time a binary is opened:
+# the CU table and CU names, the per-CU DIE offset indices, the function map, the aranges,
+# and the string index for Find (see strindex).
+# This doesn't depend on Qt.
+#
+# The file is a header, a JSON directory, and raw blobs that the directory points at.
+# The directory is plain data on purpose - the cache folder is writable by whoever, so nothing
+# that can run code on load, like pickle. The blobs are only read when needed, so opening a large
+# binary doesn't pull in all the indices. Anything that doesn't check out - magic, version,
+# checksums, the key, the CU table - means the cache is discarded and rebuilt.
+#
+# The files add up, a DIE index alone is 24 bytes per DIE. Once the total goes over MAX_CACHE_SIZE,
+# the least recently used files are deleted, by the timestamp - opening a file touches it.
+
+_MAGIC = b'DWEXIDX\0'
+_VERSION = 2 # Bump when the layout of the cached data changes
+_header = Struct('<8sIIQ') # Magic, version, directory CRC32, directory length
+_SAMPLE = 1024*1024 # For hashing files without a build ID
+MAX_CACHE_SIZE = 1024*1024*1024 # All the cache files together
+
+def cache_dir():
+    if 'DWEX_CACHEDIR' in os.environ:
+        return os.environ['DWEX_CACHEDIR']
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~\\AppData\\Local')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'dwex')
+
+# Identifies the DWARF data - build ID on ELF, UUID on Mach-O, otherwise
+# a hash of the file's size, timestamp and some of the contents.
+# None if not cacheable.
+def cache_key(di, filename):
+    if isinstance(di, DWARFInfoV1):
+        return None
+    parts = [str(di._format)]
+    slice_code = getattr(di, '_slice_code', None)
+    if slice_code:
+        parts.append(':'.join(slice_code))
+    build_id = getattr(di, '_build_id', None)
+    uuid = getattr(di, '_uuid', None)
+    if build_id:
+        parts += ['build-id', build_id]
+    elif uuid:
+        parts += ['uuid', uuid.decode('ASCII', errors='replace') if isinstance(uuid, bytes) else str(uuid)]
+    elif os.path.isfile(filename):
+        st = os.stat(filename)
+        h = hashlib.blake2b(digest_size=16)
+        with open(filename, 'rb') as f:
+            h.update(f.read(_SAMPLE))
+            if st.st_size > 2*_SAMPLE:
+                f.seek(-_SAMPLE, os.SEEK_END)
+                h.update(f.read(_SAMPLE))
+        parts += ['content', str(st.st_size), str(st.st_mtime_ns), h.hexdigest()]
+    else: # Bundle without a UUID?
+        return None
+    return '|'.join(parts)
+
+def _cache_path(key):
+    return os.path.join(cache_dir(), hashlib.blake2b(key.encode('UTF-8'), digest_size=16).hexdigest() + '.idx')
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# ARanges lookalike, as far as find_cu_by_address is concerned
+class CachedARanges(object):
+    def __init__(self, begins, lengths, cu_offsets):
+        self.begins = begins
+        self.lengths = lengths
+        self.cu_offsets = cu_offsets
+
+    def cu_offset_at_addr(self, addr):
+        i = bisect_right(self.begins, addr) - 1
+        if i >= 0 and self.begins[i] <= addr < self.begins[i] + self.lengths[i]:
+            return self.cu_offsets[i]
+        return None
+
+class IndexCache(object):
+    def __init__(self, path, directory, blob_base):
+        self.path = path
+        self.directory = directory
+        self.blob_base = blob_base # File position where the blobs start
+        self.dirty = False # Something was found corrupt
+
+    @property
+    def cu_names(self):
+        return self.directory['cu_names']
+
+    def has_die_index(self, cu_offset):
+        return cu_offset in self.directory['die_indices']
+
+    def has_funcs(self):
+        return self.directory['funcs'] is not None
+
+    def has_aranges(self):
+        return self.directory['aranges'] is not None
+
+    def has_strindex(self):
+        return self.directory['strindex'] is not None
+
+    def check_CUs(self, cu_offsets):
+        return list(self.directory['cu_offsets']) == list(cu_offsets)
+
+    # Returns the bytes of the blob, or None if it doesn't check out
+    def _read_data(self, blob, size):
+        (pos, count, crc) = blob
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.blob_base + pos)
+                data = f.read(size)
+        except OSError:
+            return None
+        if len(data) != size or zlib.crc32(data) != crc:
+            self.dirty = True
+            return None
+        return data
+
+    # Returns a list of n arrays of count items, or None if the blob doesn't check out
+    def _read_blob(self, blob, n):
+        count = blob[1]
+        data = self._read_data(blob, n * count * 8)
+        if data is None:
+            return None
+        arrays = []
+        for i in range(n):
+            a = array('Q')
+            a.frombytes(data[i*count*8:(i+1)*count*8])
+            arrays.append(a)
+        return arrays
+
+    def _read_die_index_arrays(self, cu_offset):
+        blob = self.directory['die_indices'].get(cu_offset)
+        arrays = self._read_blob(blob, 3) if blob else None
+        if blob and arrays is None:
+            del self.directory['die_indices'][cu_offset]
+        return arrays
+
+    def load_die_index(self, cu):
+        arrays = self._read_die_index_arrays(cu.cu_offset)
+        return DIEIndex(cu, *arrays) if arrays else None
+
+    # Returns a FuncList, same as GatherFuncsThread produces
+    def load_funcs(self):
+        funcs = self.directory['funcs']
+        arrays = self._read_blob(funcs[0], 2) if funcs else None
+        if arrays is None:
+            self.directory['funcs'] = None
+            return None
+        (addresses, die_offsets) = arrays
+        return FuncList(addresses, die_offsets, funcs[1])
+
+    def load_aranges(self):
+        blob = self.directory['aranges']
+        arrays = self._read_blob(blob, 3) if blob else None
+        if arrays is None:
+            self.directory['aranges'] = None
+            return None
+        return CachedARanges(*arrays)
+
+    # Returns the arguments for the StringIndex constructor, or None
+    def load_strindex(self):
+        strindex = self.directory['strindex']
+        if strindex:
+            text = self._read_data(strindex['text'], strindex['text'][1])
+            arrays = [self._read_blob(strindex[name], 1) for name in ('starts', 'post_starts', 'die_offsets')]
+            if text is not None and all(arrays):
+                try:
+                    return (text.decode('UTF-8'),) + tuple(a[0] for a in arrays) + (frozenset(strindex['covered_CUs']),)
+                except UnicodeDecodeError:
+                    self.dirty = True
+        self.directory['strindex'] = None
+        return None
+
+# Returns an IndexCache or None if there's none, or it doesn't check out
+# Sets di._cache_key
+def load_index_cache(di, filename):
+    di._cache_key = key = cache_key(di, filename)
+    if key is None:
+        return None
+    path = _cache_path(key)
+    try:
+        with open(path, 'rb') as f:
+            (magic, ver, crc, length) = _header.unpack(f.read(_header.size))
+            if magic != _MAGIC or ver != _VERSION:
+                raise ValueError()
+            data = f.read(length)
+            if len(data) != length or zlib.crc32(data) != crc:
+                raise ValueError()
+            directory = json.loads(data.decode('UTF-8'))
+            if directory['key'] != key or directory['info_size'] != di.debug_info_sec.size:
+                raise ValueError()
+            # JSON has no int keys and no tuples
+            directory['die_indices'] = {entry[0]: tuple(entry[1:]) for entry in directory['die_indices']}
+    except FileNotFoundError:
+        return None
+    except Exception: # Corrupt or stale
+        _discard(path)
+        return None
+    try:
+        os.utime(path) # Recently used, see prune_index_cache()
+    except OSError:
+        pass
+    return IndexCache(path, directory, _header.size + length)
+
+# Array data for the blob area, or raw bytes
+class _Blob(object):
+    def __init__(self, arrays):
+        if isinstance(arrays, bytes):
+            self.count = len(arrays)
+            self.data = arrays
+        else:
+            self.count = len(arrays[0])
+            self.data = b''.join(a.tobytes() for a in arrays)
+
+# Deletes the least recently used cache files over MAX_CACHE_SIZE, except for keep
+def prune_index_cache(keep):
+    files = []
+    try:
+        with os.scandir(cache_dir()) as entries:
+            for entry in entries:
+                if entry.name.endswith('.idx') and entry.is_file():
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+    except OSError:
+        return
+    total = sum(size for (mtime, size, path) in files)
+    for (mtime, size, path) in sorted(files):
+        if total <= MAX_CACHE_SIZE:
+            break
+        if path != keep:
+            _discard(path)
+            total -= size
+
+# Writes whatever has been computed for the DWARF data, plus whatever was cached and not loaded.
+# Assumes the DWARFInfo was decorated by load_dwarfinfo
+def save_index_cache(di):
+    key = getattr(di, '_cache_key', None)
+    if key is None:
+        return
+    cache = di._indexcache
+    cus = di._unsorted_CUs
+
+    # Is there anything new?
+    if (cache and not cache.dirty
+        and not any(isinstance(cu._dieindex, DIEIndex) and not cache.has_die_index(cu.cu_offset) for cu in cus)
+        and not (di._funcs and not cache.has_funcs())
+        and not (hasattr(di._aranges, 'entries') and not cache.has_aranges())
+        and not (di._strindex and not cache.has_strindex())):
+        return
+
+    if di._cu_names is None:
+        from .dwarfutil import top_die_file_name
+        di._cu_names = cache.cu_names if cache else [top_die_file_name(cu.get_top_DIE()) for cu in cus]
+
+    blobs = []
+    pos = 0
+    # Positions in the directory are relative to the end of the directory
+    def add_blob(arrays):
+        nonlocal pos
+        blob = _Blob(arrays)
+        blobs.append(blob)
+        entry = (pos, blob.count, zlib.crc32(blob.data))
+        pos += len(blob.data)
+        return entry
+
+    die_indices = dict()
+    for cu in cus:
+        index = cu._dieindex
+        if isinstance(index, DIEIndex):
+            arrays = (index.offsets, index.parents, index.ends)
+        elif cache and cache.has_die_index(cu.cu_offset):
+            arrays = cache._read_die_index_arrays(cu.cu_offset)
+        else:
+            arrays = None
+        if arrays:
+            die_indices[cu.cu_offset] = add_blob(arrays)
+
+    funcs = None
+    if not di._funcs and cache and cache.has_funcs():
+        di._funcs = cache.load_funcs()
+    if di._funcs:
+        f = di._funcs
+        funcs = (add_blob((f.addresses, f.die_offsets)), f.names)
+
+    aranges = di._aranges
+    if not aranges and cache and cache.has_aranges():
+        aranges = cache.load_aranges()
+    if hasattr(aranges, 'entries'): # From pyelftools
+        aranges = CachedARanges(array('Q', (e.begin_addr for e in aranges.entries)),
+            array('Q', (e.length for e in aranges.entries)),
+            array('Q', (e.info_offset for e in aranges.entries)))
+    aranges = add_blob((aranges.begins, aranges.lengths, aranges.cu_offsets)) if aranges else None
+
+    strindex = None
+    index = di._strindex
+    parts = (index.text, index.starts, index.post_starts, index.die_offsets, index.covered_CUs) if index else cache.load_strindex() if cache and cache.has_strindex() else None
+    if parts:
+        (text, starts, post_starts, die_offsets, covered_CUs) = parts
+        strindex = dict(text = add_blob(text.encode('UTF-8')),
+            starts = add_blob((starts,)),
+            post_starts = add_blob((post_starts,)),
+            die_offsets = add_blob((die_offsets,)),
+            covered_CUs = sorted(covered_CUs))
+
+    directory = dict(key = key,
+        info_size = di.debug_info_sec.size,
+        cu_offsets = list(di._CU_offsets),
+        cu_names = di._cu_names,
+        die_indices = [(cu_offset,) + blob for (cu_offset, blob) in die_indices.items()],
+        funcs = funcs,
+        aranges = aranges,
+        strindex = strindex)
+    data = json.dumps(directory).encode('UTF-8')
+
+    path = _cache_path(key)
+    os.makedirs(cache_dir(), exist_ok=True)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_header.pack(_MAGIC, _VERSION, zlib.crc32(data), len(data)))
+            f.write(data)
+            for blob in blobs:
+                f.write(blob.data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        _discard(tmp_path)
+        raise
+    # The old one might have been pointing at the file we've just replaced
+    directory['die_indices'] = die_indices
+    di._indexcache = IndexCache(path, directory, _header.size + len(data))
+    prune_index_cache(path)
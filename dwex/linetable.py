@@ -0,0 +1,139 @@
+from array import array
+from bisect import bisect_right
+from heapq import heappush, heappop
+
+# Compiled line table of a CU.
+#
+# The states of the line program, as parallel arrays, in the program order - that's what
+# the DW_AT_stmt_list details view pages over. For lookups by address, the
+# address ranges between consecutive states of a sequence are sorted, so that
+# finding the row for an address is a bisect rather than a run of the whole line program.
+# This doesn't depend on Qt.
+
+# Flags
+IS_STMT = 1
+BASIC_BLOCK = 2
+END_SEQUENCE = 4
+PROLOGUE_END = 8
+EPILOGUE_BEGIN = 16
+
+class LineTable(object):
+    def __init__(self, lineprogram):
+        self.lineprogram = lineprogram
+        self.addresses = array('Q')
+        self.files = array('L')
+        self.lines = array('L')
+        self.discriminators = array('L')
+        self.flags = array('B')
+        # Address ranges - [starts[i], ends[i]) maps to row rows[i]
+        self.starts = array('Q')
+        self.ends = array('Q')
+        self.rows = array('L')
+
+        ranges = []
+        prev = None # Row of the previous state in the current sequence
+        for entry in lineprogram.get_entries():
+            state = entry.state
+            if state is None: # Only interested in the entries where a new state is assigned
+                continue
+            row = len(self.addresses)
+            self.addresses.append(state.address)
+            self.files.append(state.file)
+            self.lines.append(state.line)
+            self.discriminators.append(state.discriminator)
+            self.flags.append((IS_STMT if state.is_stmt else 0) |
+                (BASIC_BLOCK if state.basic_block else 0) |
+                (END_SEQUENCE if state.end_sequence else 0) |
+                (PROLOGUE_END if state.prologue_end else 0) |
+                (EPILOGUE_BEGIN if state.epilogue_begin else 0))
+            if prev is not None and self.addresses[prev] < state.address:
+                ranges.append((self.addresses[prev], state.address, prev))
+            prev = None if state.end_sequence else row
+        self._sort_ranges(ranges)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    # Where the ranges overlap - different sequences for the same addresses,
+    # like discarded functions in object files - the first one in the program wins,
+    # same as a run through the program would find
+    def _sort_ranges(self, ranges):
+        ranges.sort()
+        overlap = any(ranges[i][0] < ranges[i-1][1] for i in range(1, len(ranges)))
+        if not overlap:
+            for (start, end, row) in ranges:
+                self.starts.append(start)
+                self.ends.append(end)
+                self.rows.append(row)
+            return
+
+        # Cut into disjoint segments, each one owned by the earliest range that covers it
+        bounds = sorted(set(r[0] for r in ranges) | set(r[1] for r in ranges))
+        heap = [] # (row, end)
+        r = 0
+        for (i, address) in enumerate(bounds[:-1]):
+            while r < len(ranges) and ranges[r][0] == address:
+                heappush(heap, (ranges[r][2], ranges[r][1]))
+                r += 1
+            while heap and heap[0][1] <= address:
+                heappop(heap)
+            if heap:
+                row = heap[0][0]
+                # Ranges that are over, but not on top, stay in the heap until they surface
+                if self.rows and self.rows[-1] == row and self.ends[-1] == address:
+                    self.ends[-1] = bounds[i+1]
+                else:
+                    self.starts.append(address)
+                    self.ends.append(bounds[i+1])
+                    self.rows.append(row)
+
+    # The row of the state that covers the address, or -1
+    def find(self, address):
+        i = bisect_right(self.starts, address) - 1
+        return self.rows[i] if i >= 0 and address < self.ends[i] else -1
+
+    # File name for the file number in the line table, or None if out of range
+    # Version 5 has the primary file as #0, before that #0 was the CU name
+    def file_name(self, file, cu_name = None):
+        files = self.lineprogram.header.file_entry
+        if self.lineprogram.header.version >= 5:
+            return files[file].name if 0 <= file < len(files) else None
+        elif file == 0:
+            return cu_name
+        else:
+            return files[file-1].name if 1 <= file <= len(files) else None
+
+    # Same, with the directory, the way addr2line shows it
+    # comp_dir and cu_name are bytes, from the top DIE
+    def file_path(self, file, comp_dir, cu_name = None):
+        header = self.lineprogram.header
+        if header.version < 5 and file == 0:
+            return _join_path(comp_dir, cu_name) if cu_name is not None else None
+        name = self.file_name(file)
+        if name is None:
+            return None
+        entry = header.file_entry[file if header.version >= 5 else file-1]
+        dirs = header.include_directory
+        i = entry.dir_index
+        if header.version >= 5:
+            dir = dirs[i] if 0 <= i < len(dirs) else None
+        else: # Directory #0 is the compilation directory
+            dir = comp_dir if i == 0 else dirs[i-1] if 1 <= i <= len(dirs) else None
+        return _join_path(comp_dir, _join_path(dir, name))
+
+def _is_abs_path(p):
+    return p[:1] in (b'/', b'\\') or p[1:3] in (b':\\', b':/')
+
+def _join_path(dir, name):
+    if not dir or _is_abs_path(name):
+        return name
+    sep = b'\\' if b'\\' in dir and b'/' not in dir else b'/'
+    return dir + name if dir[-1:] in (b'/', b'\\') else dir + sep + name
+
+# Returns the line table of the CU, building it on the first use, or None if the CU has no line program
+def get_line_table(cu):
+    if cu._linetable is None:
+        if cu._lineprogram is None:
+            cu._lineprogram = cu.dwarfinfo.line_program_for_CU(cu)
+        cu._linetable = LineTable(cu._lineprogram) if cu._lineprogram else False
+    return cu._linetable if cu._linetable is not False else None
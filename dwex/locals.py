@@ -1,7 +1,8 @@
+from bisect import bisect_right
 from PyQt6.QtCore import Qt, QAbstractTableModel, QSize
 from PyQt6.QtWidgets import *
 from elftools.dwarf.locationlists import LocationParser, LocationExpr
-from elftools.dwarf.callframe import FDE, CFARule
+from elftools.dwarf.callframe import CFARule
 
 from dwex.exprutil import ExprFormatter, format_offset
 from .dwarfutil import *
@@ -226,27 +227,24 @@ class LocalsDlg(LoadedModuleDlgBase):
         self.nav_bu.setEnabled(index.isValid())
 
     def resolve_cfa(self, address):
-        di = self.dwarfinfo
-        if di.has_CFI():
-            entries = di.CFI_entries()
-        elif di.has_EH_CFI():
-            entries = di.EH_CFI_entries()
-        else:
+        index = get_fde_index(self.dwarfinfo)
+        if not index:
             return False
         
-        for e in entries:
-            if isinstance(e, FDE) and e.header.initial_location <= address < e.header.initial_location + e.header.address_range:
-                decoded = e.get_decoded().table
-                de = next(reversed([de for de in decoded if de['pc'] <= address]))
-                if 'cfa' in de:
-                    rule = de['cfa']
-                    if isinstance(rule, CFARule):
-                        if rule.expr:
-                            return 'expr'
-                        else:
-                            return self.expr_formatter.regname(rule.reg) + format_offset(rule.offset)
+        e = index.fde_at(address)
+        if e is not None:
+            decoded = index.decoded(e).table
+            i = bisect_right(decoded, address, key = lambda de: de['pc']) - 1
+            de = decoded[i] if i >= 0 else None
+            if de and 'cfa' in de:
+                rule = de['cfa']
+                if isinstance(rule, CFARule):
+                    if rule.expr:
+                        return 'expr'
                     else:
-                        return 'unknown'
+                        return self.expr_formatter.regname(rule.reg) + format_offset(rule.offset)
+                else:
+                    return 'unknown'
 
     @classmethod
     def reset(cl):
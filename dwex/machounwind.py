@@ -10,7 +10,8 @@
 # This code is in the public domain
 #-------------------------------------------------------------------------------
 
-from bisect import bisect_left
+from array import array
+from bisect import bisect_right
 from collections import namedtuple
 from enum import Enum
 from struct import unpack_from
@@ -27,7 +28,7 @@ PageHeader = namedtuple('PageHeader', ('first_address', 'second_level_page_offse
 Page = namedtuple('Page', ('header', 'entries'))
 LSDA = namedtuple('LSDA', ('instruction_address', 'lsda_address'))
 UnwindEntry = namedtuple('UnwindEntry', ('address', 'encoding', 'command', 'arg'))
-PushOrderARM64 = (19, 21, 23, 25, 27, 8, 10, 12, 14) 
+PushOrderARM64 = (19, 21, 23, 25, 27, 72, 74, 76, 78) # d8-d15 are v8-v15 in DWARF
 RegOrderx86 = (3, 1, 2, 7, 6, 5) # ebx ecx edx edi esi ebp
 RegOrderx64 = (3, 12, 13, 14, 15, 6) # rbx r12 r13 r14 r15 rbp
 DecodedEntry = namedtuple('DecodedEntry', ('raw', 'has_frame', 'cfa_base_register', 'cfa_offset', 'saved_registers'))
@@ -50,7 +51,7 @@ class UnwindCommandARM64(Enum):
     Frame = 4
     # arg is a tuple of 9 booleans, if the respective reg pair was saved in the prologue
     # Register pair order in the arg tuple:
-    # 19/20 21/22 23/24 25/26 27/29 8/9 10/11 12/13 14/15
+    # 19/20 21/22 23/24 25/26 27/28 d8/d9 d10/d11 d12/d13 d14/d15
     # If they are pushed, they are pushed in this order, so offsets from sp go in the opposite order
     
 class UnwindCommandIntel(Enum):
@@ -109,13 +110,13 @@ def translate_encoding_intel(address, enc):
     elif cmd == UnwindCommandIntel.FramelessImmediate:
         size = (enc >> 16) & 0xff
         n = (enc >> 10) & 7
-        p = enc & 0x3f
+        p = enc & 0x3ff # 10 bits
         arg = (size, n, p)
     elif cmd == UnwindCommandIntel.FramelessIndirect:
         offset = (enc >> 16) & 0xff
         adj = (enc >> 13) & 7
         n = (enc >> 10) & 7
-        p = enc & 0x3f
+        p = enc & 0x3ff # 10 bits
         arg = (offset, adj, n, p)
     elif cmd == UnwindCommandIntel.EH:
         arg = enc & 0xffffff # Offset in the eh_frame section
@@ -124,7 +125,8 @@ def translate_encoding_intel(address, enc):
 class MachoUnwindInfo:
     """
     Holds the parsed unwind_info section. The LSDA/personality stuff is not decoded, with some stubs in place.
-    Call find_by_address() to locate the unwind entry for a particular location in code.
+    Call find_by_address() to locate the unwind entry for a particular location in code,
+    or find_by_addresses() for many locations at once.
     """
     def __init__(self, section_data, cputype, big_endian = False, text_section = None):
         """
@@ -140,7 +142,9 @@ class MachoUnwindInfo:
             All three supported architectures use little endian on Apple platforms, so this is rather irrelevant.
 
         text_section:
-            Reserved for when Intel FramelessIndirect decoding will be supported
+            A tuple of (contents, address) of the __text section, with the address relative to the same base
+            as the entry addresses - the preferred start address of the __TEXT segment.
+            Needed for the Intel FramelessIndirect entries, where the stack size is in the code.
         """
         cputype = CpuType(cputype)
         if cputype == CpuType.ARM64:
@@ -157,51 +161,81 @@ class MachoUnwindInfo:
         self.cputype = cputype
         self.text = text_section
 
-        endianness = '>' if big_endian else '<'
+        self.translate_encoding = translate_encoding
+        self.section_data = section_data
+        self.endianness = endianness = '>' if big_endian else '<'
         self.header = header = Header(*unpack_from(endianness + 'IIIIIII', section_data, 0))
-        page_headers = [PageHeader(*unpack_from(endianness + 'III', section_data, header.pages_offset + i*12)) for i in range(header.pages_length)]
-        global_encodings = unpack_from(endianness + 'I'*header.global_encodings_length, section_data, header.global_encodings_offset)
+        self.page_headers = [PageHeader(*unpack_from(endianness + 'III', section_data, header.pages_offset + i*12)) for i in range(header.pages_length)]
+        self.global_encodings = unpack_from(endianness + 'I'*header.global_encodings_length, section_data, header.global_encodings_offset)
         #personalities = unpack_from(endianness + 'I'*rph.personalities_length, unw, rph.personalities_offset)
         #lsda_offset = rph.pages_offset + rph.pages_length*12
-        
-        def process_page(page_header):
-            page_offset = page_header.second_level_page_offset
-            if page_offset: # Zero is possible in the final guard page that stores the effective end address
-                (kind,) = unpack_from(endianness + 'I', section_data, page_offset)
-                if kind == 2: # Regular second level page
-                    (entries_offset, entries_length) = unpack_from(endianness + 'HH', section_data,  + 4)
-                    entries = [translate_encoding(*unpack_from(endianness + 'II', section_data, page_offset + entries_offset + i*8)) for i in range(entries_length)]
-                elif kind == 3: # Compressed second level page
-                    (entries_offset, entries_length, encodings_offset, encodings_length) = unpack_from(endianness + 'HHHH', section_data, page_offset + 4)
-                    raw_entries = unpack_from(endianness + 'I'*entries_length, section_data, page_offset + entries_offset)
-                    encodings = unpack_from(endianness + 'I'*encodings_length, section_data, page_offset + encodings_offset)
-                    all_encodings = global_encodings + encodings # :(
-                    entries = [translate_encoding(page_header.first_address + e & 0xFFFFFF, all_encodings[(e>>24) & 0xff]) for e in raw_entries]
-                else:
-                    raise NotImplementedError(f"Unknown second level page kind {kind}")
+
+        # The second level pages are decoded as they are looked into, see PageList
+        self.pages = PageList(self)
+
+        # Lookup keys, so that a lookup is a bisect and nothing else.
+        # The per-page ones come with the page, in self.pages.addresses().
+        self.page_addresses = array('I', (ph.first_address for ph in self.page_headers))
+
+    def process_page(self, page_header):
+        """
+            Decodes a second level page. Returns a Page, with entries being None for the final guard page.
+        """
+        section_data = self.section_data
+        endianness = self.endianness
+        translate_encoding = self.translate_encoding
+        page_offset = page_header.second_level_page_offset
+        if page_offset: # Zero is possible in the final guard page that stores the effective end address
+            (kind,) = unpack_from(endianness + 'I', section_data, page_offset)
+            if kind == 2: # Regular second level page
+                (entries_offset, entries_length) = unpack_from(endianness + 'HH', section_data, page_offset + 4)
+                entries = [translate_encoding(*unpack_from(endianness + 'II', section_data, page_offset + entries_offset + i*8)) for i in range(entries_length)]
+            elif kind == 3: # Compressed second level page
+                (entries_offset, entries_length, encodings_offset, encodings_length) = unpack_from(endianness + 'HHHH', section_data, page_offset + 4)
+                raw_entries = unpack_from(endianness + 'I'*entries_length, section_data, page_offset + entries_offset)
+                encodings = unpack_from(endianness + 'I'*encodings_length, section_data, page_offset + encodings_offset)
+                # Encoding indices go through the global encodings, then through the page ones
+                global_encodings = self.global_encodings
+                global_count = len(global_encodings)
+                first_address = page_header.first_address
+                entries = []
+                for e in raw_entries:
+                    i = (e >> 24) & 0xff
+                    entries.append(translate_encoding(first_address + (e & 0xFFFFFF), global_encodings[i] if i < global_count else encodings[i - global_count]))
             else:
-                entries = None
-            return Page(page_header, entries)
-        
-        self.pages = [process_page(page_header) for page_header in page_headers]
+                raise NotImplementedError(f"Unknown second level page kind {kind}")
+        else:
+            entries = None
+        return Page(page_header, entries)
+
+    def page_entry_count(self, page_header):
+        """
+            The number of entries in a second level page, from its header, without decoding the page.
+        """
+        page_offset = page_header.second_level_page_offset
+        if not page_offset:
+            return 0
+        (kind, _, entries_length) = unpack_from(self.endianness + 'IHH', self.section_data, page_offset)
+        return entries_length if kind in (2, 3) else 0
 
     def decode_entry_arm64(self, entry):
         cmd = entry.command
         if cmd == UnwindCommandARM64.Nop:
             return NopEntry(entry)
         elif cmd == UnwindCommandARM64.Frameless:
-            return DecodedEntry(entry, False, 31, entry.arg, {})
+            return DecodedEntry(entry, False, 31, entry.arg*16, {})
         elif cmd == UnwindCommandARM64.EH:
             return FallbackEntry(entry, entry.arg)
         elif cmd == UnwindCommandARM64.Frame:
-            # CFA at x29+16, x30 at CFA-16 x31 at CFA-8
-            regs = {30: 16, 31: 8}
-            off = 32
+            # CFA at x29+16, x29 at CFA-16, x30 at CFA-8
+            # The pairs go down from there, first register of a pair on top - same as libunwind
+            regs = {29: 16, 30: 8}
+            off = 24
             for (i, r) in enumerate(entry.arg):
                 if r:
                     base_regno = PushOrderARM64[i]
                     regs[base_regno] = off
-                    regs[base_regno+1] = off - 8
+                    regs[base_regno+1] = off + 8
                     off += 16
             return DecodedEntry(entry, True, 29, 16, regs)
 
@@ -223,47 +257,74 @@ class MachoUnwindInfo:
                     regs[arch_regmap[r-1]] = (i-2 + offset)*rsize
             return DecodedEntry(entry, True, bp_regno, 2*rsize, regs)
         elif cmd == UnwindCommandIntel.FramelessImmediate:
-            raise NotImplementedError("Intel/FramelessImmediate is not supported yet")
-
-            # CFA at Xsp + stack_size*rsize
-            # return address at CFA-rsize
-            # Pushed registers above that in the permutation order
             (stack_size, reg_count, permutation) = entry.arg
-            regs = {ip_regno: rsize}
-            if reg_count:
-                pass
-                #permutation = lehmer_decode(reg_count, permutation)
-                #for (i, p) in enumerate(permutation):
-                #    regs[arch_regmap[p]] = (2+i)*rsize
-            return DecodedEntry(entry, False, sp_regno, stack_size*rsize, regs)
+            return self.decode_frameless_intel(entry, stack_size*rsize, reg_count, permutation, rsize, arch_regmap, sp_regno, ip_regno)
         elif cmd == UnwindCommandIntel.FramelessIndirect:
-            raise NotImplementedError("Intel/FramelessIndirect is not supported yet")
-
+            # The stack size is the imm32 of the sub Xsp, imm32 in the prologue, plus stack_adjust pushes.
+            # instruction_offset is from the function start to the imm32:
             # x86_64 sub rsp, imm32 goes: 48 81 ec (imm32)
-            # x86 sub esp, imm32 goes: 81 ec (imm32)            
+            # x86 sub esp, imm32 goes: 81 ec (imm32)
             (instruction_offset, stack_adjust, reg_count, permutation) = entry.arg
-            regs = {}
-            if reg_count:
-                permutation = lehmer_decode(reg_count, permutation)
-                regs = {}
-                # TODO the rest once I get an example
-            else:
-                regs = {}
-            return DecodedEntry(entry, False, sp_regno, stack_size*rsize, regs)
+            if self.text is None:
+                raise NotImplementedError("Intel/FramelessIndirect needs the __text section")
+            (text, text_address) = self.text
+            pos = entry.address + instruction_offset - text_address
+            if pos < 0 or pos + 4 > len(text):
+                raise NotImplementedError("Intel/FramelessIndirect entry with the stack size outside of __text")
+            (sub,) = unpack_from(self.endianness + 'I', text, pos)
+            return self.decode_frameless_intel(entry, sub + stack_adjust*rsize, reg_count, permutation, rsize, arch_regmap, sp_regno, ip_regno)
         elif cmd == UnwindCommandIntel.EH:
             return FallbackEntry(entry, entry.arg)
+
+    def decode_frameless_intel(self, entry, stack_size, reg_count, permutation, rsize, arch_regmap, sp_regno, ip_regno):
+        """
+            The frameless Intel entries, once the stack size in bytes is known.
+            CFA at Xsp + stack_size, return address at CFA-rsize,
+            pushed registers below that, the first one in the permutation order is the lowest.
+        """
+        regs = {ip_regno: rsize}
+        if reg_count:
+            # The permutation is of reg_count registers out of 6; same as a full permutation of 6 with the rest in order
+            permutation = lehmer_decode(6, permutation*factorial(6 - reg_count))
+            for (i, p) in enumerate(permutation[:reg_count]):
+                regs[arch_regmap[p]] = (1 + reg_count - i)*rsize
+        return DecodedEntry(entry, False, sp_regno, stack_size, regs)
     
     def find_by_address_raw(self, IP):
         """
             IP is relative to the preferred start address, as seen in the load segment command for the __TEXT segment.
             Returns a DecodedEntry, or None if the IP can't be found or the entry is a null one, or False if fallback to EH is in order
         """
-        # TODO: key
-        i = bisect_left([p.header.first_address for p in self.pages], IP)
-        if i:
-            entries = self.pages[i-1].entries
-            i = bisect_left([e.address for e in entries], IP) - 1 # Supposed to be sorted
-            return entries[i]
+        i = bisect_right(self.page_addresses, IP) - 1
+        if i >= 0 and self.pages.addresses(i) is not None:
+            j = bisect_right(self.pages.addresses(i), IP) - 1 # Supposed to be sorted
+            if j >= 0:
+                return self.pages[i].entries[j]
+
+    def find_by_addresses_raw(self, IPs):
+        """
+            Same as find_by_address_raw() for a list of IPs, sorted ascending, in one pass over the pages and the entries.
+            Returns a list of entries (or None) in the same order as IPs.
+        """
+        page_addresses = self.page_addresses
+        page_count = len(page_addresses)
+        results = []
+        p = 0 # Pages that start at or before the IP
+        e = 0 # Entries of the current page that start at or before the IP
+        addresses = None
+        for IP in IPs:
+            if p < page_count and page_addresses[p] <= IP:
+                while p < page_count and page_addresses[p] <= IP:
+                    p += 1
+                addresses = self.pages.addresses(p-1)
+                e = 0
+            if not p or addresses is None:
+                results.append(None)
+                continue
+            while e < len(addresses) and addresses[e] <= IP:
+                e += 1
+            results.append(self.pages[p-1].entries[e-1] if e else None)
+        return results
 
     def find_by_address(self, IP):
         """
@@ -280,8 +341,71 @@ class MachoUnwindInfo:
              - cfa_offset - offset from the cfa_base_register to the CFA
              - saved_registers - maps DWARF register number to the offset (negative) from CFA where it is saved
         """
-        return self.decode_entry(self.find_by_address_raw(IP))
-    
+        entry = self.find_by_address_raw(IP)
+        return self.decode_entry(entry) if entry else None
+
+    def find_by_addresses(self, IPs):
+        """
+            Same as find_by_address() for a list of IPs, sorted ascending. Returns a list in the same order as IPs.
+            The entries are decoded once each, however many IPs they cover.
+        """
+        decoded = dict()
+        results = []
+        for entry in self.find_by_addresses_raw(IPs):
+            if entry is None:
+                results.append(None)
+            else:
+                de = decoded.get(entry.address)
+                if de is None:
+                    de = decoded[entry.address] = self.decode_entry(entry)
+                results.append(de)
+        return results
+
+class PageList:
+    """
+    The second level pages of a MachoUnwindInfo, as a read-only sequence of Page.
+    A page is decoded when it's first asked for, and kept - so opening a large __unwind_info
+    only costs the first level index, and a lookup only decodes the pages that it lands on.
+    """
+    def __init__(self, unwind_info):
+        self.unwind_info = unwind_info
+        self.headers = unwind_info.page_headers
+        self.decoded = [None] * len(self.headers)
+        self.entry_addresses = [None] * len(self.headers)
+        self.counts = None
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.headers)
+        page = self.decoded[i]
+        if page is None:
+            page = self.decoded[i] = self.unwind_info.process_page(self.headers[i])
+            if page.entries is not None:
+                self.entry_addresses[i] = array('I', (e.address for e in page.entries))
+        return page
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.headers)))
+
+    def addresses(self, i):
+        """
+            Sorted entry addresses of page i, as an array, or None for the guard page.
+        """
+        if self.decoded[i] is None:
+            self[i]
+        return self.entry_addresses[i]
+
+    def entry_counts(self):
+        """
+            The entry count of every page, from the page headers, without decoding the pages.
+        """
+        if self.counts is None:
+            self.counts = array('I', (self.unwind_info.page_entry_count(ph) for ph in self.headers))
+        return self.counts
+
 _fact = (1, 1, 2, 6, 24, 120, 720)
 def factorial(n):
     return _fact[n]
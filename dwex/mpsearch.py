@@ -0,0 +1,197 @@
+import os, multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from .formats import read_dwarf, recall_slice
+from .dwarfone import DWARFInfoV1
+from .dwarfutil import decorate_dwarfinfo
+
+# Find and Find by condition, over many CUs at once, in a pool of worker processes.
+#
+# Each worker opens the binary on its own, memory mapped, and parses the CUs that it's given
+# from scratch - DIE objects never cross the process boundary. What comes back is
+# the offsets of the matching DIEs in each CU, in section order. Those are fed to
+# DWARFTreeModel.find() as candidates, so the wrap-around logic stays where it was,
+# and the condition is rechecked on the main process for the hits only.
+#
+# The CUs are submitted in the tree order, starting with the current one, so that
+# the first hit is usually known long before the whole search is over.
+#
+# The function map is gathered by the same workers, see gather_funcs_in_CUs() and ParallelGatherFuncsThread,
+# and the highlights are evaluated there, see ParallelHighlightScan.
+# This doesn't depend on Qt.
+
+MIN_INFO_SIZE = 4*1024*1024 # Below that, starting up the workers costs more than it saves
+_BATCH_SIZE = 1024*1024 # Roughly, bytes of info per work item
+
+# Queries are tuples, so that they can be pickled:
+# ('text', s) - s is lowercase, see die_has_text()
+# ('condition', source) - Python source of the expression, compiled in the worker
+# ('code', None) - has_code_location(), for the highlight
+
+# The workers reopen the file that was opened in the UI, so DWARF from a dSYM that was looked up
+# for it is out - the lookup needs the event loop, and could come up with a different dSYM
+def can_search_in_parallel(di):
+    return (not isinstance(di, DWARFInfoV1) and (os.cpu_count() or 1) > 1
+        and di.debug_info_sec.size >= MIN_INFO_SIZE and not getattr(di, '_dsym_path', None))
+
+# Splits the CUs, in order, into lists of offsets, about _BATCH_SIZE worth of info each
+def batch_CUs(cus):
+    batch = []
+    size = 0
+    for cu in cus:
+        batch.append(cu.cu_offset)
+        size += cu.size
+        if size >= _BATCH_SIZE:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+# The worker processes, bound to one binary. Started on the first search.
+class SearchPool(object):
+    def __init__(self, filename, di):
+        self.filename = filename
+        self.slice_code = getattr(di, '_slice_code', None)
+        self.info_size = di.debug_info_sec.size
+        self.executor = None
+        self.search = None # The current one
+
+    # cus are in the order the UI is going to ask about them
+    def start_search(self, query, cus):
+        if self.search:
+            self.search.cancel()
+        self.start_workers()
+        self.search = ParallelSearch(self, query, cus)
+        return self.search
+
+    def start_workers(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(os.cpu_count(), multiprocessing.get_context('spawn'), init_worker)
+
+    # Returns a list of (CU offsets, future of _search_CUs()), in the order of cus
+    # For the highlights, see ParallelHighlightScan - unlike start_search(), doesn't cancel the current search
+    def start_matching(self, query, cus):
+        self.start_workers()
+        return [(batch, self.executor.submit(_search_CUs, self.filename, self.slice_code, self.info_size, query, batch))
+            for batch in batch_CUs(cus)]
+
+    # Returns a list of (CU offsets, future of gather_funcs_in_CUs()), in the order of cus
+    def start_gathering_funcs(self, cus):
+        self.start_workers()
+        return [(batch, self.executor.submit(gather_funcs_in_CUs, self.filename, self.slice_code, self.info_size, batch))
+            for batch in batch_CUs(cus)]
+
+    def shutdown(self):
+        if self.search:
+            self.search.cancel()
+            self.search = None
+        if self.executor:
+            self.executor.shutdown(False)
+            self.executor = None
+
+class ParallelSearch(object):
+    def __init__(self, pool, query, cus):
+        self.results = dict() # CU offset to array of DIE offsets, or None if the worker failed
+        self.futures = dict() # CU offset to the future of its batch
+        self.failed = set() # Futures that raised
+        for batch in batch_CUs(cus):
+            self.submit(pool, query, batch)
+
+    def submit(self, pool, query, batch):
+        future = pool.executor.submit(_search_CUs, pool.filename, pool.slice_code, pool.info_size, query, batch)
+        for cu_offset in batch:
+            self.futures[cu_offset] = future
+
+    # Offsets of the matching DIEs in the CU, in order, or None if the CU should be searched the slow way
+    # Blocks until the CU is done, or until the pool breaks or is shut down
+    def candidates(self, cu):
+        cu_offset = cu.cu_offset
+        if cu_offset not in self.results:
+            future = self.futures.get(cu_offset)
+            self.results[cu_offset] = None
+            if future and not future.cancelled() and future not in self.failed:
+                try:
+                    self.results.update(future.result())
+                except Exception as exc:
+                    self.failed.add(future)
+                    print("Error in the parallel search: %s" % format(exc))
+        return self.results[cu_offset]
+
+    def cancel(self):
+        for future in self.futures.values():
+            future.cancel()
+
+#------------------------------------
+# Worker process side
+#------------------------------------
+
+_opened = None # ((filename, slice_code), CUs by offset) - one binary per worker at a time
+
+def init_worker():
+    from .patch import monkeypatch
+    monkeypatch()
+
+def _get_CUs(filename, slice_code, info_size):
+    global _opened
+    if _opened and _opened[0] == (filename, slice_code):
+        return _opened[1]
+    _opened = None
+    # No one to ask about the slice here, so it must have been chosen already
+    di = read_dwarf(filename, recall_slice(slice_code) if slice_code else None, True, False)
+    if not di or di.debug_info_sec.size != info_size:
+        raise ValueError("The file has changed since it was opened")
+    decorate_dwarfinfo(di) # The same caches as in the UI - get_die_ranges() and the like rely on them
+    cus = {cu.cu_offset: cu for cu in di._unsorted_CUs}
+    _opened = ((filename, slice_code), cus)
+    return cus
+
+def _make_condition(query):
+    (kind, arg) = query
+    if kind == 'text':
+        from .dwarfutil import die_has_text
+        return lambda die: die_has_text(die, arg)
+    elif kind == 'code':
+        from .dwarfutil import has_code_location
+        return has_code_location
+    else:
+        from .condition import Condition
+        cond = Condition(arg)
+        def eval_condition(die):
+            try:
+                v = cond.quick(die)
+                return v if v is not None else eval(cond.code, cond.environment(die))
+            except Exception as exc: # Same as TheWindow.eval_user_condition
+                print("Error in user condition: %s" % format(exc))
+                return False
+        return eval_condition
+
+# Returns a dict of CU offset to array of matching DIE offsets
+def _search_CUs(filename, slice_code, info_size, query, cu_offsets):
+    cus = _get_CUs(filename, slice_code, info_size)
+    cond = _make_condition(query)
+    results = dict()
+    for cu_offset in cu_offsets:
+        cu = cus[cu_offset]
+        try:
+            results[cu_offset] = array('Q', (die.offset for die in cu.iter_DIEs() if not die.is_null() and cond(die)))
+        finally: # Drop the parsed DIEs, a worker goes through a lot of CUs
+            cu._dielist = []
+            cu._diemap = []
+    return results
+
+# Returns the functions in the CUs, sorted, as a tuple of FuncList arrays - see merge_funcs()
+def gather_funcs_in_CUs(filename, slice_code, info_size, cu_offsets):
+    from .funclist import FuncCollector
+    cus = _get_CUs(filename, slice_code, info_size)
+    collector = FuncCollector()
+    for cu_offset in cu_offsets:
+        cu = cus[cu_offset]
+        try:
+            collector.add_CU(cu)
+        finally:
+            cu._dielist = []
+            cu._diemap = []
+    funcs = collector.finish()
+    return (funcs.addresses, funcs.die_offsets, funcs.names)
@@ -171,16 +171,34 @@ def monkeypatch():
                 # terminating children list. It is used to locate child subtree
                 # bounds.
 
+                # If the CU has a DIE index, it knows where the subtree ends.
                 # If children are not parsed yet, this instruction will manage
                 # to recursive call of this function which will result in
                 # setting of `_terminator` attribute of the `child`.
-                if child._terminator is None:
-                    for _ in self.iter_DIE_children(child):
-                        pass
+                index = getattr(self, '_dieindex', None)
+                if child._terminator is None and index:
+                    cur_offset = index.subtree_end(child.offset)
+                else:
+                    if child._terminator is None:
+                        for _ in self.iter_DIE_children(child):
+                            pass
 
-                cur_offset = child._terminator.offset + child._terminator.size
+                    cur_offset = child._terminator.offset + child._terminator.size
     elftools.dwarf.compileunit.CompileUnit.iter_DIE_children = iter_DIE_children
 
+    # The DIE cache lookups and inserts are atomic, see diecache.cache_lock
+    from .diecache import cache_lock
+    orig_get_cached_DIE = elftools.dwarf.compileunit.CompileUnit._get_cached_DIE
+    def _get_cached_DIE(self, offset):
+        with cache_lock:
+            return orig_get_cached_DIE(self, offset)
+    elftools.dwarf.compileunit.CompileUnit._get_cached_DIE = _get_cached_DIE
+    orig_get_top_DIE = elftools.dwarf.compileunit.CompileUnit.get_top_DIE
+    def get_top_DIE(self):
+        with cache_lock:
+            return orig_get_top_DIE(self)
+    elftools.dwarf.compileunit.CompileUnit.get_top_DIE = get_top_DIE
+
     # Fix for DW_FORM_strx
     orig_create_structs = elftools.dwarf.dwarfinfo.DWARFStructs._create_structs
     def _create_structs(self):
@@ -0,0 +1,211 @@
+import threading
+from bisect import bisect_left
+from PyQt6.QtCore import QThread
+
+from .dieindex import form_size, skip_value, read_uleb, scan_die_index, UnsupportedFormError
+from .strindex import CUParams, read_cstring
+from .tree import CHUNK
+
+# Reading ahead of the tree.
+#
+# Expanding a node means parsing its children, on the UI thread. While the user is looking
+# at the current selection, a background thread gets the children of the nodes nearby -
+# the selection itself, its siblings, closest first, and the CUs next to the current one -
+# so that expanding those is instant.
+#
+# What the tree keeps for a DIE (see DIENode) is the tag, the name, and the has children bit,
+# and that's all that is read here - straight from the section bytes, by the abbreviation,
+# without pyelftools DIE objects, so that it doesn't step on the CU's DIE cache
+# that the UI thread is filling. The children are found by the DIE index.
+#
+# Every new selection replaces the queue. Results that weren't used are dropped, oldest first.
+
+MAX_SIBLINGS = 16 # On each side of the selection
+MAX_RESULTS = 256 # Child lists kept for the tree to pick up
+
+_strx_sizes = {'DW_FORM_strx1': 1, 'DW_FORM_strx2': 2, 'DW_FORM_strx3': 3, 'DW_FORM_strx4': 4}
+
+# Child lists, by the offset of the parent DIE
+# Shared between the threads
+class PrefetchedChildren(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lists = dict()
+
+    def put(self, offset, children):
+        with self.lock:
+            self.lists[offset] = children
+            while len(self.lists) > MAX_RESULTS:
+                del self.lists[next(iter(self.lists))]
+
+    # Returns ((offset, tag, name, has_children) for each child, the DIE index position of the next one or None),
+    # or None if not there, and forgets it
+    def take(self, offset):
+        with self.lock:
+            return self.lists.pop(offset, None)
+
+    def has(self, offset):
+        return offset in self.lists
+
+class _ChildReader(object):
+    def __init__(self, di):
+        get_buffer = lambda sec: sec.stream.getbuffer() if sec else None
+        self.info = get_buffer(di.debug_info_sec)
+        self.str = get_buffer(di.debug_str_sec)
+        self.line_str = get_buffer(getattr(di, 'debug_line_str_sec', None))
+        self.str_offsets = get_buffer(getattr(di, 'debug_str_offsets_sec', None))
+        self.plans = dict() # CU offset to abbrev code to (tag, has_children, skip plan, name form)
+
+    # The plan is the sizes of the attribute values before the name
+    def make_plan(self, abbrev, p):
+        skip = []
+        for spec in abbrev['attr_spec']:
+            if spec.name == 'DW_AT_name':
+                return (abbrev['tag'], abbrev.has_children(), tuple(skip), spec.form)
+            if spec.form == 'DW_FORM_indirect':
+                raise UnsupportedFormError(spec.form)
+            skip.append(form_size(spec.form, p.address_size, p.offset_size, p.version))
+        return (abbrev['tag'], abbrev.has_children(), (), None)
+
+    # Same as DIE_name(), or None where DIE_has_name() would say no
+    def read_name(self, pos, form, p):
+        buf = self.info
+        osz = p.offset_size
+        bo = p.byteorder
+        if form == 'DW_FORM_string':
+            s = read_cstring(buf, pos)
+        elif form == 'DW_FORM_strp':
+            s = read_cstring(self.str, int.from_bytes(buf[pos:pos+osz], bo))
+        elif form == 'DW_FORM_line_strp':
+            s = read_cstring(self.line_str, int.from_bytes(buf[pos:pos+osz], bo))
+        elif form == 'DW_FORM_strx' or form in _strx_sizes:
+            if form == 'DW_FORM_strx':
+                (index, pos) = read_uleb(buf, pos)
+            else:
+                size = _strx_sizes[form]
+                index = int.from_bytes(buf[pos:pos+size], bo)
+            if p.str_offsets_base is None or self.str_offsets is None:
+                raise UnsupportedFormError(form)
+            o = p.str_offsets_base + index*osz
+            s = read_cstring(self.str, int.from_bytes(self.str_offsets[o:o+osz], bo))
+        elif form in ('DW_FORM_strp_sup', 'DW_FORM_GNU_strp_alt', 'DW_FORM_GNU_str_index'):
+            raise UnsupportedFormError(form) # A string, but not one we can get to
+        else:
+            return None
+        return s.decode('utf-8', errors='ignore')
+
+    # Returns a list of (offset, tag, name, has_children) for the first CHUNK of children of the DIE at the offset,
+    # and the DIE index position of the next child if there are more, or None if not possible
+    def read_children(self, cu, p, offset):
+        index = cu._dieindex
+        if index is None:
+            index = scan_die_index(cu)
+            if index is None:
+                return None
+            if cu._dieindex is None: # The UI thread might have built one meanwhile
+                cu._dieindex = index
+        elif index is False:
+            return None
+        i = index.find(offset)
+        if i < 0:
+            return None
+        buf = self.info
+        plans = self.plans.setdefault(p.cu_offset, dict())
+        offsets = index.offsets
+        ends = index.ends
+        n = len(offsets)
+        end = ends[i]
+        children = []
+        j = i + 1
+        while j < n and offsets[j] < end:
+            if len(children) == CHUNK:
+                return (children, j)
+            child_offset = offsets[j]
+            (code, pos) = read_uleb(buf, child_offset)
+            plan = plans.get(code)
+            if plan is None:
+                plan = plans[code] = self.make_plan(p.abbrevs.get_abbrev(code), p)
+            (tag, has_children, skip, name_form) = plan
+            name = None
+            if name_form:
+                for item in skip:
+                    if item >= 0:
+                        pos += item
+                    else:
+                        pos = skip_value(buf, pos, item, p.byteorder, p.address_size, p.offset_size, p.version)
+                name = self.read_name(pos, name_form, p)
+            children.append((child_offset, tag, name, has_children))
+            j = bisect_left(offsets, ends[j], j + 1) # The next sibling
+        return (children, None)
+
+    def release(self):
+        self.info = self.str = self.line_str = self.str_offsets = None
+
+class PrefetchThread(QThread):
+    # Construct and control from the main thread
+    def __init__(self, parent, di):
+        QThread.__init__(self, parent)
+        self.results = di._prefetched
+        self.reader = _ChildReader(di)
+        self.params = dict() # CU offset to CUParams
+        self.cond = threading.Condition()
+        self.queue = [] # (CU, CUParams, DIE offset), in the order of priority
+        self.stopped = False
+
+    # Nodes are DIENodes, in the order of priority
+    def prefetch(self, nodes):
+        targets = []
+        for node in nodes:
+            cu = node.cu
+            if cu['version'] < 2 or self.results.has(node.offset):
+                continue
+            p = self.params.get(cu.cu_offset)
+            if p is None:
+                p = self.params[cu.cu_offset] = CUParams(cu) # Loads the abbreviations, on this thread
+            targets.append((cu, p, node.offset))
+        with self.cond:
+            self.queue = targets
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.queue = []
+            self.cond.notify()
+        self.wait()
+
+    def run(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.stopped:
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                    (cu, p, offset) = self.queue.pop(0)
+                try:
+                    children = self.reader.read_children(cu, p, offset)
+                except (UnsupportedFormError, KeyError, IndexError, ValueError, AttributeError):
+                    children = None # The UI thread will parse those
+                if children is not None:
+                    self.results.put(offset, children)
+        finally:
+            self.reader.release()
+
+# The nodes whose children are worth reading ahead, when the selection is on the node
+# The selection, its siblings from the closest out, the adjacent CUs
+def nodes_to_prefetch(node, top_nodes):
+    nodes = [node]
+    siblings = node.parent._children if node.parent else top_nodes
+    i = node._i
+    for d in range(1, MAX_SIBLINGS+1):
+        if i + d < len(siblings):
+            nodes.append(siblings[i + d])
+        if i - d >= 0:
+            nodes.append(siblings[i - d])
+    if node.parent:
+        cu_i = node.cu._i
+        for j in (cu_i + 1, cu_i - 1):
+            if 0 <= j < len(top_nodes):
+                nodes.append(top_nodes[j])
+    return [n for n in nodes if n.has_children and n._children is None]
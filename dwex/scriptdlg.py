@@ -1,6 +1,7 @@
 from PyQt6.QtCore import Qt
 from PyQt6.QtWidgets import *
-from elftools.dwarf.locationlists import LocationParser
+
+from .condition import Condition
 
 class ScriptDlg(QDialog):
     def __init__(self, win, sample_die):
@@ -35,20 +36,20 @@ class ScriptDlg(QDialog):
                 "Please provide a Python expression that inspects the \"die\" object.", QMessageBox.StandardButton.Ok, self).show()
         else:
             try:
-                self.cond = compile(self.py, 'inline', 'eval')
+                self.cond = Condition(self.py)
             except Exception as exc:
                 QMessageBox(QMessageBox.Icon.Warning, "Python error",
                     "Python syntax error: " + format(exc), QMessageBox.StandardButton.Ok, self).show()
                 return
             
             try:
-                env = make_execution_environment(self.sample_die)
+                env = self.cond.environment(self.sample_die)
             except Exception: #Our error - do not surface
                 QDialog.accept(self)
                 return
 
             try:
-                eval(self.cond, env)
+                eval(self.cond.code, env)
             except Exception as exc:
                 mb = QMessageBox(QMessageBox.Icon.Question, "Python error",
                     "Python execution error (%s) on a sample DIE. Use anyway?\n\n%s" % (type(exc).__name__, format(exc)),
@@ -58,31 +59,3 @@ class ScriptDlg(QDialog):
                     return
             
             QDialog.accept(self)
-
-def make_execution_environment(die):
-    def has_attribute(func):
-        for k in die.attributes:
-            if func(k, die.attributes[k].value, die.attributes[k].form):
-                return True
-            
-    def has_loclist():
-        ver = die.cu.header.version
-        def attr_is_loclist(attr):
-            return (LocationParser._attribute_is_loclistptr_class(attr) and
-                LocationParser._attribute_has_loc_list(attr, ver))
-        g = (a for a in die.attributes if attr_is_loclist(die.attributes[a]))
-        return bool(next(g, False))
-            
-    d = {'die' : die,
-            'tag': 'user_%X' % (die.tag,) if isinstance(die.tag, int) else die.tag[7:],
-            'attr': die.attributes,
-            'has_attribute' : has_attribute,
-            'has_loclist' : has_loclist}
-    for k, a in die.attributes.items():
-        d['user_%X' % (k,) if isinstance(k, int) else k[6:]] = a.value
-    return d
-            
-
-
-    
-        
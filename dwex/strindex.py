@@ -0,0 +1,289 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from PyQt6.QtCore import QThread
+
+from .dieindex import form_size, skip_value, read_uleb, UnsupportedFormError
+
+# Inverted index of the attribute text, for Find and Highlight by substring.
+#
+# The text search in TheWindow.findbytext matches against the attribute names, forms,
+# and the values as strings, for every attribute. The index covers the string values,
+# the flag values, and the names and forms. The latter come from the abbrev: every abbrev
+# gets a line per attribute with its name, form, and "true" for DW_FORM_flag_present, and
+# that text is indexed like a string value of every DIE with that abbrev.
+# Numeric values are not covered, so the index is not used for search strings that might
+# be in the text of a number - see StringIndex.can_answer().
+#
+# The distinct texts, lowercased and in the same form as findbytext sees them, are glued
+# into one big text for str.find(). For every text, there's a list of DIE offsets
+# that have it.
+#
+# Built in a background thread from the raw section bytes, without pyelftools DIE objects,
+# so that it doesn't step on the parsing that the UI is doing in the meantime.
+
+_string_forms = set(('DW_FORM_string', 'DW_FORM_strp', 'DW_FORM_line_strp',
+    'DW_FORM_strx', 'DW_FORM_strx1', 'DW_FORM_strx2', 'DW_FORM_strx3', 'DW_FORM_strx4'))
+_strx_sizes = {'DW_FORM_strx1': 1, 'DW_FORM_strx2': 2, 'DW_FORM_strx3': 3, 'DW_FORM_strx4': 4}
+
+# Characters that could be in a str()/hex() of a number or of a list of numbers
+_numeric_chars = set('0123456789abcdefx-[], ')
+
+class StringIndex(object):
+    # text is the strings joined with newlines, starts are the positions of the strings in the text,
+    # DIE offsets for the string #i are in die_offsets[post_starts[i]:post_starts[i+1]]
+    # covered_CUs are the offsets of the CUs that were indexed completely
+    def __init__(self, text, starts, post_starts, die_offsets, covered_CUs):
+        self.text = text
+        self.starts = starts
+        self.post_starts = post_starts
+        self.die_offsets = die_offsets
+        self.covered_CUs = covered_CUs
+
+    # s is lowercase, as in findbytext
+    def can_answer(self, s):
+        return bool(s) and not set(s) <= _numeric_chars and '\n' not in s
+
+    # Returns a StringMatches, or None if the index can't answer this one
+    def search(self, s):
+        if not self.can_answer(s):
+            return None
+        text = self.text
+        starts = self.starts
+        offsets = array('Q')
+        pos = text.find(s)
+        while pos >= 0:
+            i = bisect_right(starts, pos) - 1
+            offsets.extend(self.die_offsets[self.post_starts[i]:self.post_starts[i+1]])
+            if i + 1 >= len(starts):
+                break
+            pos = text.find(s, starts[i+1]) # Next string
+        return StringMatches(self, array('Q', sorted(set(offsets))))
+
+class StringMatches(object):
+    def __init__(self, index, offsets):
+        self.covered_CUs = index.covered_CUs
+        self.offsets = offsets
+
+    def covers(self, cu):
+        return cu.cu_offset in self.covered_CUs
+
+    # Offsets of the matching DIEs in the CU, in order, or None if the CU is not in the index
+    # For DWARFTreeModel.find()
+    def candidates(self, cu):
+        if cu.cu_offset not in self.covered_CUs:
+            return None
+        offsets = self.offsets
+        return offsets[bisect_left(offsets, cu.cu_offset):bisect_left(offsets, cu.cu_offset + cu.size)]
+
+    # Assumes the DIE's CU is covered
+    def contains(self, die):
+        offsets = self.offsets
+        i = bisect_left(offsets, die.offset)
+        return i < len(offsets) and offsets[i] == die.offset
+
+# Everything the scan of a CU needs, gathered on the main thread.
+# The CU objects themselves are not touched from the background.
+class CUParams(object):
+    def __init__(self, cu):
+        self.cu_offset = cu.cu_offset
+        self.die_offset = cu.cu_die_offset
+        self.end = cu.cu_offset + cu.size
+        self.address_size = cu['address_size']
+        self.offset_size = 8 if cu.structs.dwarf_format == 64 else 4
+        self.version = cu['version']
+        self.byteorder = 'little' if cu.structs.little_endian else 'big'
+        self.abbrevs = cu.get_abbrev_table()
+        top_die = cu.get_top_DIE()
+        attr = top_die.attributes.get('DW_AT_str_offsets_base')
+        self.str_offsets_base = attr.value if attr else None
+
+def read_cstring(buf, pos):
+    end = pos
+    while True:
+        chunk = bytes(buf[end:end+256])
+        i = chunk.find(b'\x00')
+        if i >= 0:
+            return bytes(buf[pos:end+i])
+        if len(chunk) < 256:
+            raise IndexError()
+        end += 256
+
+class _Builder(object):
+    def __init__(self, di, cancelled):
+        self.cancelled = cancelled
+        self.has_sup = bool(di.supplementary_dwarfinfo)
+        self.params = [CUParams(cu) for cu in di._unsorted_CUs if cu['version'] >= 2]
+        get_buffer = lambda sec: sec.stream.getbuffer() if sec else None
+        self.info = get_buffer(di.debug_info_sec)
+        self.str = get_buffer(di.debug_str_sec)
+        self.line_str = get_buffer(getattr(di, 'debug_line_str_sec', None))
+        self.str_offsets = get_buffer(getattr(di, 'debug_str_offsets_sec', None))
+        self.ids = dict() # Text to string ID
+        self.texts = []
+        self.flag_ids = (self.value_id('false'), self.value_id('true'))
+        self.strp_ids = dict() # Offset in debug_str to string ID
+        self.line_strp_ids = dict()
+        self.entry_ids = array('L') # These two are (string ID, DIE offset) pairs
+        self.entry_offsets = array('Q')
+
+    def text_id(self, b):
+        return self.value_id(str(b).lower()) # Exactly like findbytext sees it
+
+    def value_id(self, text):
+        id = self.ids.get(text)
+        if id is None:
+            id = self.ids[text] = len(self.texts)
+            self.texts.append(text)
+        return id
+
+    def str_id(self, offset):
+        id = self.strp_ids.get(offset)
+        if id is None:
+            id = self.strp_ids[offset] = self.text_id(read_cstring(self.str, offset))
+        return id
+
+    # Returns (ID of the names text or None, plan)
+    def make_plan(self, abbrev, p):
+        plan = []
+        fixed = 0
+        names = []
+        for spec in abbrev['attr_spec']:
+            form = spec.form
+            names.append('%s\n%s' % (spec.name, form))
+            if form == 'DW_FORM_flag_present':
+                names.append('true')
+            if form in _string_forms or form == 'DW_FORM_flag':
+                size = form
+            elif form == 'DW_FORM_indirect' or (self.has_sup and form in ('DW_FORM_GNU_strp_alt', 'DW_FORM_strp_sup')):
+                raise UnsupportedFormError(form) # Could be a string that we can't get to
+            else:
+                size = form_size(form, p.address_size, p.offset_size, p.version)
+            if isinstance(size, int) and size >= 0:
+                fixed += size
+            else:
+                if fixed:
+                    plan.append(fixed)
+                    fixed = 0
+                plan.append(size)
+        if fixed:
+            plan.append(fixed)
+        return (self.value_id('\n'.join(names).lower()) if names else None, tuple(plan))
+
+    # Returns False if the CU can't be indexed completely
+    def scan_cu(self, p):
+        buf = self.info
+        osz = p.offset_size
+        bo = p.byteorder
+        plans = dict()
+        entry_ids = self.entry_ids
+        entry_offsets = self.entry_offsets
+        pos = p.die_offset
+        while pos < p.end:
+            die_offset = pos
+            (code, pos) = read_uleb(buf, pos)
+            if code == 0:
+                continue
+            plan = plans.get(code)
+            if plan is None:
+                plan = plans[code] = self.make_plan(p.abbrevs.get_abbrev(code), p)
+            if plan[0] is not None:
+                entry_ids.append(plan[0])
+                entry_offsets.append(die_offset)
+            for item in plan[1]:
+                if isinstance(item, str):
+                    if item == 'DW_FORM_flag':
+                        id = self.flag_ids[buf[pos] != 0]
+                        pos += 1
+                    elif item == 'DW_FORM_string':
+                        s = read_cstring(buf, pos)
+                        pos += len(s) + 1
+                        id = self.text_id(s)
+                    elif item == 'DW_FORM_strp':
+                        id = self.str_id(int.from_bytes(buf[pos:pos+osz], bo))
+                        pos += osz
+                    elif item == 'DW_FORM_line_strp':
+                        offset = int.from_bytes(buf[pos:pos+osz], bo)
+                        pos += osz
+                        id = self.line_strp_ids.get(offset)
+                        if id is None:
+                            id = self.line_strp_ids[offset] = self.text_id(read_cstring(self.line_str, offset))
+                    else: # strx
+                        if item == 'DW_FORM_strx':
+                            (index, pos) = read_uleb(buf, pos)
+                        else:
+                            size = _strx_sizes[item]
+                            index = int.from_bytes(buf[pos:pos+size], bo)
+                            pos += size
+                        if p.str_offsets_base is None or self.str_offsets is None:
+                            return False
+                        o = p.str_offsets_base + index*osz
+                        id = self.str_id(int.from_bytes(self.str_offsets[o:o+osz], bo))
+                    entry_ids.append(id)
+                    entry_offsets.append(die_offset)
+                elif item >= 0:
+                    pos += item
+                else:
+                    pos = skip_value(buf, pos, item, bo, p.address_size, osz, p.version)
+        return True
+
+    # Returns a StringIndex, or None if cancelled
+    def build(self):
+        covered = set()
+        for p in self.params:
+            if self.cancelled():
+                return None
+            n = len(self.entry_ids)
+            try:
+                ok = self.scan_cu(p)
+            except (UnsupportedFormError, KeyError, IndexError, ValueError):
+                ok = False
+            if ok:
+                covered.add(p.cu_offset)
+            else: # Drop the partial results, the CU will be searched the slow way
+                del self.entry_ids[n:]
+                del self.entry_offsets[n:]
+
+        # Group the DIE offsets by string - counting sort
+        texts = self.texts
+        count = len(texts)
+        post_starts = array('Q', bytes(8*(count+1)))
+        for id in self.entry_ids:
+            post_starts[id+1] += 1
+        for i in range(count):
+            post_starts[i+1] += post_starts[i]
+        fill = array('Q', post_starts)
+        die_offsets = array('Q', bytes(8*len(self.entry_ids)))
+        for (id, offset) in zip(self.entry_ids, self.entry_offsets):
+            die_offsets[fill[id]] = offset
+            fill[id] += 1
+
+        starts = array('Q')
+        pos = 0
+        for text in texts:
+            starts.append(pos)
+            pos += len(text) + 1
+        return StringIndex('\n'.join(texts), starts, post_starts, die_offsets, frozenset(covered))
+
+    def release(self):
+        self.info = self.str = self.line_str = self.str_offsets = None
+
+class StringIndexThread(QThread):
+    # Construct on the main thread - it captures what it needs from the DWARFInfo
+    def __init__(self, parent, di):
+        QThread.__init__(self, parent)
+        self.cancelled = False
+        self.index = None
+        self.exc = None
+        self.dwarfinfo = di
+        self.builder = _Builder(di, lambda: self.cancelled)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            self.index = self.builder.build()
+        except Exception as exc:
+            self.exc = exc
+        finally:
+            self.builder.release()
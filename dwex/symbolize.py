@@ -0,0 +1,244 @@
+import sys, json, argparse
+from collections import OrderedDict
+
+from .formats import read_dwarf, recall_slice
+from .linetable import get_line_table
+from .dwarfutil import decorate_dwarfinfo, find_cu_by_address, get_inline_frames, follow_function_spec, retrieve_function_names, safe_DIE_name, strip_path
+
+# Command line symbolizer, along the lines of addr2line, on top of the same DWARF logic as the UI.
+# No Qt here.
+#
+# python -m dwex.symbolize -e binary [options] [addresses]
+#
+# Addresses come from the command line, or from a file, or from stdin, one or more per line, hex,
+# with or without the 0x prefix. The output is like addr2line's, or one JSON object per address
+# with --json. Addresses are resolved in batches, sorted, so that the lookups go CU by CU,
+# and the results are cached - crash logs repeat themselves.
+
+MAX_CACHED_RESULTS = 65536 # Addresses kept by Symbolizer, least recently used out
+
+# Same decorations as TheWindow.load_dwarfinfo, minus the UI ones
+def prepare_dwarfinfo(di):
+    decorate_dwarfinfo(di)
+    try:
+        di._aranges = di.get_aranges()
+    except Exception: # Missing or corrupt - we'll go by the top DIEs
+        di._aranges = None
+    return di
+
+class Frame(object):
+    def __init__(self, name, linkage_name, file, line, inlined, discriminator = 0):
+        self.name = name
+        self.linkage_name = linkage_name
+        self.file = file
+        self.line = line
+        self.inlined = inlined
+        self.discriminator = discriminator
+
+class Symbolizer(object):
+    def __init__(self, di):
+        self.di = di
+        self.results = OrderedDict() # Address to a list of frames, innermost first
+        self.names = dict() # Function DIE offset to (name, linkage_name)
+        self.paths = dict() # (CU offset, file number) to file path
+
+    def function_names(self, die):
+        names = self.names.get(die.offset)
+        if names is None:
+            try:
+                (origin, spec) = follow_function_spec(die)
+            except Exception: # Broken reference
+                (origin, spec) = (die, die)
+            # The linkage name can be on any of them, retrieve_function_names only looks at the spec
+            linkage_name = next((d.attributes[a].value.decode('UTF-8', errors='ignore') for d in (die, origin, spec)
+                for a in ('DW_AT_linkage_name', 'DW_AT_MIPS_linkage_name') if a in d.attributes), None)
+            try:
+                # Same as LocalsDlg - the inlines are named by the abstract origin
+                (name, mangled_name) = retrieve_function_names(spec, die if die.tag != 'DW_TAG_inlined_subroutine' else origin)
+            except Exception: # The full name didn't work out, but the linkage name is still there
+                (name, mangled_name) = (linkage_name or safe_DIE_name(spec, None), None)
+            names = self.names[die.offset] = (name or linkage_name or '??', linkage_name or mangled_name or name or '??')
+        return names
+
+    def file_path(self, cu, file):
+        if file is None:
+            return None
+        key = (cu.cu_offset, file)
+        if key in self.paths:
+            return self.paths[key]
+        lt = get_line_table(cu)
+        attr = cu.get_top_DIE().attributes
+        comp_dir = attr['DW_AT_comp_dir'].value if 'DW_AT_comp_dir' in attr else None
+        cu_name = attr['DW_AT_name'].value if 'DW_AT_name' in attr else None
+        try:
+            path = lt.file_path(file, comp_dir, cu_name) if lt is not None else None
+        except (IndexError, AttributeError, TypeError): # Malformed line program header
+            path = None
+        path = self.paths[key] = path.decode('utf-8', errors='replace') if path is not None else None
+        return path
+
+    # Returns a list of frames, innermost first, empty if nothing found
+    def symbolize(self, address):
+        results = self.results
+        frames = results.get(address)
+        if frames is not None:
+            results.move_to_end(address)
+        else:
+            frames = []
+            cu = find_cu_by_address(self.di, address)
+            if cu is not None:
+                for (die, file, line) in get_inline_frames(cu, address):
+                    (name, linkage_name) = self.function_names(die)
+                    frames.append(Frame(name, linkage_name, self.file_path(cu, file), line, die.tag == 'DW_TAG_inlined_subroutine'))
+                if frames: # The discriminator only makes sense for the line of the address
+                    lt = get_line_table(cu)
+                    row = lt.find(address) if lt is not None else -1
+                    frames[0].discriminator = lt.discriminators[row] if row >= 0 else 0
+            results[address] = frames
+            if len(results) > MAX_CACHED_RESULTS:
+                results.popitem(False)
+        return frames
+
+    # Addresses are resolved in the sorted order, returned in the original one
+    # The batch may be larger than the cache, so its results are kept aside
+    def symbolize_batch(self, addresses):
+        frames = {address: self.symbolize(address) for address in sorted(set(a for a in addresses if a is not None))}
+        return [frames[a] if a is not None else None for a in addresses]
+
+def parse_address(s):
+    try:
+        return int(s[2:] if s.lower().startswith('0x') else s, 16)
+    except ValueError:
+        return None
+
+class Output(object):
+    def __init__(self, args, address_size):
+        self.args = args
+        self.address_width = address_size*2
+
+    def location(self, frame):
+        if frame.file is None:
+            return '??:0'
+        file = strip_path(frame.file) if self.args.basenames else frame.file
+        s = '%s:%s' % (file, frame.line if frame.line else '?')
+        return s + ' (discriminator %d)' % (frame.discriminator,) if frame.discriminator else s
+
+    def function(self, frame):
+        return frame.name if self.args.demangle else frame.linkage_name
+
+    def write(self, out, text, address, frames):
+        args = self.args
+        if args.json:
+            r = {'address': text}
+            if address is None:
+                r['error'] = 'Not a hex address'
+            else:
+                r['frames'] = [{'function': f.name, 'linkage_name': f.linkage_name, 'file': f.file, 'line': f.line,
+                    'discriminator': f.discriminator, 'inlined': f.inlined} for f in frames]
+            out.write(json.dumps(r) + '\n')
+            return
+
+        # addr2line format
+        if not frames:
+            frames = (Frame('??', '??', None, None, False),)
+        if not args.inlines:
+            frames = frames[:1] # The innermost inline, like addr2line
+        lines = []
+        prefix = ''
+        if args.addresses:
+            addr = '0x%0*x' % (self.address_width, address) if address is not None else text
+            if args.pretty_print:
+                prefix = addr + ': '
+            else:
+                lines.append(addr)
+        for (i, f) in enumerate(frames):
+            if args.pretty_print:
+                s = (self.function(f) + ' at ' if args.functions else '') + self.location(f)
+                lines.append((prefix if i == 0 else ' (inlined by) ') + s)
+            else:
+                if args.functions:
+                    lines.append(self.function(f))
+                lines.append(self.location(f))
+        out.write('\n'.join(lines) + '\n')
+
+def read_addresses(args):
+    if args.address:
+        yield args.address
+    elif args.input:
+        with open(args.input, 'r') as f:
+            for line in f:
+                yield line.split()
+    else:
+        for line in sys.stdin:
+            yield line.split()
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m dwex.symbolize',
+        description='Converts code addresses to function names and source lines, like addr2line.')
+    parser.add_argument('-e', '--exe', required=True, help='The binary with DWARF in it')
+    parser.add_argument('--slice', help='For fat binaries and static libraries: arch, or arch:member, or member')
+    parser.add_argument('-a', '--addresses', action='store_true', help='Show the address before the results')
+    parser.add_argument('-f', '--functions', action='store_true', help='Show the function names')
+    parser.add_argument('-i', '--inlines', action='store_true', help='Unwind the inlined functions too')
+    parser.add_argument('-p', '--pretty-print', action='store_true', help='One line per address, more or less')
+    parser.add_argument('-s', '--basenames', action='store_true', help='Strip the directories from the file names')
+    parser.add_argument('-C', '--demangle', action='store_true', help='Human readable function names, rather than linkage ones')
+    parser.add_argument('-j', '--json', action='store_true', help='JSON Lines output, with the whole inline chain')
+    parser.add_argument('-b', '--load-address', help='The address the module was loaded at, if not the preferred one (hex)')
+    parser.add_argument('--input', help='Read the addresses from a file rather than from stdin')
+    parser.add_argument('--batch-size', type=int, default=4096, help='Addresses to resolve at a time, reading from a file or a pipe')
+    parser.add_argument('address', nargs='*', help='Addresses (hex); if none, read from stdin')
+    args = parser.parse_args()
+
+    from .patch import monkeypatch
+    monkeypatch()
+
+    slice_code = None
+    if args.slice:
+        slice_code = tuple(args.slice.split(':', 1))
+    def no_slice(slices, title, text):
+        raise ValueError('This is a fat binary or a static library, please specify --slice. The choices are: ' +
+            ', '.join(a if isinstance(a, str) else a[0] + ':' + '|'.join(a[1]) for a in slices))
+    try:
+        di = read_dwarf(args.exe, recall_slice(slice_code) if slice_code else no_slice, True)
+    except Exception as exc:
+        print("%s: %s" % (args.exe, format(exc)), file=sys.stderr)
+        return 1
+    if not di:
+        print("%s: no DWARF information found, or the format is not supported" % (args.exe,), file=sys.stderr)
+        return 1
+    prepare_dwarfinfo(di)
+
+    delta = 0 # Added to the addresses to get the ones at the preferred load address
+    if args.load_address:
+        load_address = parse_address(args.load_address)
+        if load_address is None:
+            print("Bad load address: " + args.load_address, file=sys.stderr)
+            return 1
+        delta = (getattr(di, '_start_address', None) or 0) - load_address
+
+    sym = Symbolizer(di)
+    output = Output(args, di.config.default_address_size)
+    out = sys.stdout
+    # Interactive - don't wait for a batch to fill up
+    batch_size = 1 if not args.address and not args.input and sys.stdin.isatty() else max(args.batch_size, 1)
+
+    batch = [] # Address texts
+    def flush():
+        addresses = [parse_address(s) for s in batch]
+        results = sym.symbolize_batch([a + delta if a is not None else None for a in addresses])
+        for (text, address, frames) in zip(batch, addresses, results):
+            output.write(out, text, address, frames)
+        out.flush()
+        del batch[:]
+
+    for texts in read_addresses(args):
+        batch += texts
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
+import time
 from bisect import bisect_left, bisect_right
 from typing import Union
-from PyQt6.QtCore import Qt, QAbstractItemModel, QModelIndex
+from PyQt6.QtCore import Qt, QAbstractItemModel, QModelIndex, QTimer
 from PyQt6.QtWidgets import QApplication
 
 from elftools.dwarf.die import DIE
@@ -9,9 +10,16 @@ from elftools.dwarf.compileunit import CompileUnit
 from .fx import bold_font, blue_brush
 from .dwarfutil import DIE_has_name, DIE_name, has_code_location, safe_DIE_name, top_die_file_name
 from .dwarfone import DIEV1
+from .dieindex import find_DIE, iter_DIEs_back, get_die_index
+from .diecache import touch_CU
+from .highlight import Highlights
 
 
 def cu_sort_key(cu):
+    # CU names are cached by load_dwarfinfo in the same order as _CU_offsets, possibly from the index cache
+    di = cu.dwarfinfo
+    if getattr(di, '_cu_names', None):
+        return di._cu_names[bisect_left(di._CU_offsets, cu.cu_offset)].lower()
     return top_die_file_name(cu.get_top_DIE()).lower()
 
 def die_sort_key(die):
@@ -19,6 +27,10 @@ def die_sort_key(die):
     tag = '%X' % die.tag if isinstance(die.tag, int) else die.tag
     return (tag, name, die.offset)
 
+def node_sort_key(node):
+    tag = '%X' % node.tag if isinstance(node.tag, int) else node.tag
+    return (tag, node.name or '', node.offset)
+
 #------------------------------------------------
 # CU tree formatter
 #------------------------------------------------    
@@ -29,9 +41,107 @@ def decorate_die(die, i):
     die._children = None
     return die
 
+# What the tree keeps for every DIE that it shows - just enough to display and sort it.
+# A fully expanded large CU used to mean as many pyelftools DIEs, each with its OrderedDict of attributes,
+# alive for as long as the file was open. The children of a node are parsed when the node is expanded,
+# and only the tag, the name and the has children bit are kept.
+# The DIE proper is looked up by offset when someone needs it - the selection, the attribute table, highlights.
+class DIENode(object):
+    __slots__ = ('cu', 'offset', 'tag', 'name', 'has_children', 'parent', '_i', '_children', '_more', '_text', '_hl')
+
+    def __init__(self, cu, offset, tag, name, has_children, parent, i):
+        self.cu = cu
+        self.offset = offset
+        self.tag = tag
+        self.name = name
+        self.has_children = has_children
+        self.parent = parent
+        self._i = i
+        self._children = None # List of nodes once loaded
+        self._more = None # DIE index position of the first child that's not loaded, if the list is partial
+        self._text = None # Display string, once painted
+        self._hl = None # (highlight generation, is highlighted), once painted with highlights on
+
+    @property
+    def die(self):
+        # The top DIE is always in the CU's cache, no need for the index
+        return find_DIE(self.cu, self.offset) if self.parent else self.cu.get_top_DIE()
+
+def node_from_DIE(die, parent, i):
+    return DIENode(die.cu, die.offset, die.tag, DIE_name(die) if DIE_has_name(die) else None, die.has_children, parent, i)
+
+CHUNK = 1000 # Child nodes loaded at a time
+HL_POLL_INTERVAL = 100 # Milliseconds, while the highlights are being evaluated in the worker processes
+
+# The top nodes start out as placeholders. Parsing every top DIE, and the abbreviation table with it,
+# was most of the time it took to open a binary with many CUs. The rows that Qt asks about are filled
+# on demand, the rest in the idle time, see DWARFTreeModel.load_top_nodes().
+def top_node_placeholder(cu, i):
+    return DIENode(cu, cu.cu_die_offset, None, None, True, None, i)
+
+def load_top_node(node):
+    if node.tag is None:
+        die = node.cu.get_top_DIE()
+        node.tag = die.tag
+        node.name = DIE_name(die) if DIE_has_name(die) else None
+        node.has_children = die.has_children
+
+# Children of the node, count at most, starting with the one at the position j in the DIE index,
+# None for the first one. Returns the nodes and the position of the child after them, or None if no more.
+# With the DIE index, they are parsed on the side, not into the CU's DIE cache, and not linked to the parent
+# Without one (DWARFv1, or a CU that the index scanner can't handle), it's the regular cached iteration, all at once
+def parse_child_nodes(node, j, count):
+    cu = node.cu
+    index = get_die_index(cu)
+    i = index.find(node.offset) if index else -1
+    if i < 0:
+        return ([node_from_DIE(die, node, 0) for die in node.die.iter_children()], None)
+    stream = cu.get_top_DIE().stream
+    offsets = index.offsets
+    ends = index.ends
+    n = len(offsets)
+    end = ends[i]
+    if j is None:
+        j = i + 1
+    nodes = []
+    while j < n and offsets[j] < end:
+        if len(nodes) == count:
+            return (nodes, j)
+        nodes.append(node_from_DIE(DIE(cu, stream, offsets[j]), node, 0))
+        j = bisect_left(offsets, ends[j], j + 1) # The next sibling
+    return (nodes, None)
+
+def number_nodes(nodes, start = 0):
+    for (i, node) in enumerate(nodes, start):
+        node._i = i
+
+# Same as load_children, for tree nodes
+# Loads the first CHUNK of children, see DWARFTreeModel.fetchMore() for the rest
+def load_child_nodes(parent_node: DIENode, sort: bool):
+    if parent_node._children is None:
+        cu = parent_node.cu
+        prefetched = getattr(cu.dwarfinfo, '_prefetched', None)
+        prefetched = prefetched.take(parent_node.offset) if prefetched else None
+        touch_CU(cu)
+        try:
+            if prefetched is not None: # Read ahead in the background, see prefetch.py
+                (children, parent_node._more) = prefetched
+                parent_node._children = [DIENode(cu, offset, tag, name, has_children, parent_node, 0)
+                    for (offset, tag, name, has_children) in children]
+            else:
+                (parent_node._children, parent_node._more) = parse_child_nodes(parent_node, None, CHUNK)
+            if sort:
+                parent_node._children.sort(key = node_sort_key)
+            number_nodes(parent_node._children)
+        except KeyError as exc:
+            report_bad_children(exc, parent_node.cu)
+            parent_node._children = []
+            parent_node._more = None
+
 def load_children(parent_die: Union[DIE, DIEV1] , sort: bool): #(parent_die: Union[DIE, DIEV1] , sort: bool):
     # Load and cache child DIEs in the parent DIE, if necessary
     # Assumes the check if the DIE has children has been already performed
+    # The tree doesn't use this anymore, see load_child_nodes. The C skeleton export does.
     if not hasattr(parent_die, "_children") or parent_die._children is None:
         # TODO: wait cursor here.
         try:
@@ -41,231 +151,404 @@ def load_children(parent_die: Union[DIE, DIEV1] , sort: bool): #(parent_die: Uni
                 for (i, die) in enumerate(parent_die._children):
                     die._i = i
         except KeyError as exc:
-            # Catching #1516
-            from .__main__ import version
-            from .crash import report_crash
-            from inspect import currentframe
-            tb = exc.__traceback__
-            ctxt = dict()
-            try:
-                cu = parent_die.cu
-                ctxt['cu_offset'] = cu.cu_offset
-                ctxt['dwarf_config'] = cu.dwarfinfo.config
-                abbrev_codes = set(d.abbrev_code for d in cu._dielist if not d.is_null())
-                at = cu.get_abbrev_table()
-                format_attr_in_abbrev = lambda a: (a.name, a.form, a.value) if a.value is not None else (a.name, a.form)
-                format_abbr = lambda ab: (ab.decl.tag, ab._has_children, tuple(format_attr_in_abbrev(a) for a in ab.decl.attr_spec))
-                ctxt['abbrevs'] = {c: format_abbr(at.get_abbrev(c)) for c in abbrev_codes}
-                stm = cu.dwarfinfo.debug_info_sec.stream
-                crash_pos = ctxt['crash_pos'] = stm.tell()
-                slice = stm.getbuffer()[cu.cu_offset:crash_pos+1]
-                ctxt['cu_in_info'] =  ' '.join("%02x" % b for b in slice)
-            except Exception:
-                pass
-            report_crash(exc, tb, version, currentframe(), ctxt)
-
-            QApplication.instance().win.show_warning("This executable file is corrupt or incompatible with the current version of DWARF Explorer. Please consider creating a new issue at https://github.com/sevaa/dwex/, and share this file with the tech support.")
+            report_bad_children(exc, parent_die.cu)
             parent_die._children = []
 
+# Catching #1516
+def report_bad_children(exc, cu):
+    from .__main__ import version
+    from .crash import report_crash
+    from inspect import currentframe
+    tb = exc.__traceback__
+    ctxt = dict()
+    try:
+        ctxt['cu_offset'] = cu.cu_offset
+        ctxt['dwarf_config'] = cu.dwarfinfo.config
+        abbrev_codes = set(d.abbrev_code for d in cu._dielist if not d.is_null())
+        at = cu.get_abbrev_table()
+        format_attr_in_abbrev = lambda a: (a.name, a.form, a.value) if a.value is not None else (a.name, a.form)
+        format_abbr = lambda ab: (ab.decl.tag, ab._has_children, tuple(format_attr_in_abbrev(a) for a in ab.decl.attr_spec))
+        ctxt['abbrevs'] = {c: format_abbr(at.get_abbrev(c)) for c in abbrev_codes}
+        stm = cu.dwarfinfo.debug_info_sec.stream
+        crash_pos = ctxt['crash_pos'] = stm.tell()
+        slice = stm.getbuffer()[cu.cu_offset:crash_pos+1]
+        ctxt['cu_in_info'] =  ' '.join("%02x" % b for b in slice)
+    except Exception:
+        pass
+    report_crash(exc, tb, version, currentframe(), ctxt)
+
+    QApplication.instance().win.show_warning("This executable file is corrupt or incompatible with the current version of DWARF Explorer. Please consider creating a new issue at https://github.com/sevaa/dwex/, and share this file with the tech support.")
+
 class DWARFTreeModel(QAbstractItemModel):
     def __init__(self, di, prefix, sortcus, sortdies):
         QAbstractItemModel.__init__(self)
         self.prefix = prefix
-        self.top_dies = [decorate_die(CU.get_top_DIE(), i) for (i, CU) in enumerate(di._CUs)]
-        self.highlight_condition = None
+        self.top_dies = [top_node_placeholder(CU, i) for (i, CU) in enumerate(di._CUs)] # Nodes, actually
+        self.next_top = 0 # Nothing before that is a placeholder
+        self.highlights = Highlights()
+        self.hlgen = 0 # Bumped on every highlight change, see is_node_highlighted()
+        self.hlscanner = QTimer(self) # Evaluates the new highlights for every DIE, between the UI events
+        self.hlscanner.setInterval(0)
+        self.hlscanner.timeout.connect(self.on_highlight_scan)
         self.sortcus = sortcus
         self.sortdies = sortdies
+        # Sorted, a partial child list would be sorted wrong, so the rest is loaded between the UI events,
+        # and shown once it's all there. Node to (nodes so far, DIE index position of the next one)
+        self.full_loads = dict()
+        self.fullloader = QTimer(self)
+        self.fullloader.setInterval(0)
+        self.fullloader.timeout.connect(self.on_full_load)
 
     # Qt callbacks. QTreeView supports progressive loading, as long as you feed it the "item has children" bit in advance
 
     def index(self, row, col, parent):
         if parent.isValid():
-            parent_die = parent.internalPointer()
-            # print("child of %s" % parent_die.tag)
-            load_children(parent_die, self.sortdies)
-            return self.createIndex(row, col, parent_die._children[row])
+            parent_node = parent.internalPointer()
+            self.load_node_children(parent_node)
+            return self.createIndex(row, col, parent_node._children[row])
         else:
             return self.createIndex(row, col, self.top_dies[row])
         return QModelIndex()
 
     def flags(self, index):
         f = Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsEnabled
-        if index.isValid() and not index.internalPointer().has_children:
+        if index.isValid() and not self.node(index).has_children:
             f = f | Qt.ItemFlag.ItemNeverHasChildren
         return f
 
     def hasChildren(self, index):
-        return not index.isValid() or index.internalPointer().has_children
+        return not index.isValid() or self.node(index).has_children
 
     def rowCount(self, parent):
         if parent.isValid():
-            parent_die = parent.internalPointer()
-            # print('rcount of %s' % parent_die.tag)
-            if not parent_die.has_children: # Legitimately nothing
+            parent_node = parent.internalPointer()
+            if not parent_node.has_children: # Legitimately nothing
                 return 0
             else:
-                load_children(parent_die, self.sortdies)
-                return len(parent_die._children)
+                self.load_node_children(parent_node)
+                return len(parent_node._children)
         else:
             return len(self.top_dies)
 
+    # Wide child lists come in chunks, as the tree is scrolled - unsorted only
+    def canFetchMore(self, parent):
+        return parent.isValid() and not self.sortdies and parent.internalPointer()._more is not None
+
+    def fetchMore(self, parent):
+        self.load_more(parent.internalPointer(), CHUNK)
+
     def columnCount(self, parent):
         return 1
 
     def parent(self, index):
         if index.isValid():
-            parent = index.internalPointer().get_parent()
+            parent = index.internalPointer().parent
             if parent:
                 return self.createIndex(parent._i, 0, parent)
         return QModelIndex()
 
     def data(self, index, role):
-        die = index.internalPointer()
+        node = self.node(index)
         if role == Qt.ItemDataRole.DisplayRole:
-            if die.tag == 'DW_TAG_compile_unit' or die.tag == 'DW_TAG_partial_unit': # CU/top die: return file name
-                return top_die_file_name(die)
-            else: # Return tag, with name if possible
-                if isinstance(die.tag, int): # Happens with user tags, #1472
-                    s = ('DW_TAG_user_%X' if self.prefix else 'user_%X') % die.tag
-                else:
-                    s = die.tag if self.prefix or not str(die.tag).startswith('DW_TAG_') else die.tag[7:]
-                if DIE_has_name(die):
-                    s += ": " + DIE_name(die)
-                return s
+            text = node._text
+            if text is None:
+                text = node._text = self.display_text(node)
+            return text
         elif role == Qt.ItemDataRole.ToolTipRole:
-            if die.tag == 'DW_TAG_compile_unit' or die.tag == 'DW_TAG_partial_unit':
-                return safe_DIE_name(die, None)
-        elif role == Qt.ItemDataRole.ForegroundRole and self.is_highlighted(die):
+            if node.tag == 'DW_TAG_compile_unit' or node.tag == 'DW_TAG_partial_unit':
+                return node.name
+        elif role == Qt.ItemDataRole.ForegroundRole and self.is_node_highlighted(node):
             return blue_brush
-        elif role == Qt.ItemDataRole.FontRole and self.is_highlighted(die):
+        elif role == Qt.ItemDataRole.FontRole and self.is_node_highlighted(node):
             return bold_font()
 
     # The rest is not Qt callbacks
 
+    def load_node_children(self, node):
+        if node._children is None:
+            load_child_nodes(node, self.sortdies)
+            if self.sortdies and node._more is not None:
+                self.full_loads[node] = ([], node._more)
+                self.fullloader.start()
+
+    # Loads count more children of the node, or all if count is None, and lets the views know
+    def load_more(self, node, count):
+        touch_CU(node.cu)
+        try:
+            (nodes, more) = parse_child_nodes(node, node._more, count)
+        except KeyError as exc:
+            report_bad_children(exc, node.cu)
+            (nodes, more) = ([], None)
+        node._more = more
+        self.add_rows(node, nodes)
+
+    def add_rows(self, node, nodes):
+        if nodes:
+            n = len(node._children)
+            self.beginInsertRows(self.createIndex(node._i, 0, node), n, n + len(nodes) - 1)
+            number_nodes(nodes, n)
+            node._children += nodes
+            self.endInsertRows()
+
+    # All of the node's children, in the current order
+    def complete_children(self, node):
+        self.load_node_children(node)
+        if node._more is not None:
+            loaded = self.full_loads.pop(node, None)
+            if loaded: # Whatever the background got so far
+                self.add_rows(node, loaded[0])
+                node._more = loaded[1]
+            self.load_more(node, None)
+            if self.sortdies:
+                self.sort_children(node)
+
+    def sort_children(self, node):
+        def resort():
+            node._children.sort(key = node_sort_key)
+            number_nodes(node._children)
+        self.reorder(resort)
+
+    # Sorted mode, partial child lists - a chunk at a time, until the time slice is up
+    def on_full_load(self):
+        deadline = time.monotonic() + 0.02
+        while self.full_loads and time.monotonic() < deadline:
+            (node, (nodes, more)) = next(iter(self.full_loads.items()))
+            touch_CU(node.cu)
+            try:
+                (chunk, more) = parse_child_nodes(node, more, CHUNK)
+            except KeyError as exc:
+                report_bad_children(exc, node.cu)
+                (chunk, more) = ([], None)
+            nodes += chunk
+            if more is None:
+                del self.full_loads[node]
+                node._more = None
+                self.add_rows(node, nodes)
+                self.sort_children(node)
+            else:
+                self.full_loads[node] = (nodes, more)
+        if not self.full_loads:
+            self.fullloader.stop()
+
+    # Not a placeholder
+    def node(self, index):
+        node = index.internalPointer()
+        load_top_node(node)
+        return node
+
+    # Fills the placeholder top nodes, in order, until the deadline (time.monotonic())
+    # Returns True if there's more
+    def load_top_nodes(self, deadline):
+        top_nodes = self.top_dies
+        while self.next_top < len(top_nodes):
+            node = top_nodes[self.next_top]
+            self.next_top += 1 # Past it even if it can't be parsed
+            if node.tag is None:
+                load_top_node(node)
+                if time.monotonic() >= deadline:
+                    break
+        return self.next_top < len(top_nodes)
+
+    def display_text(self, node):
+        if node.tag == 'DW_TAG_compile_unit' or node.tag == 'DW_TAG_partial_unit': # CU/top die: return file name
+            return top_die_file_name(node.die)
+        else: # Return tag, with name if possible
+            if isinstance(node.tag, int): # Happens with user tags, #1472
+                s = ('DW_TAG_user_%X' if self.prefix else 'user_%X') % node.tag
+            else:
+                s = node.tag if self.prefix or not str(node.tag).startswith('DW_TAG_') else node.tag[7:]
+            if node.name is not None:
+                s += ": " + node.name
+            return s
+
+    # The DIE behind a tree index, or None
+    def die_for_index(self, index):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        touch_CU(node.cu)
+        return node.die
+
     def is_highlighted(self, die):
-        if not self.highlight_condition:
-            return False
-        return next((True for v in self.highlight_condition.values() if v(die)), False)
+        return self.highlights.is_highlighted(die)
 
-    def add_highlight(self, key, condition):
-        if not self.highlight_condition:
-            self.highlight_condition = {key:condition}
-        else:
-            self.highlight_condition[key] = condition
+    # Same, cached in the node until the highlights change, so that repaints don't evaluate the conditions
+    def is_node_highlighted(self, node):
+        if not self.highlights:
+            return False
+        hl = node._hl
+        if hl is None or hl[0] != self.hlgen:
+            touch_CU(node.cu)
+            hl = node._hl = (self.hlgen, self.highlights.is_offset_highlighted(node.cu, node.offset, lambda: node.die))
+        return hl[1]
+
+    # Offsets of the highlighted DIEs in the CU, in order, or None if not known yet - for find()
+    def highlight_candidates(self, cu):
+        return self.highlights.candidates(cu)
+
+    def on_highlight_scan(self):
+        if not self.highlights.scan(time.monotonic() + 0.02):
+            self.hlscanner.stop()
+        else: # No need to poll the worker processes that often
+            self.hlscanner.setInterval(HL_POLL_INTERVAL if self.highlights.waiting() else 0)
+
+    # batches, if any, are the condition being evaluated in the worker processes, see ParallelHighlightScan
+    def add_highlight(self, key, condition, batches = None):
+        self.hlgen += 1
+        self.highlights.add(key, condition, [node.cu for node in self.top_dies], batches)
+        self.hlscanner.setInterval(0)
+        self.hlscanner.start()
         self.dataChanged.emit(self.createIndex(0, 0, self.top_dies[0]), self.createIndex(len(self.top_dies)-1, 0, self.top_dies[-1]), (Qt.ItemDataRole.ForegroundRole, Qt.ItemDataRole.FontRole))
 
     def remove_highlight(self, key):
-        del self.highlight_condition[key]
+        self.hlgen += 1
+        self.highlights.remove(key)
         self.dataChanged.emit(self.createIndex(0, 0, self.top_dies[0]), self.createIndex(len(self.top_dies)-1, 0, self.top_dies[-1]), (Qt.ItemDataRole.ForegroundRole, Qt.ItemDataRole.FontRole))
 
     def clear_highlight(self):
-        self.highlight_condition = None
+        self.hlgen += 1
+        self.highlights.cancel()
+        self.highlights = Highlights()
+        self.hlscanner.stop()
         if len(self.top_dies):
             self.dataChanged.emit(self.createIndex(0, 0, self.top_dies[0]), self.createIndex(len(self.top_dies)-1, 0, self.top_dies[-1]), (Qt.ItemDataRole.ForegroundRole, Qt.ItemDataRole.FontRole))
 
     def has_highlight(self, key):
-        return bool(self.highlight_condition and key in self.highlight_condition)
+        return key in self.highlights
     
+    def highlight_keys(self):
+        return set(self.highlights.keys())
+
     def has_any_highlights(self):
-        return bool(self.highlight_condition and len(self.highlight_condition))
+        return bool(self.highlights)
 
     def set_prefix(self, prefix):
         if prefix != self.prefix:
             self.prefix = prefix
+            nodes = list(self.top_dies)
+            while nodes: # The display strings of the loaded nodes
+                node = nodes.pop()
+                node._text = None
+                if node._children:
+                    nodes += node._children
             self.dataChanged.emit(
                 self.createIndex(0, 0, self.top_dies[0]),
                 self.createIndex(len(self.top_dies)-1, 0, self.top_dies[-1]))    
 
-    # returns the model index of the selection, or None
-    def set_sortcus(self, sortcus, sel):
+    # Reorders the loaded nodes in place, nothing is parsed again.
+    # The persistent indices - the selection, the expanded nodes - follow the nodes to their new rows.
+    def reorder(self, resort):
+        self.layoutAboutToBeChanged.emit()
+        old = self.persistentIndexList()
+        nodes = [index.internalPointer() for index in old]
+        resort()
+        self.changePersistentIndexList(old, [self.createIndex(node._i, index.column(), node) for (index, node) in zip(old, nodes)])
+        self.layoutChanged.emit()
+
+    def set_sortcus(self, sortcus):
         if sortcus != self.sortcus:
-            sel_die = sel.internalPointer() if sel.isValid() else None
-            self.beginResetModel()
             self.sortcus = sortcus
-            #Resort the CUs, reload the top_dies
-            di = self.top_dies[0].dwarfinfo
-            sort_key = cu_sort_key if self.sortcus else lambda cu: cu.cu_offset
-            di._CUs.sort(key = sort_key)
-            for (i, cu) in enumerate(di._CUs):
-                cu._i = i
-                self.top_dies[i] = cu.get_top_DIE() # Already decorated, but the index is off
-                self.top_dies[i]._i = i
-            # Reload
-            self.endResetModel()
-            if sel_die:
-                if sel_die.get_parent(): # Not a top level
-                    return sel
-                else:
-                    return self.createIndex(0, sel_die._i, sel_die)
-
-    # Returns the index of the new selection, if any
+            di = self.top_dies[0].cu.dwarfinfo
+            if sortcus and di._cu_names is None:
+                di._cu_names = [top_die_file_name(cu.get_top_DIE()) for cu in di._unsorted_CUs]
+            def resort():
+                di._CUs.sort(key = cu_sort_key if sortcus else lambda cu: cu.cu_offset)
+                top_nodes = {node.cu.cu_offset: node for node in self.top_dies}
+                for (i, cu) in enumerate(di._CUs):
+                    cu._i = i
+                    self.top_dies[i] = top_nodes[cu.cu_offset]
+                    self.top_dies[i]._i = i
+                self.next_top = 0 # The placeholders, if any, are all over the place now
+            self.reorder(resort)
+
+    # The child lists are loaded in the offset order, so that's what unsorting means
+    # The partial ones are the first chunks, the loading of the rest starts over
     def set_sortdies(self, sortdies):
         if sortdies != self.sortdies:
             self.sortdies = sortdies
-            self.beginResetModel()
-            for (i, die) in enumerate(self.top_dies):
-                # Fragile! We invalidate the children in the decorated DIEs in the CU DIE cache
-                # To force reloading and sorting
-                for top_die in self.top_dies:
-                    for die in top_die.cu._dielist:
-                        die._children = None
-            self.endResetModel()
-            return self.createIndex(0, 0, self.top_dies[0])
+            self.full_loads.clear()
+            self.fullloader.stop()
+            partial = []
+            def resort():
+                sort_key = node_sort_key if sortdies else lambda node: node.offset
+                nodes = list(self.top_dies)
+                while nodes:
+                    node = nodes.pop()
+                    children = node._children
+                    if children:
+                        children.sort(key = sort_key)
+                        number_nodes(children)
+                        nodes += children
+                    if node._more is not None:
+                        partial.append(node)
+            self.reorder(resort)
+            if sortdies and partial:
+                for node in partial:
+                    self.full_loads[node] = ([], node._more)
+                self.fullloader.start()
 
     # Identifier for the current tree node that you can navigate to
     # For the back-forward logic
     # Specifically, (cu, offset within the info section)
     def get_navitem(self, index):
-        die = index.internalPointer()
-        return (die.cu, die.offset) if die else None # Issue # 1473, weird.
+        node = index.internalPointer()
+        return (node.cu, node.offset) if node else None # Issue # 1473, weird.
 
     # navitem is (CU, offset within the info section)
     # returns an index within the tree
     def index_for_navitem(self, navitem):
         target_cu, target_offset = navitem
-        # Random access is a tricky proposition in the current version. Parse the whole CU.
-        for _ in target_cu.iter_DIEs():
-            pass
-
-        # Abusing the structure of the per-CU DIE cache of pyelftools, it's the same in DWWARFv1
-        i = bisect_left(target_cu._diemap, target_offset)
-        if i >= len(target_cu._diemap) or target_cu._diemap[i] != target_offset:
-            return None
-        target_die = target_cu._dielist[i]
-        if target_die.is_null():
+        # Parses only the target DIE and its ancestors
+        target_die = find_DIE(target_cu, target_offset)
+        if target_die is None:
             return None
         return self.index_for_die(target_die)
 
-    # Takes a die that might not have an _i
-    # Restores the _i
-    # Assumes some parent DIEs of the current one are already parsed
-    # and cached in the CU, so get_parent will always return a valid parent DIE
+    # Finds the tree node for the DIE, loading the nodes along the path if the tree was never opened this deep
+    # Assumes get_parent will always return a valid parent DIE - true for the DIEs from find_DIE and from CU iteration
     def index_for_die(self, die):
-        if hasattr(die, '_i'): # DIE already iterated over
-            return self.createIndex(die._i, 0, die)
-        else: # Found the DIE, but the tree was never opened this deep. Read the tree along the path to the target DIE
-            index = False
-            while not hasattr(die, '_i'):
-                parent_die = die.get_parent()
-                load_children(parent_die, self.sortdies) # This will populate the _i in all children of parent_die, including die
-                if not index: # After the first iteration, the one in the direct parent of target_die, target_die will have _i
-                    if die.is_null():
-                        die = parent_die._children[-1] # Null is a terminator in a sequence - move to the sibling
-                        # TODO: move to the closest in terms of offset, which would require going down the nearest sibling's tree
-                    index = self.createIndex(die._i, 0, die)
-                die = parent_die
-            return index
+        touch_CU(die.cu)
+        path = [] # Offsets, from the target up, without the top DIE
+        null_target = die.is_null()
+        parent = die.get_parent()
+        while parent:
+            path.append(die.offset)
+            die = parent
+            parent = die.get_parent()
+        node = self.top_dies[die.cu._i]
+        for (level, offset) in enumerate(reversed(path)):
+            self.load_node_children(node)
+            if self.sortdies or (null_target and level == len(path) - 1):
+                self.complete_children(node)
+            else: # Loading just as far as the target
+                while node._more is not None and node._children[-1].offset < offset:
+                    self.load_more(node, CHUNK)
+            children = node._children
+            if not children:
+                break
+            if null_target and level == len(path) - 1:
+                node = children[-1] # Null is a terminator in a sequence - move to the sibling
+                # TODO: move to the closest in terms of offset, which would require going down the nearest sibling's tree
+            elif self.sortdies:
+                node = next((child for child in children if child.offset == offset), None) or node
+            else:
+                i = bisect_left(children, offset, key = lambda child: child.offset)
+                if i < len(children) and children[i].offset == offset:
+                    node = children[i]
+        return self.createIndex(node._i, 0, node)
 
     # Returns the index of the found item, or False
     # start_pos is the index of the current item, or an invalid one
     # cond is a condition function
     # cu_cond is the same for CUs - hook for find by IP
-    def find(self, start_pos, cond, cu_cond = False):
+    # cu_candidates, if provided, returns the offsets of the DIEs in the CU that might match, in order,
+    # or None if it doesn't know - hook for the string index
+    def find(self, start_pos, cond, cu_cond = False, cu_candidates = None):
         have_start_pos = start_pos.isValid()
         if have_start_pos: # Searching from a specific position, with wrap-around
-            start_die = start_pos.internalPointer()
-            start_die_offset = start_die.offset # In the current die, before the next one
-            start_cu = start_die.cu
+            start_node = start_pos.internalPointer()
+            start_die_offset = start_node.offset # In the current die, before the next one
+            start_cu = start_node.cu
             start_cu_offset = start_cu.cu_offset
             cu = start_cu
             wrapped = False
@@ -276,8 +559,16 @@ class DWARFTreeModel(QAbstractItemModel):
             cu_offset = cu.cu_offset
             # Parse all DIEs in the current CU
             if cu_cond(cu) if cu_cond else True:
+                touch_CU(cu) # So that a search through the whole binary doesn't keep the whole binary parsed
+                candidates = cu_candidates(cu) if cu_candidates else None
+                if candidates is None:
+                    dies = cu.iter_DIEs()
+                else:
+                    if have_start_pos and not wrapped and cu_offset == start_cu_offset: # Don't bother with the ones before the start
+                        candidates = candidates[bisect_right(candidates, start_die_offset):]
+                    dies = (find_DIE(cu, offset) for offset in candidates)
                 try: #1516
-                    for die in cu.iter_DIEs():
+                    for die in dies:
                         # Quit condition with search from position - quit once we go past the starting position after the wrap
                         if have_start_pos and cu_offset >= start_cu_offset and die.offset > start_die_offset and wrapped:
                             break
@@ -320,12 +611,12 @@ class DWARFTreeModel(QAbstractItemModel):
         return False
 
     # Search back - same idea
-    def find_back(self, start_pos, cond, cu_cond = False):
+    def find_back(self, start_pos, cond, cu_cond = False, cu_candidates = None):
         have_start_pos = start_pos.isValid()
         if have_start_pos: # Searching from a specific position, with wrap-around
-            start_die = start_pos.internalPointer()
-            start_die_offset = start_die.offset # In the current die, before the next one
-            start_cu = start_die.cu
+            start_node = start_pos.internalPointer()
+            start_die_offset = start_node.offset # In the current die, before the next one
+            start_cu = start_node.cu
             start_cu_offset = start_cu.cu_offset
             cu = start_cu
             wrapped = False
@@ -336,25 +627,21 @@ class DWARFTreeModel(QAbstractItemModel):
             cu_offset = cu.cu_offset
             # Parse all DIEs in the current CU
             if cu_cond(cu) if cu_cond else True:
-                for die in cu.iter_DIEs(): # Fill the DIE cache
-                    pass
-
-                # Abusing the internal cache of pyelftools - fragile!
-
-                if have_start_pos and not wrapped and cu_offset == start_cu_offset:
-                    i = bisect_left(cu._diemap, start_die_offset-1)-1
+                touch_CU(cu)
+                before = start_die_offset if have_start_pos and not wrapped and cu_offset == start_cu_offset else None
+                candidates = cu_candidates(cu) if cu_candidates else None
+                if candidates is None:
+                    dies = iter_DIEs_back(cu, before)
                 else:
-                    i = len(cu._diemap) - 1
-
-                while i >= 0:
-                    die = cu._dielist[i]
-                    if not die.is_null():
-                        # Quit condition with search from position - quit once we go past the starting position after the wrap
-                        if have_start_pos and die.offset == start_die_offset and wrapped:
-                            return False
-                        if cond(die):
-                            return self.index_for_die(die)
-                    i -= 1
+                    if before is not None:
+                        candidates = candidates[:bisect_left(candidates, before)]
+                    dies = (find_DIE(cu, offset) for offset in reversed(candidates))
+                for die in dies:
+                    # Quit condition with search from position - quit once we go past the starting position after the wrap
+                    if have_start_pos and die.offset == start_die_offset and wrapped:
+                        return False
+                    if cond(die):
+                        return self.index_for_die(die)
 
             # We're at the end of the CU. What next?
             if cu._i > 0: # More CUs to scan
@@ -375,15 +662,6 @@ class DWARFTreeModel(QAbstractItemModel):
             if 0 <= offset-td.cu.cu_die_offset < td.cu.header.unit_length), False)
         if not cu:
             return None
-        # On an off chance it's already parsed and the offset is precise
-        i = bisect_right(cu._diemap, offset)
-        if offset == cu._diemap[i - 1]:
-            return self.index_for_die(cu._dielist[i - 1])
-        # Now the hard way
-        # It would be possible to optimize that, parse not all DIEs but just some
-        # But let's not.
-        for die in cu.iter_DIEs():
-            pass
-        i = bisect_right(cu._diemap, offset)
-        return self.index_for_die(cu._dielist[i - 1])
-
+        # The DIE that contains the offset
+        die = find_DIE(cu, offset, False)
+        return self.index_for_die(die) if die else None
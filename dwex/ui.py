@@ -22,6 +22,22 @@ def setup_menu(win):
     win.exporttree_menuitem = file_menu.addAction("Export C skeleton...")
     win.exporttree_menuitem.triggered.connect(win.on_export_tree)
     win.exporttree_menuitem.setEnabled(False)
+    win.mapfiles_menuitem = file_menu.addAction("Memory-map files")
+    win.mapfiles_menuitem.setCheckable(True)
+    win.mapfiles_menuitem.setChecked(win.mapfiles)
+    win.mapfiles_menuitem.triggered.connect(win.on_mapfiles)
+    win.cacheindex_menuitem = file_menu.addAction("Cache indices on disk")
+    win.cacheindex_menuitem.setCheckable(True)
+    win.cacheindex_menuitem.setChecked(win.cacheindex)
+    win.cacheindex_menuitem.triggered.connect(win.on_cacheindex)
+    win.stringindex_menuitem = file_menu.addAction("Index strings in the background")
+    win.stringindex_menuitem.setCheckable(True)
+    win.stringindex_menuitem.setChecked(win.stringindex)
+    win.stringindex_menuitem.triggered.connect(win.on_stringindex)
+    win.parallelfind_menuitem = file_menu.addAction("Search in parallel processes")
+    win.parallelfind_menuitem.setCheckable(True)
+    win.parallelfind_menuitem.setChecked(win.parallelfind)
+    win.parallelfind_menuitem.triggered.connect(win.on_parallelfind)
     win.mru_menu = file_menu.addMenu("Recent files")
     if len(win.mru):
         win.populate_mru_menu()
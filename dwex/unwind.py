@@ -1,7 +1,10 @@
-from dwex.details import GenericTableModel
+from bisect import bisect_right
+from itertools import accumulate
+from dwex.details import GenericTableModel, PagedTableModel
 from PyQt6.QtWidgets import QHeaderView
 from .frames import FramesUIDlg
-from .machounwind import MachoUnwindInfo, UnwindCommandARM64, UnwindCommandIntel, NopEntry, FallbackEntry
+from .dwarfutil import get_unwind_info
+from .machounwind import UnwindCommandARM64, UnwindCommandIntel, NopEntry, FallbackEntry
 from .exprutil import _REG_NAME_MAP, format_offset
 
 def format_arg(e):
@@ -15,23 +18,25 @@ def format_arg(e):
 class UnwindDlg(FramesUIDlg):
     def __init__(self, win, unwind_section, di, regnames, hex_):
         FramesUIDlg.__init__(self, win)
-        if hasattr(di, '_unwind_info'):
-            uw = di._unwind_info
-        else:
-            uw = di._unwind_info = MachoUnwindInfo(unwind_section, di._arch_code[0])
+        uw = get_unwind_info(di)
 
         self.dwarfinfo = di
         self.regnames = _REG_NAME_MAP.get(di.config.machine_arch, None) if not regnames else None
 
-        lines = [(hex(di._start_address + e.address), hex(e.encoding), e.command.name, format_arg(e), e)
-            for p in uw.pages if p.entries for e in p.entries]
-        self.entries.setModel(GenericTableModel(('Address', 'Encoding', 'Command', 'Argument(s)'), lines))
+        # Rows are made as they are scrolled into view, the pages of the section are decoded as they are reached
+        counts = uw.pages.entry_counts()
+        starts = tuple(accumulate(counts, initial=0)) # Row of the first entry of every page, and the row count at the end
+        def get_row(i):
+            p = bisect_right(starts, i, 0, len(counts)) - 1
+            e = uw.pages[p].entries[i - starts[p]]
+            return (hex(di._start_address + e.address), hex(e.encoding), e.command.name, format_arg(e), e)
+        self.entries.setModel(PagedTableModel(('Address', 'Encoding', 'Command', 'Argument(s)'), starts[-1], get_row))
         self.entries.horizontalHeader().setSectionResizeMode(3, QHeaderView.ResizeMode.ResizeToContents)
         self.entries.selectionModel().currentChanged.connect(self.on_entry_sel)
 
     def on_entry_sel(self, index, prev = None):
         try:
-            entry = self.entries.model().values[index.row()][-1]
+            entry = self.entries.model().row(index.row())[-1]
             de = self.dwarfinfo._unwind_info.decode_entry(entry)
             if isinstance(de, NopEntry):
                 headers = ('',)
@@ -46,9 +51,9 @@ class UnwindDlg(FramesUIDlg):
                 value = (self.regname(de.cfa_base_register) + format_offset(de.cfa_offset),)
                 value += tuple(f"[CFA{format_offset(-off)}]" for off in de.saved_registers.values())
                 values = (value,)
-        except NotImplementedError:
+        except NotImplementedError as exc:
             headers = ('',)
-            values = (('Not supported yet.',),)
+            values = ((str(exc) or 'Not supported yet.',),)
         self.details.setModel(GenericTableModel(headers, values))
 
     def regname(self, regno):
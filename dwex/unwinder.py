@@ -0,0 +1,353 @@
+import sys, json, argparse, base64
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from struct import Struct
+
+from elftools.dwarf.callframe import CFARule
+
+from .formats import read_dwarf, recall_slice
+from .dwarfutil import get_di_frames, get_fde_index, get_unwind_info
+from .machounwind import DecodedEntry, FallbackEntry
+from .symbolize import prepare_dwarfinfo, Symbolizer, parse_address
+
+# Headless stack unwinder, for crash snapshots - the registers at the crash point plus a copy
+# of the stack memory. No Qt here.
+#
+# python -m dwex.unwinder -e binary [options] < snapshots.jsonl
+#
+# Frame by frame, the rules come from:
+# - compact unwind (__unwind_info), on Mach-O;
+# - the eh_frame FDE that the compact unwind entry points at, when it says so (FallbackEntry);
+# - the FDE that covers the address, from debug_frame or eh_frame (FDEIndex);
+# - the frame pointer chain, if none of the above is there or works.
+# An Unwinder indexes the binary once. The rules are normalized into tuples and cached
+# by address, so unwinding many snapshots against the same binary is mostly the memory reads.
+
+MAX_FRAMES = 256 # Per snapshot, in case the stack loops
+MAX_CACHED_RULES = 16384 # Normalized rules kept by Unwinder, least recently used out
+
+# How a register is restored in the caller
+_AT = 0 # From the memory at CFA+arg
+_VAL = 1 # CFA+arg
+_REG = 2 # From register arg
+_UNKNOWN = 3 # Undefined, or an expression that can't be evaluated
+
+# Architecture to the DWARF numbers of (SP, FP, return address register, link register),
+# and whether the frame records go [FP] = caller's FP, [FP+size] = return address.
+# The return address register is what the CIEs would name, for when there's no CIE. On Intel, it's the IP.
+_arch_regs = {
+    'x86': (4, 5, 8, None, True),
+    'I386': (4, 5, 8, None, True),
+    'x64': (7, 6, 16, None, True),
+    'AMD64': (7, 6, 16, None, True),
+    'X86_64': (7, 6, 16, None, True),
+    'ARM': (13, 11, 14, 14, False), # Thumb code uses r7 for FP, no frame chain guessing
+    'AArch64': (31, 29, 30, 30, True),
+    'ARM64': (31, 29, 30, 30, True)}
+
+def _arch_registers(arch):
+    regs = _arch_regs.get(arch)
+    if regs is None and arch.startswith('ARM64'): # Mach-O flavors - ARM64E, ARM64V8
+        regs = _arch_regs['ARM64']
+    elif regs is None and arch.startswith('ARMV'):
+        regs = _arch_regs['ARM']
+    if regs is None:
+        raise NotImplementedError(f"Unwinding is not supported for {arch}")
+    return regs
+
+# stack_address is the address of stack[0]; lr is for ARM, where the return address of the innermost function
+# may be in a register. slide is the load address minus the preferred load address.
+Snapshot = namedtuple('Snapshot', ('ip', 'sp', 'fp', 'stack', 'stack_address', 'lr', 'slide'), defaults=(None, None, 0))
+
+# method is how the frame was recovered from the one before - 'context' for the innermost one,
+# then 'compact', 'eh_frame' (via compact unwind), 'cfi' (by address), or 'fp'
+Frame = namedtuple('Frame', ('ip', 'sp', 'fp', 'method'))
+
+class Unwinder(object):
+    # di is a decorated DWARFInfo, see symbolize.prepare_dwarfinfo()
+    def __init__(self, di):
+        self.di = di
+        (self.sp_reg, self.fp_reg, self.ra_reg, self.lr_reg, self.fp_chain) = _arch_registers(di.config.machine_arch)
+        self.address_size = size = di.config.default_address_size
+        self.word = Struct(('<' if di.config.little_endian else '>') + ('Q' if size == 8 else 'I'))
+        self.start_address = getattr(di, '_start_address', None) or 0
+
+        self.compact = None
+        unwind_section = getattr(di, '_unwind_sec', None)
+        if unwind_section:
+            try:
+                self.compact = get_unwind_info(di)
+            except NotImplementedError: # 32-bit ARM
+                pass
+        frames = get_di_frames(di)
+        self.eh = frames.eh if frames else None
+        self.fdes = get_fde_index(di) # Built here rather than on the first snapshot
+        self.rules = OrderedDict() # Address to the normalized rule, or False if none
+
+    #------------------------------------
+    # Rules. A rule is (CFA register, CFA offset, restores, return address register, method)
+    # where restores is a tuple of (register, how, arg).
+    #------------------------------------
+
+    # Address is at the preferred load address
+    def rule_at(self, address):
+        rules = self.rules
+        rule = rules.get(address)
+        if rule is None:
+            rule = rules[address] = self.find_rule(address) or False
+            if len(rules) > MAX_CACHED_RULES:
+                rules.popitem(False)
+        else:
+            rules.move_to_end(address)
+        return rule
+
+    def find_rule(self, address):
+        if self.compact:
+            relative = address - self.start_address
+            entry = self.compact.find_by_address_raw(relative)
+            if entry is not None:
+                try:
+                    de = self.compact.decode_entry(entry)
+                except NotImplementedError: # Intel frameless entries with the stack size in the code, and no code - try by address
+                    de = None
+                if isinstance(de, DecodedEntry):
+                    restores = tuple((regno, _AT, -offset) for (regno, offset) in de.saved_registers.items())
+                    return (de.cfa_base_register, de.cfa_offset, restores, self.ra_reg, 'compact')
+                elif isinstance(de, FallbackEntry) and self.eh:
+                    fde = self.eh.fde_at_offset(de.offset)
+                    if fde is not None:
+                        rule = self.fde_rule(fde, address, 'eh_frame')
+                        if rule:
+                            return rule
+        if self.fdes:
+            fde = self.fdes.fde_at(address)
+            if fde is not None:
+                return self.fde_rule(fde, address, 'cfi')
+        return None
+
+    def fde_rule(self, fde, address, method):
+        rows = self.fdes.decoded(fde).table
+        i = bisect_right(rows, address, key = lambda row: row['pc']) - 1
+        if i < 0:
+            return None
+        row = rows[i]
+        cfa = row.get('cfa')
+        if not isinstance(cfa, CFARule) or cfa.expr is not None or cfa.reg is None:
+            return None
+        restores = []
+        for (regno, rule) in row.items():
+            if regno in ('pc', 'cfa'):
+                continue
+            type = rule.type
+            if type == 'OFFSET':
+                restores.append((regno, _AT, rule.arg))
+            elif type == 'VAL_OFFSET':
+                restores.append((regno, _VAL, rule.arg))
+            elif type == 'REGISTER':
+                restores.append((regno, _REG, rule.arg))
+            elif type != 'SAME_VALUE':
+                restores.append((regno, _UNKNOWN, None))
+        return (cfa.reg, cfa.offset, tuple(restores), fde.cie.header.return_address_register, method)
+
+    #------------------------------------
+    # Steps. regs is a dict of the known register values by DWARF number; read() reads a word off the stack,
+    # returns None if out of the snapshot. Return (return address, caller's regs), or None.
+    #------------------------------------
+
+    def apply_rule(self, rule, regs, read):
+        (cfa_reg, cfa_offset, restores, ra_reg, _) = rule
+        base = regs.get(cfa_reg)
+        if base is None:
+            return None
+        cfa = base + cfa_offset
+        caller = dict(regs) # Same value unless said otherwise
+        for (regno, how, arg) in restores:
+            if how == _AT:
+                value = read(cfa + arg)
+            elif how == _VAL:
+                value = cfa + arg
+            elif how == _REG:
+                value = regs.get(arg)
+            else:
+                value = None
+            if value is None:
+                caller.pop(regno, None)
+            else:
+                caller[regno] = value
+        ra = caller.get(ra_reg)
+        if ra is None:
+            return None
+        caller[self.sp_reg] = cfa
+        return (ra, caller)
+
+    def follow_fp(self, regs, read):
+        fp = regs.get(self.fp_reg)
+        sp = regs.get(self.sp_reg)
+        if fp is None or sp is None or fp < sp:
+            return None
+        size = self.address_size
+        (caller_fp, ra) = (read(fp), read(fp + size))
+        if caller_fp is None or ra is None:
+            return None
+        caller = dict(regs)
+        caller[self.fp_reg] = caller_fp
+        caller[self.sp_reg] = fp + 2*size
+        caller[self.ra_reg] = ra
+        return (ra, caller)
+
+    def reader(self, stack, stack_address):
+        unpack = self.word.unpack_from
+        last = len(stack) - self.word.size
+        def read(address):
+            offset = address - stack_address
+            if 0 <= offset <= last:
+                return unpack(stack, offset)[0]
+            return None
+        return read
+
+    # Returns a list of Frame, innermost first
+    def unwind(self, snapshot, max_frames = MAX_FRAMES):
+        (ip, sp, fp, stack, stack_address, lr, slide) = snapshot
+        read = self.reader(stack, sp if stack_address is None else stack_address)
+        sp_reg = self.sp_reg
+        regs = {sp_reg: sp, self.fp_reg: fp}
+        if lr is not None and self.lr_reg is not None:
+            regs[self.lr_reg] = lr
+        frames = [Frame(ip, sp, fp, 'context')]
+        while len(frames) < max_frames:
+            # Past the innermost frame, the IP is a return address, it may be past the end of the caller's code
+            address = ip - slide - (1 if len(frames) > 1 else 0)
+            rule = self.rule_at(address)
+            step = self.apply_rule(rule, regs, read) if rule else None
+            method = rule[4] if step else 'fp'
+            if step is None and self.fp_chain:
+                step = self.follow_fp(regs, read)
+            if step is None:
+                break
+            (ip, caller) = step
+            if not ip or caller[sp_reg] <= regs[sp_reg]: # End of the stack, or garbage
+                break
+            regs = caller
+            frames.append(Frame(ip, caller[sp_reg], caller.get(self.fp_reg), method))
+        return frames
+
+    def unwind_batch(self, snapshots, max_frames = MAX_FRAMES):
+        return [self.unwind(snapshot, max_frames) for snapshot in snapshots]
+
+#------------------------------------
+# Command line
+#------------------------------------
+
+def parse_number(v):
+    if isinstance(v, int) or v is None:
+        return v
+    return int(v[2:] if v.lower().startswith('0x') else v, 16)
+
+# One JSON object per line: ip, sp, fp, optional lr - numbers or hex strings; stack - base64;
+# optional stack_address (defaults to sp), optional load_address. Anything else, like an id, is echoed back.
+def parse_snapshot(line, default_slide, start_address):
+    j = json.loads(line)
+    slide = default_slide
+    if 'load_address' in j:
+        slide = parse_number(j['load_address']) - start_address
+    snapshot = Snapshot(parse_number(j['ip']), parse_number(j['sp']), parse_number(j.get('fp', 0)),
+        base64.b64decode(j['stack']), parse_number(j.get('stack_address')), parse_number(j.get('lr')), slide)
+    return (j, snapshot)
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m dwex.unwinder',
+        description='Unwinds crash snapshots - registers and a copy of the stack - into the call stacks, using the unwind info in the binary.')
+    parser.add_argument('-e', '--exe', required=True, help='The binary with DWARF and unwind info in it')
+    parser.add_argument('--slice', help='For fat binaries and static libraries: arch, or arch:member, or member')
+    parser.add_argument('-b', '--load-address', help='The address the module was loaded at, if not the preferred one (hex); a snapshot may have its own')
+    parser.add_argument('-f', '--functions', action='store_true', help='Symbolize the frames, with the inlines')
+    parser.add_argument('--max-frames', type=int, default=MAX_FRAMES, help='Frames per snapshot at most')
+    parser.add_argument('--input', help='Read the snapshots from a file rather than from stdin')
+    parser.add_argument('--batch-size', type=int, default=4096, help='Snapshots to symbolize at a time')
+    args = parser.parse_args()
+
+    from .patch import monkeypatch
+    monkeypatch()
+
+    slice_code = None
+    if args.slice:
+        slice_code = tuple(args.slice.split(':', 1))
+    def no_slice(slices, title, text):
+        raise ValueError('This is a fat binary or a static library, please specify --slice. The choices are: ' +
+            ', '.join(a if isinstance(a, str) else a[0] + ':' + '|'.join(a[1]) for a in slices))
+    try:
+        di = read_dwarf(args.exe, recall_slice(slice_code) if slice_code else no_slice, True)
+    except Exception as exc:
+        print("%s: %s" % (args.exe, format(exc)), file=sys.stderr)
+        return 1
+    if not di:
+        print("%s: no DWARF information found, or the format is not supported" % (args.exe,), file=sys.stderr)
+        return 1
+    prepare_dwarfinfo(di)
+    try:
+        unwinder = Unwinder(di)
+    except NotImplementedError as exc:
+        print("%s: %s" % (args.exe, format(exc)), file=sys.stderr)
+        return 1
+
+    start_address = unwinder.start_address
+    slide = 0
+    if args.load_address:
+        load_address = parse_address(args.load_address)
+        if load_address is None:
+            print("Bad load address: " + args.load_address, file=sys.stderr)
+            return 1
+        slide = load_address - start_address
+
+    sym = Symbolizer(di) if args.functions else None
+    width = di.config.default_address_size*2
+    out = sys.stdout
+    batch = [] # (JSON, snapshot, frames or error)
+    def flush():
+        if sym:
+            # Return addresses are looked up one byte back, same as the rules
+            addresses = [f.ip - s.slide - (1 if i else 0) for (j, s, frames) in batch if isinstance(frames, list) for (i, f) in enumerate(frames)]
+            sym.symbolize_batch(addresses)
+        for (j, s, frames) in batch:
+            if isinstance(frames, list):
+                out_frames = []
+                for (i, f) in enumerate(frames):
+                    of = {'ip': '0x%0*x' % (width, f.ip), 'sp': '0x%0*x' % (width, f.sp), 'method': f.method}
+                    if sym:
+                        of['functions'] = [{'function': sf.name, 'file': sf.file, 'line': sf.line, 'inlined': sf.inlined}
+                            for sf in sym.symbolize(f.ip - s.slide - (1 if i else 0))]
+                    out_frames.append(of)
+                j['frames'] = out_frames
+            else:
+                j['error'] = frames
+            j.pop('stack', None)
+            out.write(json.dumps(j) + '\n')
+        out.flush()
+        del batch[:]
+
+    file = open(args.input, 'r') if args.input else sys.stdin
+    try:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                (j, snapshot) = parse_snapshot(line, slide, start_address)
+            except (ValueError, KeyError, TypeError, AttributeError) as exc:
+                batch.append(({}, None, 'Bad snapshot: ' + format(exc)))
+            else:
+                try:
+                    frames = unwinder.unwind(snapshot, args.max_frames)
+                except Exception as exc: # Malformed unwind info - pyelftools asserts, missing augmentation data and such
+                    frames = 'Unwinding failed: ' + (format(exc) or type(exc).__name__)
+                batch.append((j, snapshot, frames))
+            if len(batch) >= args.batch_size:
+                flush()
+        if batch:
+            flush()
+    finally:
+        if args.input:
+            file.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
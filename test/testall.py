@@ -1,24 +1,133 @@
 import os, sys
+from bisect import bisect_left
 from PyQt6.QtCore import Qt, QAbstractItemModel, QAbstractTableModel, QModelIndex
 sys.path.insert(1, os.getcwd()) # To make sure dwex resolves to local path
 from elftools.dwarf.locationlists import LocationParser, LocationExpr
 from dwex.formats import read_dwarf
 from dwex.die import DIETableModel
-from dwex.dwarfutil import strip_path
+from dwex.dwarfutil import decorate_dwarfinfo, get_source_line, has_code_location, ip_in_range, strip_path
+from dwex.addrindex import get_address_index
+from dwex.dieindex import NO_PARENT, scan_die_index
+from dwex.condition import Condition, make_execution_environment
+from dwex.symbolize import prepare_dwarfinfo
+from dwex.unwinder import Unwinder, parse_snapshot
+
+# The fast paths against the slow ones that they replaced, CU by CU
+
+# The DIE index against parsing the whole CU
+def check_die_index(CU):
+    index = scan_die_index(CU)
+    if index is None: # DWARF 1, or a form that the scanner doesn't know - the app falls back to parsing, too
+        return
+    offsets = []
+    parents = []
+    ends = []
+    open_ends = [] # Positions of the DIEs whose subtrees are not over yet
+    for die in CU.iter_DIEs():
+        if die.is_null(): # Closes the innermost open subtree
+            if open_ends:
+                ends[open_ends.pop()] = die.offset + die.size
+        else:
+            offsets.append(die.offset)
+            parent = die.get_parent()
+            parents.append(parent.offset if parent else NO_PARENT)
+            if die.has_children:
+                open_ends.append(len(ends))
+                ends.append(CU.cu_offset + CU.size) # Unless terminated
+            else:
+                ends.append(die.offset + die.size)
+    assert list(index.offsets) == offsets
+    assert list(index.parents) == parents
+    assert list(index.ends) == ends
+    for i in range(0, len(offsets), max(len(offsets) // 64, 1)):
+        die = index.get_DIE(i)
+        assert die.offset == offsets[i]
+        assert (die.get_parent().offset if die.get_parent() else NO_PARENT) == parents[i]
+
+# The address index against ip_in_range() on every DIE with code, at the range boundaries
+def check_address_index(CU, dies):
+    index = get_address_index(CU)
+    coded = [die for die in dies if has_code_location(die)]
+    probes = sorted(set(a for (low, high) in zip(index.lows, index.highs) for a in (low - 1, low, high - 1, high)))
+    for ip in probes[::max(len(probes) // 64, 1)]:
+        expected = []
+        for die in coded:
+            try:
+                if ip_in_range(die, ip):
+                    expected.append(die.offset)
+            except Exception: # No base address and such - the index leaves those out
+                pass
+        assert list(index.offsets_at(ip)) == expected
+
+# get_source_line() on the compiled line table against a run through the line program,
+# the way it used to be done, at the addresses of the states and right after
+def check_line_table(CU):
+    lp = CU.dwarfinfo.line_program_for_CU(CU)
+    if not lp:
+        return
+    v5 = CU.header.version >= 5
+    top_die = CU.get_top_DIE()
+    states = [entry.state for entry in lp.get_entries() if entry.state]
+    probes = sorted(set(a for state in states for a in (state.address, state.address + 1)))
+    probes = probes[::max(len(probes) // 256, 1)]
+    expected = dict() # The first pair of consecutive states in a sequence that covers the address wins
+    prevstate = None
+    for state in states:
+        if prevstate:
+            for i in range(bisect_left(probes, prevstate.address), bisect_left(probes, state.address)):
+                if probes[i] not in expected:
+                    try:
+                        file = top_die.attributes['DW_AT_name'].value if not v5 and prevstate.file == 0 else lp['file_entry'][prevstate.file + (0 if v5 else -1)].name
+                        expected[probes[i]] = (file.decode('UTF-8'), prevstate.line)
+                    except IndexError: # File number out of range
+                        expected[probes[i]] = None
+        prevstate = None if state.end_sequence else state
+    for address in probes:
+        assert get_source_line(top_die, address) == expected.get(address)
+
+# Some user conditions - static and not, partially static, with lambdas and the like
+test_conditions = ("tag == 'subprogram'",
+    "tag in ('variable', 'formal_parameter') and not die.has_children",
+    "'DW_AT_name' in attr and tag != 'member'",
+    "die.tag == 'DW_TAG_subprogram' and external and name",
+    "tag == 'base_type' and byte_size > 2",
+    "byte_size == 4",
+    "has_attribute(lambda k, v, f: f == 'DW_FORM_strp')",
+    "tag == 'variable' and has_loclist()",
+    "(t := tag) == 'structure_type' or t == 'union_type'",
+    "die.has_children and any(c.tag == 'DW_TAG_member' for c in die.iter_children())")
+
+# Same as TheWindow.eval_user_condition, errors are false
+def eval_condition(f):
+    try:
+        return bool(f())
+    except Exception:
+        return False
+
+# The compiled conditions against eval() in the environment with everything bound, the way it used to be done
+def check_conditions(conditions, dies):
+    for cond in conditions:
+        code = compile(cond.source, 'inline', 'eval')
+        def compiled(die):
+            v = cond.quick(die)
+            return v if v is not None else eval(cond.code, cond.environment(die))
+        for die in dies:
+            assert eval_condition(lambda: compiled(die)) == eval_condition(lambda: eval(code, make_execution_environment(die)))
 
 def test_dwarfinfo(di):
-    # Some global cache setup in line with the app proper
-    di._ranges = None
-    di._CUs = [cu for cu in di.iter_CUs()]
-    di._locparser = None
+    # Same global cache setup as the app proper
+    decorate_dwarfinfo(di)
 
     m = False
     dummy_index = QModelIndex()
+    conditions = [Condition(source) for source in test_conditions] # They cache by abbreviation, per binary
     for (i, CU) in enumerate(di._CUs):
         top_die = CU.get_top_DIE()
         print("%s" % strip_path(top_die.attributes['DW_AT_name'].value.decode('utf-8', errors='ignore')) if 'DW_AT_name' in top_die.attributes else "(no name)")
-        CU._lineprogram = None
-        CU._exprparser = None
+        check_die_index(CU)
+        check_address_index(CU, [die for die in CU.iter_DIEs() if not die.is_null()])
+        check_line_table(CU)
+        check_conditions(conditions, [die for die in CU.iter_DIEs() if not die.is_null()])
         for die in CU.iter_DIEs():
             if not die.is_null():
                 assert die.tag.startswith('DW_TAG_')
@@ -94,6 +203,23 @@ def test_tree_for(path, on_di):
 def test_tree(path):
     test_tree_for(path, test_dwarfinfo)
 
+# Unwinds the snapshots that unwind/t.c wrote, see there, and compares the call stacks
+# with what backtrace(3) got in the process. The binary has no frame pointers, so that's the CFI.
+# The unwinder is not expected to go past the first frame outside of the binary, it has no CFI for those.
+def test_unwind(path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'unwind')):
+    di = prepare_dwarfinfo(read_dwarf(os.path.join(path, 't.elf'), None))
+    unwinder = Unwinder(di)
+    with open(os.path.join(path, 't.jsonl')) as f:
+        for line in f:
+            (j, snapshot) = parse_snapshot(line, 0, unwinder.start_address)
+            backtrace = j['backtrace']
+            frames = unwinder.unwind(snapshot)
+            assert frames[0].method == 'context'
+            assert all(frame.method == 'cfi' for frame in frames[1:])
+            # Return addresses from the caller of snap() to main's, into libc
+            n = next(i for (i, ip) in enumerate(backtrace) if not unwinder.fdes.fde_at(ip - snapshot.slide - 1)) + 1
+            assert [frame.ip for frame in frames[1:n+1]] == backtrace[:n]
+
 
 
 
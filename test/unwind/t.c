@@ -0,0 +1,86 @@
+// The test program for test_unwind() in testall.py. Built and run as:
+//
+// gcc -O2 -g -fomit-frame-pointer -o t.elf t.c && ./t.elf t.jsonl
+//
+// Writes a crash snapshot - the registers and a copy of the stack, see dwex/unwinder.py - from a few
+// call chains of different depths and frame sizes, along with what backtrace(3) made of the same stack.
+// Without the frame pointers, unwinding that takes the CFI. x86_64 only.
+
+#include <stdio.h>
+#include <stdint.h>
+#include <string.h>
+#include <stdlib.h>
+#include <execinfo.h>
+
+extern char __executable_start;
+static uintptr_t stack_top;
+static FILE *out;
+
+static void write_base64(const unsigned char *p, size_t n)
+{
+    static const char digits[] = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+    for (size_t i = 0; i < n; i += 3)
+    {
+        uint32_t v = p[i] << 16 | (i + 1 < n ? p[i+1] << 8 : 0) | (i + 2 < n ? p[i+2] : 0);
+        fputc(digits[v >> 18], out);
+        fputc(digits[(v >> 12) & 63], out);
+        fputc(i + 1 < n ? digits[(v >> 6) & 63] : '=', out);
+        fputc(i + 2 < n ? digits[v & 63] : '=', out);
+    }
+}
+
+__attribute__((noinline)) void snap(void)
+{
+    uintptr_t sp, ip;
+    __asm__ volatile("lea (%%rip), %0" : "=r"(ip));
+    __asm__ volatile("mov %%rsp, %0" : "=r"(sp));
+    void *bt[64];
+    int n = backtrace(bt, 64);
+    fprintf(out, "{\"ip\": %lu, \"sp\": %lu, \"fp\": 0, \"load_address\": %lu, \"backtrace\": [", ip, sp, (uintptr_t)&__executable_start);
+    for (int i = 1; i < n; i++)
+        fprintf(out, "%s%lu", i > 1 ? ", " : "", (uintptr_t)bt[i]);
+    fprintf(out, "], \"stack\": \"");
+    write_base64((const unsigned char *)sp, stack_top - sp);
+    fprintf(out, "\"}\n");
+}
+
+volatile int sink;
+
+__attribute__((noinline)) int f3(int n, int k)
+{
+    int a[k+1];
+    a[k] = n;
+    if (n <= 0)
+    {
+        snap();
+        return a[k];
+    }
+    sink += a[k];
+    return f3(n-1, k) + 1;
+}
+
+__attribute__((noinline)) int f2(int n)
+{
+    char buf[100];
+    memset(buf, n, sizeof buf);
+    sink += buf[n % 100];
+    return f3(n, n % 7 + 1) * 2 + buf[3];
+}
+
+__attribute__((noinline)) int f1(int n)
+{
+    if (n & 1)
+        return f2(n) + 1;
+    return f2(n + 2) - 1;
+}
+
+int main(int argc, char **argv)
+{
+    int x;
+    stack_top = ((uintptr_t)&x + 4096) & ~4095;
+    out = fopen(argv[1], "w");
+    for (int i = 0; i < 8; i++)
+        sink += f1(i);
+    fclose(out);
+    return 0;
+}